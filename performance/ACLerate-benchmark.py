@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+# Copyright (c) 2018 Arista Networks, Inc.  All rights reserved.
+# Arista Networks, Inc. Confidential and Proprietary.
+
+#This script is used to benchmark ACLerate off-switch.  Rather than the
+#EOS SDK, ACLerate is run against the stand-in in fakesdk/eossdk.py which
+#records the ACL calls made instead of programming any HW.  Therefore, the
+#results measure only ACLerate's own processing, i.e. reading, parsing and
+#validating the JSON files and making the SDK calls.
+#It is executed:
+#   ACLerate-benchmark.py [--output <file>] [<rule_count> ...]
+#where
+#   file: JSON file the results are written to (default ACLerate-benchmark.json)
+#   rule_count: number of rules in the ACL (default 1000 10000 100000 1000000)
+#Hence
+#   ACLerate-benchmark.py --output before.json 1000 50000
+#will measure ACLerate processing ACLs of 1000 and 50000 rules.  For each
+#rule count, a rules description file is generated with rules-json-writer.py
+#and processed twice: initially, creating the ACL, and then again unchanged
+#(when the entry is skipped as its fingerprint is unchanged).
+#Each rule count is measured in a separate process so that the peak RSS
+#reported is that of processing that ACL alone.  The results (rules/sec,
+#peak RSS, time in each processing phase and SDK call counts) are written as
+#JSON so that runs against different commits can be compared.
+#pyinotify must be installed; the EOS SDK is not needed.
+
+import imp
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+perf_dir = os.path.dirname(os.path.abspath(__file__))
+top_dir = os.path.dirname(perf_dir)
+
+default_rule_counts = [1000, 10000, 100000, 1000000]
+
+def run(sdk, agent):
+    """Carry out a configuration pass, returning its duration, the
+    processing time of each phase and the entries executed and skipped"""
+
+    completed = agent.metrics.completed
+    start = time.time()
+    agent.process_config()
+    sdk.run_until_idle()
+    duration = time.time() - start
+    if agent.metrics.completed == completed:
+        raise RuntimeError("configuration pass did not complete")
+
+    phases = {}
+    for timer in agent.metrics.last:
+        for phase, phase_duration in timer.phases.iteritems():
+            phases[phase] = phases.get(phase, 0.0) + phase_duration
+    entries = sdk.agent_mgr.status.get("Entries %s:" % agent.config_path)
+    return duration, phases, entries
+
+def benchmark(rule_count, work_dir):
+    """Run in a child process: process the ACL in work_dir with ACLerate and
+    print the results as JSON"""
+
+    sys.path.insert(0, os.path.join(perf_dir, "fakesdk"))
+    sys.path.insert(1, os.path.join(top_dir, "src"))
+    import eossdk
+    import ACLerate
+
+    config_file = os.path.join(work_dir, "ACLerate-config.json")
+    ACLerate.ACLerate_config_file = config_file
+    ACLerate.metrics_file = None
+    ACLerate.snapshot_file = None
+    ACLerate.control_socket = None
+    ACLerate.ACLerate_config_dir = None
+    ACLerate.counters_interval = None
+    # There is no TCAM to exhaust
+    ACLerate.tcam_entry_budget = None
+    ACLerate.tcam_counter_budget = None
+
+    sdk = eossdk.Sdk()
+    agent = ACLerate.ACLerate(sdk)
+    acl_mgr = sdk.get_acl_mgr()
+
+    results = {"rules": rule_count}
+    for run_name in ("initial", "unchanged"):
+        acl_mgr.calls.clear()
+        duration, phases, entries = run(sdk, agent)
+        results[run_name] = {"duration": duration,
+                             "rules_per_sec": rule_count / duration,
+                             "phases": phases,
+                             "entries": entries,
+                             "calls": dict(acl_mgr.calls)}
+
+    # ru_maxrss is in KB on Linux
+    results["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print json.dumps(results)
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       cwd=top_dir).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    args = sys.argv[1:]
+
+    if args and args[0] == "--single":
+        benchmark(int(args[1]), args[2])
+        return
+
+    output = "ACLerate-benchmark.json"
+    if args and args[0] == "--output":
+        output = args[1]
+        args = args[2:]
+    rule_counts = [int(arg) for arg in args] or default_rule_counts
+
+    writer = imp.load_source("rules_json_writer",
+                             os.path.join(top_dir, "utilities", "rules-json-writer.py"))
+
+    results = []
+    for rule_count in rule_counts:
+        work_dir = tempfile.mkdtemp(prefix="ACLerate-benchmark-")
+        try:
+            rules_file = os.path.join(work_dir, "ACLerate-rules.json")
+            writer.rules_write(rule_count, rules_file)
+            with open(os.path.join(work_dir, "ACLerate-config.json"), "w") as f:
+                json.dump([{"command": "add-rule",
+                            "name": "ACLerate-benchmark",
+                            "type": "IPv4",
+                            "interface": "Ethernet1",
+                            "direction": "in",
+                            "operation": "attach",
+                            "rules": rules_file}], f, indent=2)
+
+            output_json = subprocess.check_output([sys.executable, __file__, "--single",
+                                                   str(rule_count), work_dir])
+            result = json.loads(output_json.splitlines()[-1])
+        finally:
+            shutil.rmtree(work_dir)
+
+        sys.stderr.write("%s rules: %.0f rules/sec initially, %.0f rules/sec unchanged, "
+                         "peak RSS %sKB\n" % (rule_count, result["initial"]["rules_per_sec"],
+                                              result["unchanged"]["rules_per_sec"],
+                                              result["peak_rss_kb"]))
+        results.append(result)
+
+    with open(output, "w") as f:
+        json.dump({"commit": git_commit(),
+                   "timestamp": time.time(),
+                   "python": sys.version.split()[0],
+                   "results": results}, f, indent=2)
+    sys.stderr.write("Results written to %s\n" % output)
+
+if __name__ == '__main__':
+   sys.exit( main() )
@@ -4,65 +4,185 @@
 
 #This script is used to evaluate the performance of ACLerate
 #It is executed:
-#   ACLerate-performance-evaluation.py <rule_min> <rule_max> <rule_step> <run_count>
+#   ACLerate-performance-evaluation.py <rule_min> <rule_max> <rule_step> <run_count> [--eapi]
 #where
 #   rule_min: lowest number of rules
 #   rule_max: highest number of rules
 #   rule_step: increment step size
-#   run_count: number of runs for each number of rules (average of these results should be used)
+#   run_count: number of runs for each number of rules (percentiles of these results are reported)
+#   --eapi: also time eAPI-ACL.py creating the same ACL, for comparison
 #Hence
 #   ACLerate-performance-evaluation.py 2000 5000 500 100
 #will evaluate ACLerate's perfromance in creating ACLs containing
 #2000, 2500, 3000 .... 5000 rules.  For each value in this range
 #ACLerate will attempt to apply the ACL to HW and then remove it
 #100 times before moving on.
-#(The results are printed to ACLerate-results.txt by ACLerate.)
+#Rather than pausing for a fixed time after each change, the script waits for
+#ACLerate to report that it has finished processing the change, i.e. for the
+#HW to respond, by watching ACLerate's metrics file.  The parse, HW and overall
+#durations of each run are taken from the same file.  The results of every run
+#are written to ACLerate-results.csv and a summary with percentiles for each
+#number of rules to ACLerate-results.json.
+#With --eapi, eAPI-ACL.py is given the add and then the delete configuration
+#file directly, rather than through ACLerate's configuration file, so that
+#ACLerate does not program the ACL at the same time.
 #The ACLerate daemon should be running before this script is kicked off.
 
 import json
+import os
 import sys
 import time
 import subprocess
-from jsonrpclib import Server
 
-rule_min = int(sys.argv[1])
-rule_max = int(sys.argv[2])
-rule_step = int(sys.argv[3])
-run_count = int(sys.argv[4])
+#Must match metrics_file in ACLerate.py
+ACLerate_metrics_file = '/var/tmp/ACLerate-metrics.json'
+eapi_results_file = 'eAPI-results.txt'
 
-start_time = time.time()
+#Give up waiting for ACLerate after this many secs
+completion_timeout = 600
+poll_interval = 0.05
 
-#Need to pause to allow the HW to apply the ACL before removing it etc.
-#May need to make these larger as processing times grows with number of rules
-#i.e. Care should be taken with these values.
-add_processing_delay = 30
-del_processing_delay = 5
+#Phases which are not part of parsing & processing the files before the commit
+non_parse_phases = ["commit", "hw_sync", "intf_apply", "total"]
 
-#Ensure clean slate before starting test by deleting an any pre-exsiting ACLs
-subprocess.call("cp /mnt/flash/ACLerate-config-del.json /mnt/flash/ACLerate-config.json", shell=True)
-time.sleep(del_processing_delay)
+def metrics_read():
+    try:
+        with open(ACLerate_metrics_file) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
 
-for i in xrange(rule_min, rule_max, rule_step):
+def completed_count():
+    metrics = metrics_read()
+    if metrics is None:
+        return 0
+    return metrics["completed"]
 
-    #Create rules files containing this number of rules
-    #Add some randomisation to rules???
-    subprocess.call("python /mnt/flash/rules-json-writer.py %s" % i, shell=True)
+def config_apply(config_file):
+    """Copy config_file into place then wait for ACLerate to finish processing
+    it.  Returns the timings ACLerate recorded for the ACL, or None if ACLerate
+    did not complete processing in time."""
 
-    #For each number of rules, the configuration file is changed to add
-    #the ACL and then remove the ACL.  These changes to the file are
-    #detected by ACLerate which will then update the HW accordingly.
-    for j in range (run_count):
+    previous = completed_count()
+    start_time = time.time()
+    subprocess.call("cp %s /mnt/flash/ACLerate-config.json" % config_file, shell=True)
 
-        #Set config file to add ACL.
-        subprocess.call("cp /mnt/flash/ACLerate-config-add.json /mnt/flash/ACLerate-config.json", shell=True)
-        #Pause for the HW to create the ACL.
-        time.sleep(add_processing_delay)
+    while completed_count() == previous:
+        if time.time() - start_time > completion_timeout:
+            sys.stderr.write("ACLerate did not respond to %s within %ss\n" %
+                             (config_file, completion_timeout))
+            return None
+        time.sleep(poll_interval)
 
-        #Tidy up: set config file to delete ACL then call eAPI to execute
-        subprocess.call("cp /mnt/flash/ACLerate-config-del.json /mnt/flash/ACLerate-config.json", shell=True)
-        #Pause for the HW to delete the ACL.
-        time.sleep(del_processing_delay)
+    wall_duration = time.time() - start_time
+    for timer in metrics_read()["last"]:
+        phases = timer["phases"]
+        if "rule_set" in phases or "parse" in phases:
+            parse = sum(duration for phase, duration in phases.iteritems()
+                        if phase not in non_parse_phases)
+            return {"parse": parse,
+                    "hw": phases.get("hw_sync", 0.0),
+                    "overall": phases.get("total", wall_duration),
+                    "wall": wall_duration,
+                    "failed": timer["failed"]}
+    return {"parse": None, "hw": None, "overall": None, "wall": wall_duration, "failed": False}
 
-#This value is of no great signficance but print anyway.
-test_duration = time.time() - start_time
-sys.stderr.write("Test complete (duration: %ss)\n" % test_duration)
+def eapi_results():
+    try:
+        with open(eapi_results_file) as f:
+            return f.readlines()
+    except IOError:
+        return []
+
+def eapi_run(config_file):
+    """Run eAPI-ACL.py creating the ACL in config_file and return the durations
+    it appended to its results file, or None for each if it appended none"""
+
+    previous = len(eapi_results())
+    subprocess.call("python /mnt/flash/eAPI-ACL.py %s" % config_file, shell=True)
+    results = eapi_results()
+    if len(results) == previous:
+        sys.stderr.write("eAPI-ACL.py recorded no results for %s\n" % config_file)
+        return {"parse": None, "hw": None, "overall": None}
+    fields = results[-1].split(",")
+    return {"parse": float(fields[1]), "hw": float(fields[2]), "overall": float(fields[3])}
+
+def percentiles(values):
+    values = sorted(value for value in values if value is not None)
+    if not values:
+        return None
+    return dict(("p%s" % p, values[min(len(values) - 1, len(values) * p // 100)])
+                for p in (50, 95, 99))
+
+def summarise(runs):
+    return dict((key, percentiles([run[key] for run in runs]))
+                for key in ("parse", "hw", "overall"))
+
+def main():
+    args = [arg for arg in sys.argv[1:] if arg != "--eapi"]
+    with_eapi = "--eapi" in sys.argv[1:]
+
+    rule_min = int(args[0])
+    rule_max = int(args[1])
+    rule_step = int(args[2])
+    run_count = int(args[3])
+
+    start_time = time.time()
+    if with_eapi:
+        open(eapi_results_file, "w").close()
+
+    #Ensure clean slate before starting test by deleting an any pre-exsiting ACLs
+    config_apply("/mnt/flash/ACLerate-config-del.json")
+
+    csv = open('ACLerate-results.csv', 'w')
+    csv.write("tool, rules, run, parse, hw, overall\n")
+    summary = []
+
+    for i in xrange(rule_min, rule_max + 1, rule_step):
+
+        #Create rules files containing this number of rules
+        #Add some randomisation to rules???
+        subprocess.call("python /mnt/flash/rules-json-writer.py %s" % i, shell=True)
+
+        #For each number of rules, the configuration file is changed to add
+        #the ACL and then remove the ACL.  These changes to the file are
+        #detected by ACLerate which will then update the HW accordingly.
+        runs = {"ACLerate": [], "eAPI": []}
+        for j in range (run_count):
+
+            #Set config file to add ACL and wait for the HW to create the ACL.
+            result = config_apply("/mnt/flash/ACLerate-config-add.json")
+            if result is None:
+                sys.exit(1)
+            runs["ACLerate"].append(result)
+
+            #Tidy up: set config file to delete ACL and wait for the HW to delete it.
+            if config_apply("/mnt/flash/ACLerate-config-del.json") is None:
+                sys.exit(1)
+
+            if with_eapi:
+                runs["eAPI"].append(eapi_run("/mnt/flash/ACLerate-config-add.json"))
+                #eAPI-ACL.py also deletes ACLs using the delete config file
+                subprocess.call("python /mnt/flash/eAPI-ACL.py "
+                                "/mnt/flash/ACLerate-config-del.json", shell=True)
+
+        for tool, tool_runs in sorted(runs.iteritems()):
+            for j, run in enumerate(tool_runs):
+                csv.write("%s, %d, %d, %s, %s, %s\n" % (tool, i, j, run["parse"],
+                                                         run["hw"], run["overall"]))
+            if tool_runs:
+                summary.append({"tool": tool, "rules": i, "runs": len(tool_runs),
+                                "durations": summarise(tool_runs)})
+        csv.flush()
+        sys.stderr.write("%s rules complete\n" % i)
+
+    csv.close()
+    with open('ACLerate-results.json', 'w') as f:
+        json.dump(summary, f, indent=2)
+
+    #This value is of no great signficance but print anyway.
+    test_duration = time.time() - start_time
+    sys.stderr.write("Test complete (duration: %ss)\n" % test_duration)
+
+if __name__ == '__main__':
+   sys.exit( main() )
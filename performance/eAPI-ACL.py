@@ -8,6 +8,9 @@
 #commands to the switch, timing how long it takes for the ACL to be
 #programmed.  The results are printed suitably delimited into a file
 #for convenient processing in Excel.
+#It is executed:
+#   eAPI-ACL.py [<config_file>]
+#where config_file defaults to ACLerate's configuration file.
 
 import json
 import sys
@@ -15,7 +18,7 @@ import time
 from jsonrpclib import Server
 
 #Use same config file as ACLerate so exactly same ACL and rules programmed.
-ACLerate_config_file = '/mnt/flash/ACLerate-config.json'
+ACLerate_config_file_default = '/mnt/flash/ACLerate-config.json'
 
 def main():
 
@@ -24,7 +27,11 @@ def main():
 
     start_time = time.time()
 
-    #Use the same config file used as ACLerate 
+    #Use the same config file used as ACLerate, unless told otherwise
+    if len(sys.argv) > 1:
+        ACLerate_config_file = sys.argv[1]
+    else:
+        ACLerate_config_file = ACLerate_config_file_default
     try:
         with open(ACLerate_config_file) as acl_config_file:
             acl_config_list = json.load(acl_config_file)
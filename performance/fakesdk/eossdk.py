@@ -0,0 +1,419 @@
+#!/usr/bin/env python
+# Copyright (c) 2018 Arista Networks, Inc.  All rights reserved.
+# Arista Networks, Inc. Confidential and Proprietary.
+
+"""In-process stand-in for the parts of the EOS SDK used by ACLerate.  It allows
+ACLerate to be run, and its performance measured, off-switch: ACL manager calls
+are recorded (and the resulting ACLs held in memory) rather than programmed,
+commits are acknowledged via on_acl_sync after a configurable delay, and a
+simple event loop drives the timeout handlers.  Place the directory containing
+this file at the front of sys.path before importing ACLerate."""
+
+import json
+import socket
+import time
+import collections
+
+ACL_TYPE_IPV4 = 0
+ACL_TYPE_IPV6 = 1
+ACL_TYPE_ETH = 2
+
+ACL_IN = 0
+ACL_OUT = 1
+
+ACL_PERMIT = 0
+ACL_DENY = 1
+
+class Error(Exception):
+   pass
+
+class NoSuchInterfaceError(Error):
+   pass
+
+def now():
+    return time.time()
+
+class Tracer(object):
+   def __init__(self, name):
+      self.name = name
+
+   def trace0(self, message):
+      pass
+
+class AclKey(object):
+   def __init__(self, name, acl_type):
+      self.name = name
+      self.type = acl_type
+
+   def acl_name(self):
+      return self.name
+
+   def acl_type(self):
+      return self.type
+
+   def __eq__(self, other):
+      return (self.name, self.type) == (other.name, other.type)
+
+   def __ne__(self, other):
+      return not self == other
+
+   def __hash__(self):
+      return hash((self.name, self.type))
+
+class IpAddr(object):
+   def __init__(self, addr):
+      family = socket.AF_INET6 if ":" in addr else socket.AF_INET
+      try:
+          self.packed = socket.inet_pton(family, addr)
+      except socket.error:
+          raise Error("Invalid IP address %s" % addr)
+      self.family = family
+
+   def to_string(self):
+      return socket.inet_ntop(self.family, self.packed)
+
+class IpPrefix(object):
+   def __init__(self, prefix):
+      addr, _, length = prefix.partition("/")
+      self.addr = IpAddr(addr)
+      max_length = 128 if self.addr.family == socket.AF_INET6 else 32
+      try:
+          self.length = int(length) if length else max_length
+      except ValueError:
+          raise Error("Invalid prefix length in %s" % prefix)
+      if not 0 <= self.length <= max_length:
+          raise Error("Invalid prefix length in %s" % prefix)
+
+   def network(self):
+      return self.addr
+
+   def prefix_length(self):
+      return self.length
+
+class IpAddrMask(object):
+   def __init__(self, addr, mask_length):
+      self.address = addr
+      self.length = mask_length
+
+   def addr(self):
+      return self.address
+
+   def mask_length(self):
+      return self.length
+
+   def to_string(self):
+      return "%s/%s" % (self.address.to_string(), self.length)
+
+class AclRuleIp(object):
+   def __init__(self):
+      self.source = None
+      self.destination = None
+      self.protocol = 0
+      self.rule_action = ACL_PERMIT
+      self.rule_log = False
+
+   def source_addr_is(self, addr):
+      self.source = addr
+
+   def source_addr(self):
+      return self.source
+
+   def destination_addr_is(self, addr):
+      self.destination = addr
+
+   def destination_addr(self):
+      return self.destination
+
+   def ip_protocol_is(self, protocol):
+      self.protocol = protocol
+
+   def ip_protocol(self):
+      return self.protocol
+
+   def action_is(self, action):
+      self.rule_action = action
+
+   def action(self):
+      return self.rule_action
+
+   def log_is(self, log):
+      self.rule_log = log
+
+   def log(self):
+      return self.rule_log
+
+class AclRuleIpEntry(object):
+   def __init__(self, number, acl_rule):
+      self.number = number
+      self.rule = acl_rule
+
+   def sequence_number(self):
+      return self.number
+
+   def acl_rule(self):
+      return self.rule
+
+class EapiResponse(object):
+   def __init__(self, success, responses, error_message=""):
+      self.succeeded = success
+      self.response_list = responses
+      self.message = error_message
+
+   def success(self):
+      return self.succeeded
+
+   def responses(self):
+      return self.response_list
+
+   def error_message(self):
+      return self.message
+
+class IntfId(object):
+   # Interface names accepted as existing
+   valid_prefixes = ("Ethernet", "Port-Channel", "Vlan", "Management", "Loopback")
+
+   def __init__(self, name):
+      if not name.startswith(self.valid_prefixes):
+          raise NoSuchInterfaceError("No such interface %s" % name)
+      self.name = name
+
+   def to_string(self):
+      return self.name
+
+   def __eq__(self, other):
+      return self.name == other.name
+
+   def __hash__(self):
+      return hash(self.name)
+
+class AgentMgr(object):
+   def __init__(self):
+      self.status = collections.OrderedDict()
+
+   def status_set(self, key, value):
+      self.status[key] = value
+
+   def status_del(self, key):
+      self.status.pop(key, None)
+
+   def agent_shutdown_complete_is(self, complete):
+      self.shutdown_complete = complete
+
+class AclMgr(object):
+   """Records every call made and maintains the resulting ACLs in memory"""
+
+   def __init__(self, sdk):
+      self.sdk = sdk
+      self.handlers = []
+      self.calls = collections.Counter()
+      self.acls = {}
+      self.counters_enabled = {}
+      self.applied = {}
+      # Secs between a commit and the corresponding on_acl_sync.  If
+      # sync_fail is set, on_acl_sync_fail is called with it instead.
+      self.sync_delay = 0
+      self.sync_fail = None
+      # Names of interfaces to which acl_apply fails
+      self.apply_fail = set()
+
+   def acl_rule_set(self, acl_key, number, acl_rule):
+      self.calls["acl_rule_set"] += 1
+      self.acls.setdefault(acl_key, {})[number] = acl_rule
+
+   def acl_rule_del(self, acl_key, number):
+      self.calls["acl_rule_del"] += 1
+      self.acls.get(acl_key, {}).pop(number, None)
+
+   def acl_del(self, acl_key):
+      self.calls["acl_del"] += 1
+      self.acls.pop(acl_key, None)
+      self.counters_enabled.pop(acl_key, None)
+      # Deleting an ACL detaches it from its interfaces
+      for binding, applied_key in self.applied.items():
+          if applied_key == acl_key:
+              del self.applied[binding]
+
+   def acl_exists(self, acl_key):
+      self.calls["acl_exists"] += 1
+      return acl_key in self.acls
+
+   def acl_iter(self):
+      self.calls["acl_iter"] += 1
+      return iter(list(self.acls))
+
+   def acl_rule_ip_iter(self, acl_key):
+      self.calls["acl_rule_ip_iter"] += 1
+      return iter([AclRuleIpEntry(number, acl_rule) for number, acl_rule
+                   in sorted(self.acls.get(acl_key, {}).items())])
+
+   def acl_counters_enabled_set(self, acl_key, enabled):
+      self.calls["acl_counters_enabled_set"] += 1
+      self.counters_enabled[acl_key] = enabled
+
+   def acl_apply(self, acl_key, intf_id, direction, apply):
+      self.calls["acl_apply"] += 1
+      if intf_id.to_string() in self.apply_fail:
+          raise Error("Cannot apply ACL to %s" % intf_id.to_string())
+      if apply:
+          self.applied[(intf_id.to_string(), direction)] = acl_key
+      elif self.applied.get((intf_id.to_string(), direction)) == acl_key:
+          del self.applied[(intf_id.to_string(), direction)]
+
+   def acl_commit(self):
+      self.calls["acl_commit"] += 1
+      self.sdk.call_later(self.sync_delay, self.sync)
+
+   def sync(self):
+      for handler in self.handlers:
+          if self.sync_fail is None:
+              handler.on_acl_sync()
+          else:
+              handler.on_acl_sync_fail("Linecard0", self.sync_fail)
+
+class EapiMgr(object):
+   """Answers the show access-lists commands ACLerate reads counters with"""
+
+   def __init__(self, sdk):
+      self.sdk = sdk
+      self.calls = collections.Counter()
+      # Number of times the counters of each ACL have been read.  Synthetic
+      # counters grow by number % stats_modulus packets per read, so some
+      # rules never match.  Counters may instead be set in counters, keyed by
+      # ACL key, as a dict of rule number to (packets, bytes).
+      self.stats_reads = collections.Counter()
+      self.stats_modulus = 4
+      self.counters = {}
+      # Commands which fail, with the error message
+      self.fail = {}
+
+   def run_show_cmd(self, command):
+      self.calls["run_show_cmd"] += 1
+      if command in self.fail:
+          return EapiResponse(False, [], self.fail[command])
+      words = command.split()
+      acl_types = {"ip": ACL_TYPE_IPV4, "ipv6": ACL_TYPE_IPV6, "mac": ACL_TYPE_ETH}
+      if len(words) != 4 or words[:1] + words[2:3] != ["show", "access-lists"]:
+          return EapiResponse(False, [], "Invalid input")
+      acl_key = AclKey(words[3], acl_types[words[1]])
+      acl_mgr = self.sdk.acl_mgr
+      if acl_key not in acl_mgr.acls:
+          return EapiResponse(True, [json.dumps({"aclList": []})])
+
+      counting = acl_mgr.counters_enabled.get(acl_key)
+      if counting and acl_key not in self.counters:
+          self.stats_reads[acl_key] += 1
+      reads = self.stats_reads[acl_key]
+      sequence = []
+      for number in sorted(acl_mgr.acls[acl_key]):
+          rule = {"sequenceNumber": number, "text": ""}
+          if counting:
+              packets, byte_count = self.counters.get(acl_key, {}).get(
+                 number, (reads * (number % self.stats_modulus),
+                          reads * (number % self.stats_modulus) * 100))
+              rule["counterData"] = {"packetCount": packets, "byteCount": byte_count}
+          sequence.append(rule)
+      return EapiResponse(True, [json.dumps({"aclList": [{"name": acl_key.acl_name(),
+                                                          "sequence": sequence}]})])
+
+class IntfMgr(object):
+   pass
+
+class TimeoutMgr(object):
+   pass
+
+class AgentHandler(object):
+   def __init__(self, agent_mgr):
+      agent_mgr.sdk.agent_handlers.append(self)
+
+   def on_initialized(self):
+      pass
+
+class AclHandler(object):
+   def __init__(self, acl_mgr):
+      acl_mgr.handlers.append(self)
+
+   def watch_all_acls(self, watch):
+      pass
+
+   def on_acl_sync(self):
+      pass
+
+   def on_acl_sync_fail(self, linecard, message):
+      pass
+
+class IntfHandler(object):
+   def __init__(self, intf_mgr):
+      pass
+
+class FdHandler(object):
+   def __init__(self):
+      pass
+
+   def watch_readable(self, fd, interest):
+      pass
+
+   def watch_writable(self, fd, interest):
+      pass
+
+class TimeoutHandler(object):
+   def __init__(self, timeout_mgr):
+      self.sdk = timeout_mgr.sdk
+
+   def timeout_time_is(self, when):
+      self.sdk.timeouts[self] = when
+
+   def on_timeout(self):
+      pass
+
+class Sdk(object):
+   """Owns the managers and runs a minimal event loop of timeouts"""
+
+   def __init__(self):
+      self.agent_handlers = []
+      self.timeouts = {}
+      self.agent_mgr = AgentMgr()
+      self.acl_mgr = AclMgr(self)
+      self.eapi_mgr = EapiMgr(self)
+      self.intf_mgr = IntfMgr()
+      self.timeout_mgr = TimeoutMgr()
+      for mgr in (self.agent_mgr, self.intf_mgr, self.timeout_mgr):
+          mgr.sdk = self
+
+   def get_agent_mgr(self):
+      return self.agent_mgr
+
+   def get_acl_mgr(self):
+      return self.acl_mgr
+
+   def get_eapi_mgr(self):
+      return self.eapi_mgr
+
+   def get_intf_mgr(self):
+      return self.intf_mgr
+
+   def get_timeout_mgr(self):
+      return self.timeout_mgr
+
+   def call_later(self, delay, callback):
+      """Invoke callback from the event loop after delay secs"""
+
+      handler = TimeoutHandler(self.timeout_mgr)
+      handler.on_timeout = callback
+      handler.timeout_time_is(now() + delay)
+
+   def run_until_idle(self):
+      """Run expired timeouts, sleeping until the next one is due, until there
+      are none outstanding"""
+
+      while self.timeouts:
+          handler, when = min(self.timeouts.items(), key=lambda item: item[1])
+          delay = when - now()
+          if delay > 0:
+              time.sleep(delay)
+          del self.timeouts[handler]
+          handler.on_timeout()
+
+   def main_loop(self, argv):
+      for handler in self.agent_handlers:
+          handler.on_initialized()
+      self.run_until_idle()
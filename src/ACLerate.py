@@ -12,18 +12,256 @@ import syslog
 import eossdk
 import json
 import pyinotify
-import functools
 import time
 import fcntl
+import os
+import collections
+import multiprocessing
+import mmap
+import socket
+import struct
+import zlib
+import bisect
+import re
+import errno
+import array
+import signal
+import cProfile
+import pstats
+import traceback
 
 ACLerate_config_file = '/mnt/flash/ACLerate-config.json'
 
+# Every *.json file in the directory ACLerate_config_dir is also a
+# configuration file (None disables this).  Each configuration file is
+# processed independently, e.g. so that several automation systems can each
+# maintain their own, and a change to one touches only the ACLs declared in
+# it.  An ACL may be declared in only one configuration file: entries for it
+# in any other are reported and ignored.
+ACLerate_config_dir = '/mnt/flash/ACLerate.d'
+
 # Use locks to attempt to prevent  config file being updated while it is being
 # processed.  If file already locked by another entity, attempt to acquire
-# lock file_lock_attempt times at file_lock_interval secs intervals
+# lock file_lock_attempt times at file_lock_interval secs intervals.  The agent
+# continues to service the event loop while waiting between attempts.
 file_lock_attempt = 5
 file_lock_interval = 1
 
+# Configuration file updates are acted upon only once no further update has
+# been notified for config_debounce secs (or config_debounce_max secs after the
+# first) so a burst of rewrites results in a single pass.  While a commit is
+# awaiting the HW, further passes are held back until the HW responds (or for
+# at most commit_wait_max secs), then a single pass processes the latest
+# configuration.
+config_debounce = 0.2
+config_debounce_max = 2
+commit_wait_max = 30
+
+# Rules description files are read and parsed incrementally, rules_read_size
+# bytes at a time, so memory use does not grow with the size of the file.
+rules_read_size = 65536
+
+# Compiled rules are cached so that a rules file shared by several ACLs, or
+# unchanged since it was last processed, is not parsed again.  The cache holds
+# at most rules_cache_max_files files and rules_cache_max_rules rules in total,
+# least recently used files being evicted first.  Larger files are not cached,
+# so memory use remains bounded however large the rules files are.  Only the
+# compiled rules are cached: SDK rule objects are built afresh each time.
+rules_cache_max_files = 16
+rules_cache_max_rules = 50000
+
+# Source and destination addresses are parsed and normalised in Python rather
+# than by the SDK, and the SDK address object for each distinct prefix is
+# created once and shared by every rule, of every ACL, using it.  At most
+# prefix_cache_max prefixes are remembered; the table is emptied when full.
+prefix_cache_max = 65536
+
+# Rules are programmed in chunks of at most rule_chunk_size rules or
+# rule_chunk_time secs, returning to the SDK event loop between chunks so that
+# other events and callbacks are not held up by very large ACLs.
+rule_chunk_size = 1000
+rule_chunk_time = 0.05
+
+# Processing each configuration file, the ACLs using changed rules files, or
+# control socket requests is a job.  Between chunks, a job is preempted by any
+# job of higher priority, so a small urgent change need not wait for a bulk
+# load to complete.  As a commit pushes all ACL changes made so far to HW, a
+# job is only preempted while it has no changes awaiting its commit, i.e.
+# before it starts changing ACLs and, unless batch_commit is set, between
+# entries.  With batch_commit set, an urgent job therefore waits for a job
+# already programming a large batch to commit it; urgent changes should be
+# kept out of bulk loads.  Each configuration entry may give its priority
+# (one of job_priorities) and deadline, the number of secs after the change
+# within which it should be in HW (job_deadlines gives the default for each
+# priority).  A job takes on the priority of its most urgent entry, running as
+# job_priority_new until its entries are known, and jobs past their deadline
+# are run ahead of all others.  Entries default to job_priority_default, or
+# job_priority_control for control socket commands.
+job_priorities = {"low": 0, "normal": 1, "high": 2}
+job_deadlines = {"low": 600, "normal": 60, "high": 5}
+job_priority_default = "normal"
+job_priority_control = "high"
+job_priority_new = "high"
+
+# When the configuration file references at least precompile_min_files rules
+# files not already compiled, they are parsed and validated in parallel by a
+# pool of precompile_workers processes before the ACLs are processed, the
+# results populating the compiled rules cache.  0 workers disables this.  The
+# pool is created by main() before the SDK is started, so the workers do not
+# inherit the agent's SDK connections, sockets and watches, and is terminated
+# when the agent is shut down.  The agent never forks the pool itself: without
+# one the files are compiled in the agent's own process instead.
+precompile_workers = 4
+precompile_min_files = 2
+precompile_poll_interval = 0.01
+
+# When batch_commit is set, all the changes made while processing the
+# configuration file are committed to HW together and interfaces are attached
+# or detached only once the HW has accepted them.  Should the HW reject the
+# batch, every ACL changed by it is restored to its previous state.  Otherwise
+# each ACL is committed, and applied to its interface, as it is processed.
+batch_commit = True
+
+# The replace-acl command builds the new rules in a separate ACL, alternately
+# named after the ACL with and without acl_replace_suffix, and only once the
+# HW has accepted it moves the ACL's interfaces over to it and deletes the old
+# ACL.  Traffic therefore sees either the complete old or the complete new
+# rules, never a mixture.
+acl_replace_suffix = "-ACLerate-shadow"
+
+# The interface attribute of a configuration entry may specify many interfaces,
+# e.g. Ethernet1-48 or Port-Channel10,20 (see interfaces_expand()): a name
+# followed by a list of interface numbers or ranges of them
+interface_spec = re.compile(r"^([A-Za-z][A-Za-z-]*?)(\d[\d/,-]*)$")
+# Only the last component of a modular interface number may be a range
+interface_number = re.compile(r"^((?:\d+/)*)(\d+)(?:-(\d+))?$")
+# An entry specifying more than interfaces_max interfaces is malformed
+interfaces_max = 4096
+
+# Estimated number of TCAM entries used by each rule of an ACL of each type.
+# IPv6 rules need a double width lookup key.  None of a rule's other fields
+# change the width of its entry, so every rule of an ACL costs the same.
+rule_tcam_width = {eossdk.ACL_TYPE_IPV4: 1,
+                   eossdk.ACL_TYPE_IPV6: 2,
+                   eossdk.ACL_TYPE_ETH: 1}
+
+# Before an ACL's rules are programmed, the TCAM entries it will use are
+# estimated: those of its rules plus the implicit deny, for each interface and
+# direction it is applied to, and as many counters again if counting is
+# enabled.  ACLs estimated to need more than tcam_entry_budget entries or
+# tcam_counter_budget counters are rejected without any changes being made.
+# TCAM sizes vary widely between platforms, so the check is disabled (None)
+# unless set to suit the platform.  While it is disabled, the rules are not
+# held in memory for the estimate: it is made from the rules once programmed.
+tcam_entry_budget = None
+tcam_counter_budget = None
+
+# The time spent in each phase of processing each ACL (waiting for the rules
+# file lock, parsing, validation, building SDK objects, SDK rule calls, commit,
+# HW programming and updating interfaces) is recorded.  Percentiles over the
+# most recent metrics_window samples of each are reported via the agent status
+# and written to metrics_file (unless None) after each commit completes.
+metrics_window = 1000
+metrics_file = '/var/tmp/ACLerate-metrics.json'
+
+# The packet and byte counters of every rule of the ACLs with counting enabled
+# are read every counters_interval secs (None disables this), returning to the
+# event loop every counters_chunk_size rules.  The SDK's ACL manager has no
+# call reading them, so the show command of counters_commands for the ACL's
+# type is run via the SDK's eAPI manager.  The changes
+# since the previous export, for only the rules whose counters changed, are
+# appended as a line of JSON to counters_file (unless None), at most every
+# counters_export_interval secs.  counters_file is renamed to counters_file.1
+# once it reaches counters_file_max bytes.
+counters_interval = 10
+counters_chunk_size = 5000
+counters_export_interval = 10
+counters_file = '/var/tmp/ACLerate-counters.jsonl'
+counters_file_max = 64 * 1024 * 1024
+counters_commands = {eossdk.ACL_TYPE_IPV4: "show ip access-lists %s",
+                     eossdk.ACL_TYPE_IPV6: "show ipv6 access-lists %s",
+                     eossdk.ACL_TYPE_ETH: "show mac access-lists %s"}
+acl_type_names = {eossdk.ACL_TYPE_IPV4: "IPv4",
+                  eossdk.ACL_TYPE_IPV6: "IPv6",
+                  eossdk.ACL_TYPE_ETH: "MAC"}
+
+# Sending ACLerate SIGUSR1 (e.g. "kill -USR1 <pid>") profiles the next
+# profile_jobs jobs (see job_add()).  While a job being profiled runs, it is
+# profiled by cProfile and its stack is also sampled every
+# profile_sample_interval secs of CPU time.  For each job, the profile (for
+# pstats), a summary of the functions taking the most time and the sampled
+# stacks, collapsed as for flame graphs, are written to profile_dir.  None
+# disables profiling.  Jobs not being profiled are not slowed down.
+profile_dir = '/var/tmp/ACLerate-profile'
+profile_jobs = 1
+profile_sample_interval = 0.001
+profile_summary_lines = 40
+
+# When the agent starts, the ACLs already on the switch are read so that only
+# the differences between them and the configuration need be programmed.  The
+# state last programmed (each ACL's rules and the rules files they came from,
+# counters, interfaces and the fingerprints of the configuration entries) is
+# saved to snapshot_file, at most every snapshot_interval secs, so that if the
+# ACLs found at startup match the snapshot, unchanged configuration entries
+# need not be processed at all.  Only the ACLs ACLerate has programmed are
+# saved, and the snapshot is written snapshot_chunk_size rules at a time,
+# returning to the event loop in between, so large ACLs do not hold up other
+# work.  None disables the snapshot.
+snapshot_file = '/mnt/flash/.ACLerate-snapshot.json'
+snapshot_interval = 60
+snapshot_chunk_size = 10000
+snapshot_magic = "ACLerate-snapshot"
+snapshot_version = 1
+
+# Besides the configuration file, commands (with their rules given inline) may
+# be sent to ACLerate over the Unix domain socket control_socket, avoiding the
+# file system altogether.  None disables the socket.  Each request and reply
+# is framed as a 4 byte length, in network byte order, followed by that many
+# bytes of JSON.  Requests longer than control_message_max bytes are refused.
+control_socket = '/var/run/ACLerate.sock'
+control_message_max = 16 * 1024 * 1024
+control_read_size = 65536
+control_frame = struct.Struct("!I")
+
+# Rules description files may alternatively use a compact binary format (see
+# utilities/rules-json-to-binary.py), recognised by the magic at the start of
+# the file.  The file is a header followed by fixed size rule records:
+#   header: magic, version, record size, record count, CRC32 of the records
+#   record: number, protocol (0 if none), address family (4 or 6),
+#           source & destination prefix lengths, flags, source & destination
+#           addresses (16 bytes each, IPv4 addresses in the first 4)
+rules_binary_magic = "ACLR"
+rules_binary_version = 1
+rules_binary_header = struct.Struct("<4sHHII")
+rules_binary_record = struct.Struct("<IHBBBB2x16s16s")
+rules_binary_permit = 0x01
+rules_binary_log_set = 0x02
+rules_binary_log = 0x04
+rules_binary_source = 0x08
+rules_binary_destination = 0x10
+
+# Not exhaustive list.  Update?
+protocols_ip = {"ICMP": 1,
+                "IGMP": 2,
+                "IP": 4,
+                "TCP": 6,
+                "UDP": 17,
+                "GRE": 47,
+                "ESP": 50,
+                "OSPF": 89,
+                "PIM": 103,
+                "VRRP": 112}
+
+protocols_eth = {"ARP": 0x806,
+                 "IPV4": 0x800,
+                 "IPV6": 0x86DD,
+                 "LLDP": 0x88CC}
+
+# Normalised prefix (or "" if invalid) of each address string seen, and the
+# SDK address object of each normalised prefix.  See prefix_cache_max.
+prefix_table = {}
+prefix_addr_masks = {}
+
 def rule_validate(number, source, destination, action):
     """Validate the info supplied for a rule.  Specifically, a source or destination
     must be present.  Also, there must be an action and it can be only either
@@ -68,7 +306,7 @@ def acl_validate(command, name, acl_type, direction, counting):
         sys.stderr.write("An command must be specified\n")
         return False
 
-    valid_commands = ["add-rule", "delete-rule", "delete-acl"]
+    valid_commands = ["add-rule", "delete-rule", "delete-acl", "replace-acl"]
     if not (command.lower() in valid_commands): 
           sys.stderr.write("'%s' is not a valid command\n" % command)
           return False
@@ -90,23 +328,6 @@ def protocol_validate(protocol, acl_type):
     """Validate supplied protocol for IP or Ethernet and supply corresponding
     protocol number or Ethertype"""
 
-    # Not exhaustive list.  Update?
-    protocols_ip = {"ICMP": 1,
-                    "IGMP": 2,
-                    "IP": 4,
-                    "TCP": 6,
-                    "UDP": 17,
-                    "GRE": 47,
-                    "ESP": 50,
-                    "OSPF": 89,
-                    "PIM": 103,
-                    "VRRP": 112}
-
-    protocols_eth = {"ARP": 0x806,
-                     "IPV4": 0x800,
-                     "IPV6": 0x86DD,
-                     "LLDP": 0x88CC}
-                     
     if acl_type is eossdk.ACL_TYPE_IPV4 or acl_type is eossdk.ACL_TYPE_IPV6:
         protocol_number = protocols_ip.get(protocol.upper())
         if protocol_number:
@@ -152,12 +373,1247 @@ def direction_convert(direction):
 
     return None
 
+def interfaces_expand(interface):
+    """Expand the interface attribute of a configuration entry into the names
+    of the interfaces it specifies, in order and without duplicates.  It may be
+    a single interface name or a list of them, and each name may give ranges
+    and lists of interface numbers, e.g. Ethernet1-48, Port-Channel10,20 or
+    Ethernet3/1-4.  Leading zeros are dropped from interface numbers, as EOS
+    names interfaces without them.  Returns None if it is malformed or
+    specifies more than interfaces_max interfaces, counting repeats."""
+
+    if isinstance(interface, basestring):
+        interface = [interface]
+    if not isinstance(interface, list):
+        return None
+
+    names = []
+    for spec in interface:
+        if not isinstance(spec, basestring):
+            return None
+        match = interface_spec.match(spec.strip())
+        if match is None:
+            if len(names) >= interfaces_max:
+                return None
+            names.append(spec)
+            continue
+        base, numbers = match.groups()
+        for number in numbers.split(","):
+            match = interface_number.match(number)
+            if match is None:
+                return None
+            module, first, last = match.groups()
+            module = "".join("%d/" % int(part) for part in module.split("/")[:-1])
+            if last is None:
+                if len(names) >= interfaces_max:
+                    return None
+                names.append("%s%s%d" % (base, module, int(first)))
+                continue
+            if int(last) < int(first) or len(names) + int(last) - int(first) >= interfaces_max:
+                return None
+            names.extend("%s%s%s" % (base, module, port)
+                          for port in xrange(int(first), int(last) + 1))
+
+    expanded = []
+    seen = set()
+    for name in names:
+        if name not in seen:
+            seen.add(name)
+            expanded.append(name)
+    return expanded
+
+def config_dir_member(path):
+    """Is the absolute path that of a configuration file in
+    ACLerate_config_dir?  Hidden files, e.g. editors' temporary files, are
+    not."""
+
+    if not ACLerate_config_dir:
+        return False
+    name = os.path.basename(path)
+    return (os.path.dirname(path) == os.path.abspath(ACLerate_config_dir) and
+            name.endswith(".json") and not name.startswith("."))
+
+def config_dir_files():
+    """Return the absolute paths of the configuration files currently in
+    ACLerate_config_dir, sorted"""
+
+    if not ACLerate_config_dir:
+        return []
+    try:
+        names = os.listdir(ACLerate_config_dir)
+    except OSError:
+        return []
+    paths = [os.path.join(os.path.abspath(ACLerate_config_dir), name)
+             for name in sorted(names)]
+    return [path for path in paths if config_dir_member(path)]
+
+def file_lock(locked_file, path, attempt):
+    """Make a single, non-blocking attempt to acquire the exclusive lock on the
+    open file.  Returns True if the lock was acquired."""
+
+    try:
+        fcntl.flock(locked_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except IOError:
+        sys.stderr.write("Attempt %s to lock %s "
+                         "failed\n" % (str(attempt+1), path))
+        return False
+
+def rules_iterate(rule_listing_file):
+    """Generator yielding the elements of the JSON array in rule_listing_file one
+    at a time.  The file is read in rules_read_size chunks and each element is
+    decoded as soon as it is complete, so neither the file contents nor the full
+    list of rules is ever held in memory.  Raises ValueError if the file does
+    not contain a valid JSON array, or anything other than whitespace follows
+    it."""
+
+    decoder = json.JSONDecoder()
+    whitespace = " \t\n\r"
+    buf = ""
+    # Offset in the file of the start of buf
+    base = 0
+    pos = 0
+    eof = False
+    started = False
+    closed = False
+    separated = True
+    elements = 0
+
+    while True:
+        # Skip whitespace and the array punctuation between elements
+        while pos < len(buf) and buf[pos] in whitespace:
+            pos += 1
+        if closed:
+            if pos < len(buf):
+                raise ValueError("Unexpected data after rules at offset %s" % (base + pos))
+            if eof:
+                return
+        elif pos < len(buf):
+            char = buf[pos]
+            if not started:
+                if char != "[":
+                    raise ValueError("Rules description must be a JSON array")
+                started = True
+                pos += 1
+                continue
+            if char == "]":
+                if separated and elements:
+                    raise ValueError("Unexpected ']' at offset %s" % (base + pos))
+                # Only whitespace may follow, which is checked up to the end
+                # of the file
+                closed = True
+                pos += 1
+                continue
+            if char == "," and not separated:
+                separated = True
+                pos += 1
+                continue
+            if not separated:
+                raise ValueError("Expected ',' between rules at offset %s" % (base + pos))
+
+            # Attempt to decode the next element.  If it runs off the end of
+            # what has been read so far, read more and try again.
+            try:
+                rule, end = decoder.raw_decode(buf, pos)
+            except ValueError:
+                if eof:
+                    raise
+            else:
+                # A number is only complete once followed by a delimiter, as
+                # e.g. "1" of "1.5" or "1e3" decodes on its own
+                if eof or (end < len(buf) and
+                           (type(rule) not in (int, long, float) or
+                            buf[end] in whitespace + ",]")):
+                    pos = end
+                    separated = False
+                    elements += 1
+                    yield rule
+                    continue
+
+        if eof:
+            raise ValueError("Unexpected end of rules description file")
+
+        # Discard what has already been consumed before reading more
+        buf = buf[pos:]
+        base += pos
+        pos = 0
+        chunk = rule_listing_file.read(rules_read_size)
+        if chunk:
+            buf += chunk
+        else:
+            eof = True
+
+def prefix_format(family, packed, length):
+    """Return the normalised "address/length" string for a packed address,
+    with any host bits beyond the prefix length cleared"""
+
+    if length < len(packed) * 8:
+        address = bytearray(packed)
+        full, bits = divmod(length, 8)
+        if bits:
+            address[full] &= (0xff << (8 - bits)) & 0xff
+            full += 1
+        address[full:] = bytearray(len(address) - full)
+        packed = str(address)
+    return "%s/%s" % (socket.inet_ntop(family, packed), length)
+
+def prefix_normalise(address, sdk_type):
+    """Parse an IPv4 or IPv6 host address or prefix string.  Returns the
+    normalised prefix, or None if the address is invalid or of the wrong
+    family for an IP ACL of type sdk_type."""
+
+    if address == "any":
+        if sdk_type == eossdk.ACL_TYPE_IPV6:
+            return "::/0"
+        return "0.0.0.0/0"
+
+    try:
+        address, separator, length = str(address).partition("/")
+        if ":" in address:
+            if sdk_type == eossdk.ACL_TYPE_IPV4:
+                return None
+            family, max_length = socket.AF_INET6, 128
+        else:
+            if sdk_type == eossdk.ACL_TYPE_IPV6:
+                return None
+            family, max_length = socket.AF_INET, 32
+        packed = socket.inet_pton(family, address)
+        if separator:
+            length = int(length)
+        else:
+            length = max_length
+    except (socket.error, ValueError, UnicodeError):
+        return None
+    if not 0 <= length <= max_length:
+        return None
+    if length == 32 and family == socket.AF_INET:
+        # inet_pton() only accepts IPv4 addresses in their normal form
+        return "%s/32" % address
+    return prefix_format(family, packed, length)
+
+def prefix_lookup(address, sdk_type):
+    """Memoised prefix_normalise()"""
+
+    key = (address, sdk_type)
+    prefix = prefix_table.get(key)
+    if prefix is None:
+        prefix = prefix_normalise(address, sdk_type) or ""
+        if len(prefix_table) >= prefix_cache_max:
+            prefix_table.clear()
+        prefix_table[key] = prefix
+    return prefix or None
+
+def prefix_addr_mask(prefix):
+    """Return the shared SDK address object for a normalised prefix"""
+
+    addr_mask = prefix_addr_masks.get(prefix)
+    if addr_mask is None:
+        address, _, length = prefix.partition("/")
+        addr_mask = eossdk.IpAddrMask(eossdk.IpAddr(address), int(length))
+        if len(prefix_addr_masks) >= prefix_cache_max:
+            prefix_addr_masks.clear()
+        prefix_addr_masks[prefix] = addr_mask
+    return addr_mask
+
+def rule_compile(rule, sdk_type):
+    """Validate the rule data and reduce it to a compact, comparable description
+    of the rule, i.e. a (source, destination, protocol, action, log) tuple.
+    This description is what is remembered for each programmed rule so that
+    subsequent updates can determine whether a rule has actually changed.
+    Returns None if the rule data is invalid."""
+
+    source = rule.get("source")
+    destination = rule.get("destination")
+    protocol = rule.get("protocol")
+    action = rule.get("action")
+    log = rule.get("log")
+
+    if rule_validate(rule.get("number"), source, destination, action) == False:
+        syslog.syslog("Invalid rule input data")
+        sys.stderr.write("Invalid rule input data\n")
+        return None
+
+    if source:
+        source = prefix_lookup(source, sdk_type)
+        if source is None:
+            syslog.syslog("Error processing source address %s" % rule.get("source"))
+            sys.stderr.write("Error processing source address %s\n" % rule.get("source"))
+            return None
+    if destination:
+        destination = prefix_lookup(destination, sdk_type)
+        if destination is None:
+            syslog.syslog("Error processing destination address %s" % rule.get("destination"))
+            sys.stderr.write("Error processing destination address %s\n" %
+                             rule.get("destination"))
+            return None
+
+    protocol_number = None
+    if protocol:
+        protocol_number = protocol_validate(protocol, sdk_type)
+        if not protocol_number:
+            syslog.syslog("Error processing protocol %s" % protocol)
+            sys.stderr.write("Error processing protocol %s\n" % protocol)
+            return None
+
+    if log:
+        try:
+            log = log.lower() == "true"
+        except AttributeError:
+            syslog.syslog("Error processing log %s" % log)
+            sys.stderr.write("Error processing log %s\n" % log)
+            return None
+    else:
+        log = None
+
+    # A prefix of length 0 matches any address, as does no address at all, and
+    # rules are not logged by default, so these are described the same way
+    if source and source.endswith("/0"):
+        source = None
+    if destination and destination.endswith("/0"):
+        destination = None
+    return (source or None, destination or None, protocol_number, action.lower(), log or None)
+
+def rule_build(rule_sig):
+    """Create the EOS SDK IP ACL rule object for a rule previously compiled by
+    rule_compile().  Returns None if the SDK rejects any of the rule data."""
+
+    source, destination, protocol_number, action, log = rule_sig
+
+    # Create IP ACL rule object.  Used for IPv4 and IPv6 ACLs but
+    # different object needed for Ethernet ACLs.
+    # (Perhaps create object with all rule info and invoke
+    # functions to process for ACL, IPv4, IPv6 etc?
+    # Needs more thought on optimal way to handle different ACL type)
+    acl_rule = eossdk.AclRuleIp()
+
+    # Addresses were normalised by rule_compile() so the SDK address
+    # objects can be shared between rules.
+    if source:
+        try:
+            acl_rule.source_addr_is(prefix_addr_mask(source))
+        except eossdk.Error:
+            syslog.syslog("Error processing source address %s" % source)
+            sys.stderr.write("Error processing source address %s\n" % source)
+            return None
+
+    if destination:
+        try:
+            acl_rule.destination_addr_is(prefix_addr_mask(destination))
+        except eossdk.Error:
+            syslog.syslog("Error processing destination address %s" % destination)
+            sys.stderr.write("Error processing destination address %s\n" % destination)
+            return None
+
+    if protocol_number:
+        acl_rule.ip_protocol_is(protocol_number)
+
+    # Previously verified that action is 'permit' or 'deny'
+    if action == "permit":
+        acl_rule.action_is(eossdk.ACL_PERMIT)
+    else:
+        acl_rule.action_is(eossdk.ACL_DENY)
+
+    if log:
+        acl_rule.log_is(log)
+
+    return acl_rule
+
+def rules_compile(rules, command, sdk_type, timer):
+    """Generator compiling the rules yielded by rules (e.g. by rules_iterate()) for
+    an ACL of type sdk_type and yielding a (number, rule_sig) pair for each.  When
+    rules are being deleted only the number is needed so rule_sig is None;
+    rule_sig is also None if the rule data is invalid.  Time spent parsing and
+    validating the rules is accumulated in timer."""
+
+    rules = iter(rules)
+    while True:
+        parse_start = time.time()
+        try:
+            rule = next(rules)
+        except StopIteration:
+            timer.add("parse", time.time() - parse_start)
+            return
+        validate_start = time.time()
+        timer.add("parse", validate_start - parse_start)
+
+        number = rule.get("number")
+
+        # Rule must have a sequence number.
+        if number is None:
+            syslog.syslog("Rule must have a number")
+            sys.stderr.write("Rule must have a number\n")
+            continue
+
+        if command.lower() == "delete-rule":
+            rule_sig = None
+        else:
+            rule_sig = rule_compile(rule, sdk_type)
+        timer.add("validate", time.time() - validate_start)
+        yield int(number), rule_sig
+
+def rules_file_binary(rule_listing_file):
+    """Is the open rules file in the binary format rather than JSON?"""
+
+    magic = rule_listing_file.read(len(rules_binary_magic))
+    rule_listing_file.seek(0)
+    return magic == rules_binary_magic
+
+def rules_binary_iterate(rule_listing_file, command, sdk_type, timer):
+    """Generator yielding a (number, rule_sig) pair, as for rules_compile(), for
+    each record of a binary rules file.  The file is memory-mapped and the
+    records decoded in place, so it is never copied or parsed as a whole.
+    Raises ValueError if the header is invalid or the checksum is wrong."""
+
+    parse_start = time.time()
+    size = os.fstat(rule_listing_file.fileno()).st_size
+    if size < rules_binary_header.size:
+        raise ValueError("Truncated binary rules header")
+    rules_map = mmap.mmap(rule_listing_file.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        magic, version, record_size, count, checksum = \
+            rules_binary_header.unpack_from(rules_map, 0)
+        if version != rules_binary_version or record_size != rules_binary_record.size:
+            raise ValueError("Unsupported binary rules version %s" % version)
+        if size != rules_binary_header.size + count * record_size:
+            raise ValueError("Binary rules file size does not match record count")
+        records = buffer(rules_map, rules_binary_header.size)
+        if zlib.crc32(records) & 0xffffffff != checksum:
+            raise ValueError("Binary rules checksum mismatch")
+        del records
+        timer.add("parse", time.time() - parse_start)
+
+        if sdk_type == eossdk.ACL_TYPE_ETH:
+            protocols = set(protocols_eth.itervalues())
+        else:
+            protocols = set(protocols_ip.itervalues())
+        deleting = command.lower() == "delete-rule"
+        unpack_from = rules_binary_record.unpack_from
+        for offset in xrange(rules_binary_header.size, size, record_size):
+            validate_start = time.time()
+            (number, protocol, family, source_length, destination_length, flags,
+             source, destination) = unpack_from(rules_map, offset)
+
+            rule_sig = None
+            if not deleting:
+                rule_sig = rule_binary_decode(number, protocol, family, source_length,
+                                              destination_length, flags, source,
+                                              destination, protocols, sdk_type)
+            timer.add("validate", time.time() - validate_start)
+            yield number, rule_sig
+    finally:
+        rules_map.close()
+
+def rule_binary_decode(number, protocol, family, source_length, destination_length,
+                       flags, source, destination, protocols, sdk_type):
+    """Convert the fields of a binary rule record to the rule description
+    produced by rule_compile() for the equivalent JSON rule.  Returns None if
+    the record is invalid, or of the wrong family for an IP ACL of type
+    sdk_type."""
+
+    if ((family == 4 and sdk_type == eossdk.ACL_TYPE_IPV6) or
+        (family == 6 and sdk_type == eossdk.ACL_TYPE_IPV4)):
+        sys.stderr.write("Rule %s has address family %s, not that of the "
+                         "ACL\n" % (number, family))
+        return None
+    if family == 4:
+        address_family, address_length, max_length = socket.AF_INET, 4, 32
+    elif family == 6:
+        address_family, address_length, max_length = socket.AF_INET6, 16, 128
+    else:
+        sys.stderr.write("Rule %s has invalid address family %s\n" % (number, family))
+        return None
+
+    prefixes = []
+    for present, address, length in ((flags & rules_binary_source, source, source_length),
+                                     (flags & rules_binary_destination, destination,
+                                      destination_length)):
+        if not present:
+            prefixes.append(None)
+            continue
+        if length > max_length:
+            sys.stderr.write("Rule %s has invalid prefix length %s\n" % (number, length))
+            return None
+        prefixes.append(prefix_format(address_family, address[:address_length], length))
+
+    if prefixes == [None, None]:
+        sys.stderr.write("Either source or destination essential for rule\n")
+        return None
+    prefixes = [prefix if length else None
+                for prefix, length in zip(prefixes, (source_length, destination_length))]
+
+    if protocol and protocol not in protocols:
+        sys.stderr.write("Rule %s has unsupported protocol %s\n" % (number, protocol))
+        return None
+
+    if flags & rules_binary_permit:
+        action = "permit"
+    else:
+        action = "deny"
+
+    log = None
+    if flags & rules_binary_log_set and flags & rules_binary_log:
+        log = True
+
+    return (prefixes[0], prefixes[1], protocol or None, action, log)
+
+def rules_file_identity(rules_file, stat):
+    """Identify the current contents of the rules file, given the result of
+    stat()ing it, by its path, inode, modification time and size.  Any rewrite
+    of the file changes its identity."""
+
+    return (rules_file, stat.st_dev, stat.st_ino, stat.st_mtime, stat.st_size)
+
+def prefix_read(addr_mask, sdk_type):
+    """Return the normalised prefix, as used in compiled rules, of an SDK
+    address read from a rule on the switch"""
+
+    if addr_mask is None or addr_mask.mask_length() == 0:
+        return None
+    return prefix_lookup("%s/%s" % (addr_mask.addr().to_string(), addr_mask.mask_length()),
+                         sdk_type)
+
+def rule_sig_read(acl_rule, sdk_type):
+    """Return the compiled description, as produced by rule_compile(), of an SDK
+    rule read from an ACL on the switch"""
+
+    if acl_rule.action() == eossdk.ACL_PERMIT:
+        action = "permit"
+    else:
+        action = "deny"
+    return (prefix_read(acl_rule.source_addr(), sdk_type),
+            prefix_read(acl_rule.destination_addr(), sdk_type),
+            acl_rule.ip_protocol() or None, action, acl_rule.log() or None)
+
+def snapshot_load():
+    """Read the snapshot of the state last programmed, returning it or None if
+    there is no snapshot or it is corrupt.  The snapshot is a header line of
+    magic, version and CRC32 of the rest of the file, which is JSON."""
+
+    try:
+        with open(snapshot_file) as f:
+            header = f.readline().split()
+            body = f.read()
+    except IOError:
+        syslog.syslog("No snapshot %s" % snapshot_file)
+        return None
+    try:
+        magic, version, checksum = header
+        if magic != snapshot_magic or int(version) != snapshot_version:
+            raise ValueError("unsupported version")
+        if zlib.crc32(body) & 0xffffffff != int(checksum):
+            raise ValueError("checksum mismatch")
+        return json.loads(body)
+    except ValueError as e:
+        syslog.syslog("Ignoring snapshot %s: %s" % (snapshot_file, e))
+        sys.stderr.write("Ignoring snapshot %s: %s\n" % (snapshot_file, e))
+        return None
+
+def config_acl_group(acl_config):
+    """Identify the ACL a configuration file entry is for, for the purpose of
+    fingerprinting (see config_fingerprint())."""
+
+    return json.dumps([acl_config.get("name"), acl_config.get("type")]).lower()
+
+def config_fingerprint(acl_config):
+    """Fingerprint a configuration file entry together with the current state
+    of the rules file it references.  An entry whose fingerprint is unchanged
+    since it was last successfully processed need not be processed again."""
+
+    rules_file = acl_config.get("rules")
+    identity = None
+    if isinstance(rules_file, basestring):
+        try:
+            identity = rules_file_identity(rules_file, os.stat(rules_file))
+        except OSError:
+            pass
+    return (json.dumps(acl_config, sort_keys=True), identity)
+
+def entry_schedule(acl_config, default):
+    """Return the priority (a value of job_priorities) and deadline (secs) of
+    the configuration entry acl_config.  Where these are not given, or are
+    invalid, those of the priority default are used."""
+
+    priority = acl_config.get("priority", default)
+    if not isinstance(priority, basestring) or priority.lower() not in job_priorities:
+        syslog.syslog("Priority must be one of %s, i.e. not '%s'" %
+                      (", ".join(sorted(job_priorities)), priority))
+        sys.stderr.write("Priority must be one of %s, i.e. not '%s'\n" %
+                         (", ".join(sorted(job_priorities)), priority))
+        priority = default
+    priority = priority.lower()
+
+    deadline = acl_config.get("deadline", job_deadlines[priority])
+    if (isinstance(deadline, bool) or not isinstance(deadline, (int, long, float)) or
+        deadline < 0):
+        syslog.syslog("Deadline must be a number of secs, i.e. not '%s'" % deadline)
+        sys.stderr.write("Deadline must be a number of secs, i.e. not '%s'\n" % deadline)
+        deadline = job_deadlines[priority]
+    return job_priorities[priority], deadline
+
+def counters_reader(sdk):
+    """Return a function returning an iterator over the counters of each rule of
+    an ACL, as (number, packets, bytes) tuples, read from the JSON output of
+    the ACL's show command (see counters_commands) run via the SDK's eAPI
+    manager.  Rules with no counters, and counts not reported (EOS may only
+    count packets), are read as 0.  The function raises ValueError if the
+    command fails.  Returns None if the SDK cannot run show commands."""
+
+    get_eapi_mgr = getattr(sdk, "get_eapi_mgr", None)
+    if get_eapi_mgr is None:
+        return None
+    eapi_mgr = get_eapi_mgr()
+
+    def counters_read(acl_key):
+        command = counters_commands.get(acl_key.acl_type())
+        if command is None:
+            return
+        response = eapi_mgr.run_show_cmd(command % acl_key.acl_name())
+        if not response.success():
+            raise ValueError(response.error_message())
+        for acl in json.loads(response.responses()[0]).get("aclList", []):
+            if acl.get("name") != acl_key.acl_name():
+                continue
+            for rule in acl.get("sequence", []):
+                counter_data = rule.get("counterData", {})
+                yield (rule["sequenceNumber"], counter_data.get("packetCount", 0),
+                       counter_data.get("byteCount", 0))
+    return counters_read
+
+def rules_file_precompile(rules_file, sdk_type, command):
+    """Run in a precompile worker process, or the agent's own process if it
+    has no workers: compile the rules in rules_file as described for
+    rules_compile(), returning the file's identity and the list of
+    (number, rule_sig) pairs.  Returns None if the file cannot be locked
+    immediately, is invalid or is too large to cache, in which case it is
+    simply processed by the agent itself as usual."""
+
+    try:
+        with open(rules_file) as rule_listing_file:
+            if not file_lock(rule_listing_file, rules_file, 0):
+                return None
+            identity = rules_file_identity(rules_file, os.fstat(rule_listing_file.fileno()))
+            timer = LatencyTimer(rules_file)
+            if rules_file_binary(rule_listing_file):
+                rules = rules_binary_iterate(rule_listing_file, command, sdk_type, timer)
+            else:
+                rules = rules_compile(rules_iterate(rule_listing_file), command,
+                                      sdk_type, timer)
+            compiled = []
+            for rule in rules:
+                compiled.append(rule)
+                if len(compiled) > rules_cache_max_rules:
+                    return None
+            return identity, compiled
+    except (IOError, ValueError):
+        return None
+
+def precompile_pool_create():
+    """Create the pool of processes precompiling rules files (see
+    rules_file_precompile()), or return None if precompiling is disabled"""
+
+    if precompile_workers <= 0:
+        return None
+    return multiprocessing.Pool(precompile_workers, precompile_worker_init)
+
+def precompile_worker_init():
+    """Run in each precompile worker as it starts.  Signals handled by the
+    agent, e.g. to start profiling, are ignored by the workers."""
+
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    signal.signal(signal.SIGPROF, signal.SIG_IGN)
+
+def acl_tcam_estimate(rule_count, sdk_type, counters, bindings):
+    """Estimate the TCAM usage of an ACL of rule_count valid rules, counters
+    enabled or not, applied to bindings interfaces and directions.
+    Returns (entries per binding, total entries, total counters)."""
+
+    per_binding = (rule_count + 1) * rule_tcam_width.get(sdk_type, 1)
+    entries = per_binding * bindings
+    if counters:
+        return per_binding, entries, (rule_count + 1) * bindings
+    return per_binding, entries, 0
+
+def prefix_node(prefix, memo):
+    """Return the node of a binary trie of prefixes corresponding to a
+    normalised prefix, i.e. (prefix length, address >> host bits).  None, i.e.
+    no address, is the root node, which matches any address."""
+
+    node = memo.get(prefix)
+    if node is None:
+        if prefix is None:
+            node = (0, 0)
+        else:
+            address, _, length = prefix.partition("/")
+            length = int(length)
+            if ":" in address:
+                family, max_length = socket.AF_INET6, 128
+            else:
+                family, max_length = socket.AF_INET, 32
+            value = int(socket.inet_pton(family, address).encode("hex"), 16)
+            node = (length, value >> (max_length - length))
+        memo[prefix] = node
+    return node
+
+def prefix_node_format(node, sdk_type):
+    """Return the normalised prefix corresponding to a trie node"""
+
+    length, value = node
+    if length == 0:
+        return None
+    if sdk_type == eossdk.ACL_TYPE_IPV6:
+        family, max_length = socket.AF_INET6, 128
+    else:
+        family, max_length = socket.AF_INET, 32
+    packed = ("%0*x" % (max_length // 4, value << (max_length - length))).decode("hex")
+    return prefix_format(family, packed, length)
+
+def rule_shadowed(source, destination, protocol, covering, lengths):
+    """Does an earlier rule, whose (source node, destination node, protocol) is
+    in covering, match every packet matched by a rule with the given source and
+    destination nodes and protocol?  The earlier rule's nodes must be ancestors
+    of the rule's so only the combinations of prefix lengths in lengths, those
+    of the earlier rules, need be looked up."""
+
+    source_length, source_value = source
+    destination_length, destination_value = destination
+    for covering_source, covering_destination in lengths:
+        if covering_source > source_length or covering_destination > destination_length:
+            continue
+        key = ((covering_source, source_value >> (source_length - covering_source)),
+               (covering_destination,
+                destination_value >> (destination_length - covering_destination)))
+        if key + (None,) in covering:
+            return True
+        if protocol is not None and key + (protocol,) in covering:
+            return True
+    return False
+
+def rules_merge(earlier, later):
+    """Merge two rules, given as (number, source node, destination node,
+    protocol, action, log, source, destination), which are identical except
+    that one of their source or destination prefixes are siblings, into a
+    single rule for the parent prefix.  Returns None if they cannot be
+    merged."""
+
+    if earlier[3:6] != later[3:6]:
+        return None
+    if earlier[1] == later[1]:
+        sibling = 2
+    elif earlier[2] == later[2]:
+        sibling = 1
+    else:
+        return None
+    (length, value), (later_length, later_value) = earlier[sibling], later[sibling]
+    if length != later_length or length == 0 or value ^ later_value != 1:
+        return None
+    # The merged prefix is formatted only once merging is complete
+    merged = list(earlier)
+    merged[sibling] = (length - 1, value >> 1)
+    merged[sibling + 5] = False
+    return tuple(merged)
+
+def rules_optimize(rules, sdk_type, barriers):
+    """Return a list of (number, rule_sig) pairs equivalent to, but usually
+    smaller than, the (number, rule_sig) pairs rules, in number order, together
+    with the number of rules and TCAM entries saved.  Rules which can never
+    match, because earlier rules match all their packets, are dropped, and
+    adjacent rules which differ only in sibling source or destination prefixes
+    are repeatedly merged into a single rule, numbered as the first of them.
+    Rules are never merged across a number in the sorted list barriers (e.g.
+    rules of the ACL from other files) or across invalid rules."""
+
+    ordered = {}
+    for number, rule_sig in rules:
+        ordered[number] = rule_sig
+    numbers = sorted(ordered)
+    barriers = sorted(barriers + [number for number in numbers if ordered[number] is None])
+
+    memo = {}
+    covering = set()
+    lengths = set()
+    kept = []
+    for number in numbers:
+        rule_sig = ordered[number]
+        if rule_sig is None:
+            continue
+        source, destination, protocol, action, log = rule_sig
+        source_node = prefix_node(source, memo)
+        destination_node = prefix_node(destination, memo)
+        if rule_shadowed(source_node, destination_node, protocol, covering, lengths):
+            continue
+
+        rule = (number, source_node, destination_node, protocol, action, log,
+                source, destination)
+        while kept:
+            earlier = kept[-1]
+            index = bisect.bisect_right(barriers, earlier[0])
+            if index < len(barriers) and barriers[index] < number:
+                break
+            merged = rules_merge(earlier, rule)
+            if merged is None:
+                break
+            kept.pop()
+            rule = merged
+        kept.append(rule)
+        covering.add(rule[1:4])
+        lengths.add((rule[1][0], rule[2][0]))
+
+    optimized = [(number, None) for number in numbers if ordered[number] is None]
+    for number, source_node, destination_node, protocol, action, log, source, destination in kept:
+        if source is False:
+            source = prefix_node_format(source_node, sdk_type)
+        if destination is False:
+            destination = prefix_node_format(destination_node, sdk_type)
+        if ordered[number][:2] == (source, destination):
+            optimized.append((number, ordered[number]))
+        else:
+            optimized.append((number, (source, destination, protocol, action, log)))
+    optimized.sort()
+
+    saved_rules = len(numbers) - len(optimized)
+    saved_entries = saved_rules * rule_tcam_width.get(sdk_type, 1)
+    return optimized, saved_rules, saved_entries
+
+class CompiledRules(object):
+   """The compiled rules from one version of a rules file, for a given ACL type
+   and command."""
+
+   def __init__(self, identity, sdk_type, command):
+      self.key = (identity, sdk_type, command.lower())
+      self.rules = []
+      self.complete = False
+      self.cacheable = True
+
+   def collect(self, rules):
+      """Generator passing through the (number, rule_sig) pairs from rules while
+      keeping a copy of them.  If the file proves too large to cache the copy is
+      discarded so memory use remains flat."""
+
+      for rule in rules:
+          if self.cacheable:
+              self.rules.append(rule)
+              if len(self.rules) > rules_cache_max_rules:
+                  self.cacheable = False
+                  self.rules = []
+          yield rule
+      self.complete = True
+
+class RulesCache(object):
+   """Bounded, least recently used cache of CompiledRules."""
+
+   def __init__(self):
+      self.entries = collections.OrderedDict()
+      self.rule_total = 0
+
+   def get(self, identity, sdk_type, command):
+      if identity is None:
+          return None
+      key = (identity, sdk_type, command.lower())
+      compiled = self.entries.pop(key, None)
+      if compiled is not None:
+          self.entries[key] = compiled
+      return compiled
+
+   def add(self, compiled):
+      """Cache compiled provided it covers the whole file and is small enough,
+      then evict the least recently used entries until within bounds."""
+
+      if not compiled.complete or not compiled.cacheable:
+          return
+
+      # Entries for previous versions of the same file are of no further use
+      identity = compiled.key[0]
+      for key in self.entries.keys():
+          if key[0][0] == identity[0] and (key[0] != identity or key == compiled.key):
+              self.rule_total -= len(self.entries.pop(key).rules)
+
+      self.entries[compiled.key] = compiled
+      self.rule_total += len(compiled.rules)
+
+      while (len(self.entries) > rules_cache_max_files or
+             self.rule_total > rules_cache_max_rules):
+          evicted = self.entries.popitem(last=False)[1]
+          self.rule_total -= len(evicted.rules)
+
+   def discard(self, rules_file):
+      """Evict all entries for the rules file, which has been rewritten"""
+
+      for key in self.entries.keys():
+          if os.path.abspath(key[0][0]) == rules_file:
+              self.rule_total -= len(self.entries.pop(key).rules)
+
+class LatencyTimer(object):
+   """Time spent in each phase of processing a single ACL (or, for the phases
+   concerning the configuration file itself, a configuration pass)."""
+
+   def __init__(self, name):
+      self.name = name
+      self.start = time.time()
+      self.phases = collections.OrderedDict()
+      self.committed = None
+      self.failed = False
+
+   def add(self, phase, duration):
+      self.phases[phase] = self.phases.get(phase, 0.0) + duration
+
+def percentile(ordered, fraction):
+    """Return the value at the given fraction (0-1) of the sorted list"""
+
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+class LatencyMetrics(object):
+   """Rolling record of the most recent metrics_window durations of each phase,
+   from which p50/p95/p99 latencies are reported via the agent's status and
+   the metrics_file."""
+
+   def __init__(self):
+      self.samples = collections.OrderedDict()
+      self.last = []
+      self.completed = 0
+
+   def record(self, timers):
+      """Add the phase durations of the completed timers to the histograms"""
+
+      for timer in timers:
+          for phase, duration in timer.phases.iteritems():
+              if phase not in self.samples:
+                  self.samples[phase] = collections.deque(maxlen=metrics_window)
+              self.samples[phase].append(duration)
+      self.last = timers
+      self.completed += 1
+
+   def summary(self):
+      summary = collections.OrderedDict()
+      for phase, samples in self.samples.iteritems():
+          ordered = sorted(samples)
+          summary[phase] = collections.OrderedDict([
+              ("count", len(ordered)),
+              ("p50", percentile(ordered, 0.50)),
+              ("p95", percentile(ordered, 0.95)),
+              ("p99", percentile(ordered, 0.99)),
+              ("max", ordered[-1])])
+      return summary
+
+   def publish(self, agent_mgr):
+      """Report the latest histograms via agent status and the metrics file"""
+
+      summary = self.summary()
+      for phase, stats in summary.iteritems():
+          agent_mgr.status_set("Latency %s:" % phase,
+                               "p50 %.1fms p95 %.1fms p99 %.1fms "
+                               "(%s samples)" % (stats["p50"] * 1000, stats["p95"] * 1000,
+                                                 stats["p99"] * 1000, stats["count"]))
+
+      if not metrics_file:
+          return
+      metrics = collections.OrderedDict([
+          ("timestamp", time.time()),
+          ("completed", self.completed),
+          ("last", [collections.OrderedDict([("name", timer.name),
+                                             ("failed", timer.failed),
+                                             ("phases", timer.phases)])
+                    for timer in self.last]),
+          ("histograms", summary)])
+      try:
+          # Write then rename so readers never see a partial file
+          with open(metrics_file + ".tmp", "w") as f:
+              json.dump(metrics, f, indent=2)
+          os.rename(metrics_file + ".tmp", metrics_file)
+      except (IOError, OSError) as e:
+          syslog.syslog("Cannot write metrics file %s: %s" % (metrics_file, e))
+
+class RuleCounters(object):
+   """Counters of each rule of an ACL, in arrays indexed as the sorted array of
+   rule numbers: the values last read, the changes since last exported and
+   the indices of the rules which have changed.  Values read for the first
+   time are taken as the starting point rather than as changes."""
+
+   def __init__(self, numbers, previous=None):
+      count = len(numbers)
+      self.numbers = array.array("L", numbers)
+      self.packets = array.array("L", [0]) * count
+      self.bytes = array.array("L", [0]) * count
+      self.read = bytearray(count)
+      self.delta_packets = array.array("L", [0]) * count
+      self.delta_bytes = array.array("L", [0]) * count
+      self.changed = array.array("L")
+      if previous is None:
+          return
+
+      # The rules of the ACL have changed, so keep what is known of those
+      # which remain
+      for index, number in enumerate(previous.numbers):
+          new_index = bisect.bisect_left(self.numbers, number)
+          if new_index < count and self.numbers[new_index] == number:
+              self.packets[new_index] = previous.packets[index]
+              self.bytes[new_index] = previous.bytes[index]
+              self.read[new_index] = previous.read[index]
+              self.delta_packets[new_index] = previous.delta_packets[index]
+              self.delta_bytes[new_index] = previous.delta_bytes[index]
+              if previous.delta_packets[index] or previous.delta_bytes[index]:
+                  self.changed.append(new_index)
+
+   def update(self, number, packets, byte_count):
+      """Record the counters read for the rule number.  Returns True if they
+      have changed."""
+
+      index = bisect.bisect_left(self.numbers, number)
+      if index == len(self.numbers) or self.numbers[index] != number:
+          return False
+      last_packets = self.packets[index]
+      last_bytes = self.bytes[index]
+      self.packets[index] = packets
+      self.bytes[index] = byte_count
+      # The first values read, even if zero, are the starting point
+      if not self.read[index]:
+          self.read[index] = 1
+          return False
+      if packets == last_packets and byte_count == last_bytes:
+          return False
+
+      # Counters which have gone backwards have been reset
+      if packets < last_packets or byte_count < last_bytes:
+          last_packets = last_bytes = 0
+      if packets == last_packets and byte_count == last_bytes:
+          return False
+      if not self.delta_packets[index] and not self.delta_bytes[index]:
+          self.changed.append(index)
+      self.delta_packets[index] += packets - last_packets
+      self.delta_bytes[index] += byte_count - last_bytes
+      return True
+
+   def export(self):
+      """Return the changes since last exported, as [number, packets, bytes]
+      lists, and start afresh"""
+
+      changes = []
+      for index in sorted(self.changed):
+          changes.append([self.numbers[index], self.delta_packets[index],
+                          self.delta_bytes[index]])
+          self.delta_packets[index] = 0
+          self.delta_bytes[index] = 0
+      self.changed = array.array("L")
+      return changes
+
+class JobProfile(object):
+   """Profile of a job: cProfile's, and the stacks sampled on SIGPROF while
+   the job runs, counted by stack"""
+
+   def __init__(self):
+      self.profiler = cProfile.Profile()
+      self.stacks = collections.Counter()
+
+   def start(self):
+      signal.signal(signal.SIGPROF, self.sample)
+      # System calls interrupted by the sampling are restarted
+      signal.siginterrupt(signal.SIGPROF, False)
+      signal.setitimer(signal.ITIMER_PROF, profile_sample_interval, profile_sample_interval)
+      self.profiler.enable()
+
+   def stop(self):
+      self.profiler.disable()
+      signal.setitimer(signal.ITIMER_PROF, 0)
+      signal.signal(signal.SIGPROF, signal.SIG_IGN)
+
+   def sample(self, signum, frame):
+      stack = []
+      while frame is not None:
+          code = frame.f_code
+          stack.append("%s:%s" % (os.path.basename(code.co_filename), code.co_name))
+          frame = frame.f_back
+      self.stacks[";".join(reversed(stack))] += 1
+
+   def write(self, prefix):
+      """Write the profile to prefix.prof, a summary to prefix.txt and the
+      collapsed stacks to prefix.collapsed"""
+
+      self.profiler.dump_stats(prefix + ".prof")
+      with open(prefix + ".txt", "w") as f:
+          stats = pstats.Stats(self.profiler, stream=f)
+          stats.sort_stats("cumulative").print_stats(profile_summary_lines)
+          stats.sort_stats("time").print_stats(profile_summary_lines)
+      with open(prefix + ".collapsed", "w") as f:
+          for stack, count in sorted(self.stacks.iteritems()):
+              f.write("%s %s\n" % (stack, count))
+
+class CommitBatch(object):
+   """ACL changes made during a configuration pass and committed together.
+   acls maps each ACL changed to its state beforehand, as an (acl_key, existed,
+   rules, counters, bindings) tuple, and applies lists the interface updates
+   to be made once the HW has accepted the changes.  ACLs replaced are
+   deleted, as (acl_id, acl_key) pairs in retired, once their interfaces have
+   been moved to their replacements, and aliases maps each ACL whose
+   replacement changed the name of the ACL in HW to the name it had
+   beforehand."""
+
+   def __init__(self):
+      self.acls = collections.OrderedDict()
+      self.applies = []
+      self.retired = []
+      self.aliases = {}
+      self.timers = []
+      self.changed = False
+      self.rollback = False
+      # Fingerprints of the configuration file entries for each ACL processed,
+      # or None for ACLs whose entries were not all processed successfully
+      self.fingerprints = {}
+      # Control socket requests carried out, awaiting replies, and the
+      # configuration entries of these executed successfully (by id())
+      self.requests = []
+      self.executed = set()
+
+   def absorb(self, earlier):
+      """Take over an earlier batch which has been committed but not yet
+      confirmed by the HW.  Its record of each ACL's state predates ours."""
+
+      for acl_id, state in earlier.acls.iteritems():
+          self.acls[acl_id] = state
+      self.applies = earlier.applies + self.applies
+      self.retired = earlier.retired + self.retired
+      self.aliases.update(earlier.aliases)
+      self.requests = earlier.requests + self.requests
+      self.executed.update(earlier.executed)
+      fingerprints = dict(earlier.fingerprints)
+      fingerprints.update(self.fingerprints)
+      self.fingerprints = fingerprints
+
+class CallbackTimer(eossdk.TimeoutHandler):
+   """SDK timeout handler which simply invokes callback when it expires.  Used
+   to resume work from the SDK event loop."""
+
+   def __init__(self, timeout_mgr, callback):
+      eossdk.TimeoutHandler.__init__(self, timeout_mgr)
+      self.callback = callback
+
+   def on_timeout(self):
+      self.callback()
+
+class ConfigFile(object):
+   """A configuration file, as last parsed: the entries for the ACLs it owns
+   and the indices of the entries referencing each rules file (by absolute
+   path), so a change to a rules file need only reprocess the ACLs using it."""
+
+   def __init__(self, path):
+      self.path = path
+      self.entries = []
+      self.rules_dependents = {}
+
+class Job(object):
+   """Processing scheduled by the agent: the generator (e.g. config_pass())
+   carrying it out is resumed a step at a time, and may be preempted by more
+   urgent jobs between steps while it has no ACL changes awaiting commit.
+   With batch_commit set, that is only until it starts changing ACLs: from
+   then until its commit even a job past its deadline waits for it.  kind
+   and work identify what is processed, e.g. ("config", path of the
+   configuration file).  While the job runs, the ACLs it is changing are
+   reserved in acls so no other job changes them."""
+
+   def __init__(self, kind, work, generator, timer, priority, deadline, seq):
+      self.kind = kind
+      self.work = work
+      self.generator = generator
+      self.timer = timer
+      self.priority = priority
+      self.queued = time.time()
+      self.deadline = self.queued + deadline
+      self.seq = seq
+      self.started = None
+      # Time after which the job may be resumed, unless it is blocked
+      # waiting for ACLs reserved by another job
+      self.resume = self.queued
+      self.blocked = False
+      self.missed = False
+      self.acls = set()
+      # JobProfile if the job is being profiled
+      self.profile = None
+
+   def __str__(self):
+      if isinstance(self.work, basestring):
+          return "%s %s" % (self.kind, self.work)
+      return self.kind
+
+class ControlRequest(object):
+   """Request received on the control socket: a list of commands, each a
+   configuration file entry, which are carried out together.  The reply, with
+   the id given by the client, is sent once the HW has responded."""
+
+   def __init__(self, connection, request_id, entries):
+      self.connection = connection
+      self.id = request_id
+      self.entries = entries
+
+class ControlConnection(object):
+   """A client's connection to the control socket.  Buffers the partial
+   requests received and the replies the client is not yet ready for."""
+
+   def __init__(self, sock):
+      self.sock = sock
+      self.fd = sock.fileno()
+      self.received = ""
+      self.unsent = ""
+
+   def read(self):
+      """Read whatever the client has sent, returning the messages now
+      complete, or None if the client has closed the connection.  Raises
+      ValueError if a message is too long."""
+
+      try:
+          data = self.sock.recv(control_read_size)
+      except socket.error as e:
+          if e.errno in (errno.EAGAIN, errno.EINTR):
+              return []
+          return None
+      if not data:
+          return None
+
+      self.received += data
+      messages = []
+      while len(self.received) >= control_frame.size:
+          length = control_frame.unpack_from(self.received)[0]
+          if length > control_message_max:
+              raise ValueError("Request of %s bytes too long" % length)
+          end = control_frame.size + length
+          if len(self.received) < end:
+              break
+          messages.append(self.received[control_frame.size:end])
+          self.received = self.received[end:]
+      return messages
+
+   def send(self, message):
+      """Queue message to be sent then send as much as possible.  Returns
+      True if everything has been sent."""
+
+      body = json.dumps(message)
+      self.unsent += control_frame.pack(len(body)) + body
+      return self.flush()
+
+   def flush(self):
+      """Send as much of the replies queued as the client will accept.
+      Returns True if everything has been sent."""
+
+      try:
+          sent = self.sock.send(self.unsent)
+      except socket.error as e:
+          if e.errno not in (errno.EAGAIN, errno.EINTR):
+              # The client has gone; it is tidied up when next read
+              self.unsent = ""
+          return not self.unsent
+      self.unsent = self.unsent[sent:]
+      return not self.unsent
+
 class InotifyHandler(pyinotify.ProcessEvent):
    """Class for handling inotify events.
-   The different event handlers will be called when the file being watched,
-   the ACLerate configuration file (/mnt/flash/ACLerate-config.json), changes
-   on the disk.  Log the different notifications but process only following
-   process_IN_CLOSE_WRITE as this is when the file has been updated and saved."""
+   The directories containing the ACLerate configuration file
+   (/mnt/flash/ACLerate-config.json), the configuration directory
+   (/mnt/flash/ACLerate.d) and the rules description files they
+   reference are watched, and the different event handlers called when a file
+   in them changes on the disk.  Log the different notifications for the
+   configuration file but process only following process_IN_CLOSE_WRITE (or
+   process_IN_MOVED_TO, if the file is replaced by renaming another) as this
+   is when the file has been updated and saved."""
 
    parent = None
 
@@ -168,25 +1624,38 @@ class InotifyHandler(pyinotify.ProcessEvent):
    # Thus, the processing of the config  file is triggered following only
    # this notification.
    def process_IN_CLOSE_WRITE(self, event):
-       syslog.syslog("ACLerate config file, %s, updated & saved: process" % ACLerate_config_file)
-       self.parent.process_config()
+       self.parent.file_updated(event.pathname)
+
+   def process_IN_MOVED_TO(self, event):
+       self.parent.file_updated(event.pathname)
 
    # Called every time file content changes, i.e. potentially multiple times
    # when an open file is being manipulated.  Therefore do not trigger processing
    # following this notification.
    def process_IN_MODIFY(self, event):
-       syslog.syslog("ACLerate config file, %s, modified" % ACLerate_config_file)
+       if self.parent.config_path == event.pathname:
+           syslog.syslog("ACLerate config file, %s, modified" % ACLerate_config_file)
 
    # Create events also result in a close write and modify notifications.  Processing
    # is triggered from the former so simply log the create notification here.
    def process_IN_CREATE(self, event):
-       syslog.syslog("ACLerate config file, %s, created" % ACLerate_config_file)
+       if self.parent.config_path == event.pathname:
+           syslog.syslog("ACLerate config file, %s, created" % ACLerate_config_file)
 
    # No processing can be done once the file is deleted.  Simply log here.
    # Potentially an error so log to stderr too.
+   # A file removed from the configuration directory, though, no longer
+   # declares its ACLs so must be processed.
    def process_IN_DELETE(self, event):
-       syslog.syslog("ACLerate config file, %s, deleted" % ACLerate_config_file)
-       sys.stderr.write("ACLerate config file, %s, deleted\n" % ACLerate_config_file)
+       if self.parent.config_path == event.pathname:
+           syslog.syslog("ACLerate config file, %s, deleted" % ACLerate_config_file)
+           sys.stderr.write("ACLerate config file, %s, deleted\n" % ACLerate_config_file)
+       elif config_dir_member(event.pathname):
+           self.parent.file_updated(event.pathname)
+
+   def process_IN_MOVED_FROM(self, event):
+       if config_dir_member(event.pathname):
+           self.parent.file_updated(event.pathname)
 
 
 class ACLerate(eossdk.AgentHandler, eossdk.AclHandler,
@@ -195,7 +1664,7 @@ class ACLerate(eossdk.AgentHandler, eossdk.AclHandler,
    process configuration and rules description files, invoke the appropriate EOS SDK
    ACL APIs and handle pertinent updates from Sysdb via EOS SDK."""
     
-   def __init__(self, sdk):
+   def __init__(self, sdk, precompile_pool=None):
       # Carry out SDK-specific initialisation
       syslog.syslog("Initialization starting")
       agent_mgr = sdk.get_agent_mgr()
@@ -211,65 +1680,932 @@ class ACLerate(eossdk.AgentHandler, eossdk.AclHandler,
       self.tracer = eossdk.Tracer("ACLeratePythonAgent")
       self.tracer.trace0("Python agent constructed")
 
-      # Now register with inotify to receive be notified of changes to the config file
-      self.config_file = ACLerate_config_file
+      # Now register with inotify to receive be notified of changes to the config
+      # files.  Their directories are watched, rather than the files themselves, so
+      # that the directories of the rules files can be watched in the same way.
+      self.config_path = os.path.abspath(ACLerate_config_file)
       self.wm = pyinotify.WatchManager()
-      handler = functools.partial(InotifyHandler, parent=self)
-      mask = pyinotify.IN_MODIFY | pyinotify.IN_CREATE | pyinotify.IN_DELETE | pyinotify.IN_CLOSE_WRITE
-      self.wm.watch_transient_file(ACLerate_config_file, mask, handler)
+      self.inotify_mask = (pyinotify.IN_MODIFY | pyinotify.IN_CREATE | pyinotify.IN_DELETE |
+                           pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO |
+                           pyinotify.IN_MOVED_FROM)
       self.inotifier = pyinotify.AsyncNotifier(self.wm,
                                               InotifyHandler(parent=self))
       self.inotifier.coalesce_events(True)
       self.inotify_fd = self.wm.get_fd()
       self.watch_readable(self.inotify_fd, True)
 
+      # Interface id of each interface name validated
+      self.intf_ids = {}
+
+      # Watch descriptor of each directory watched
+      self.watches = {}
+
+      # Each configuration file parsed, by absolute path, the configuration
+      # file owning each ACL (identified as by config_acl_group()) and, for
+      # each ACL also declared in other configuration files, those files
+      self.configs = {}
+      self.acl_owners = {}
+      self.acl_conflicts = {}
+      self.watches_update()
+
+      # Fingerprints (see config_fingerprint()) of the configuration file
+      # entries for each ACL when last committed successfully
+      self.config_fingerprints = {}
+
+      # Is writing the snapshot of the state programmed scheduled, the write
+      # in progress (see snapshot_write()), if any, and when the last write
+      # started.  ACLs are only saved once ACLerate has changed them, or if
+      # they were in the snapshot read at startup.
+      self.snapshot_scheduled = False
+      self.snapshot_gen = None
+      self.snapshot_written = 0
+      self.snapshot_timer = CallbackTimer(sdk.get_timeout_mgr(), self.snapshot_resume)
+      self.acls_managed = set()
+
+      # In-memory shadow of the rules last pushed to each ACL, keyed by
+      # (ACL name, SDK ACL type).  Each value maps a rule's sequence number to
+      # its compiled description and the rules file it originated from.
+      self.acl_rules = {}
+
+      # Unless batch_commit is set, the shadow of each ACL changed since the
+      # HW last confirmed a commit, as it was beforehand.  Should the HW
+      # reject a commit, the shadow of those ACLs is no longer known to match
+      # the HW, so the numbers of the rules which must be pushed again, even
+      # if unchanged, are kept for each ACL in rules_unverified.
+      self.acls_unconfirmed = {}
+      self.rules_unverified = {}
+
+      # Counters setting last applied to each ACL, keyed as for acl_rules
+      self.acl_counters = {}
+
+      # Interfaces, as (interface name, SDK direction) pairs, to which each
+      # ACL has been applied, keyed as for acl_rules
+      self.acl_bindings = {}
+
+      # Name in HW of each ACL, keyed by (ACL name, SDK ACL type), which
+      # replace-acl has moved to the ACL named with acl_replace_suffix.  The
+      # state above is keyed by the name in HW.
+      self.acl_aliases = {}
+
+      # Batch of changes committed to HW but not yet confirmed by the HW
+      self.commit_batch = None
+
+      # Latency of the ACLs committed but not yet confirmed by the HW, and
+      # histograms of latencies of those completed
+      self.sync_timers = []
+      self.metrics = LatencyMetrics()
+      self.start_time = self.commit_time = time.time()
+
+      # Rules compiled from recently processed rules files, and the pool of
+      # processes used to compile them in parallel (see
+      # precompile_pool_create(); None if not given, in which case rules files
+      # are precompiled in this process)
+      self.rules_cache = RulesCache()
+      self.precompile_pool = precompile_pool
+
+      # Jobs queued or in progress, the job running (if any) and last run,
+      # the job with ACL changes not yet committed (if any), and the
+      # processing requested for which no job has yet been queued:
+      # configuration files, the ACLs using a set of rules files, or control
+      # socket requests
+      self.jobs = []
+      self.job_current = None
+      self.job_last = None
+      self.job_staged = None
+      self.job_count = 0
+      self.deadlines_missed = 0
+      self.pending_configs = set()
+      self.pending_rules = set()
+      self.pending_requests = []
+      self.pass_timer = CallbackTimer(sdk.get_timeout_mgr(), self.pass_resume)
+
+      # Burst of file updates being waited out, if any: time of its first
+      # update, when the burst is deemed over and the files updated
+      self.change_first = None
+      self.change_due = 0
+      self.change_configs = set()
+      self.change_rules = set()
+      self.debounce_timer = CallbackTimer(sdk.get_timeout_mgr(), self.debounce_expired)
+
+      # Is a commit awaiting the HW?  Passes are held back until it responds.
+      self.commit_pending = False
+      self.commit_wait_timer = CallbackTimer(sdk.get_timeout_mgr(), self.pass_start)
+
+      # Control socket listening for connections, if any, and the connection
+      # of each client, keyed by file descriptor number.  An inline rules
+      # list is identified in the record of the rules in each ACL by a unique
+      # origin, counted by inline_count, in place of the rules file.
+      self.control_sock = None
+      self.control_connections = {}
+      self.inline_count = 0
+      if control_socket:
+          self.control_open()
+
+      # Reader of the rules' counters (see counters_reader()), the counters
+      # of each ACL, keyed as for acl_rules, the collection in progress, if
+      # any, and when the next is due and the changes were last exported
+      self.counters_read = counters_reader(sdk)
+      self.acl_rule_counters = {}
+      self.counters_gen = None
+      self.counters_due = 0
+      self.counters_exported = time.time()
+      self.counters_timer = CallbackTimer(sdk.get_timeout_mgr(), self.counters_resume)
+
+      # Number of jobs yet to be queued which are to be profiled
+      self.profile_remaining = 0
+      if profile_dir:
+          signal.signal(signal.SIGUSR1, self.profile_request)
+
+   def on_agent_enabled(self, enabled):
+      """Called when the agent is shut down (or enabled again)"""
+
+      if not enabled:
+          syslog.syslog("Shutting down")
+          self.precompile_stop()
+          self.agent_mgr.agent_shutdown_complete_is(True)
+
+   def precompile_stop(self):
+      """Terminate the pool of precompile workers, if any"""
+
+      if self.precompile_pool is not None:
+          self.precompile_pool.terminate()
+          self.precompile_pool.join()
+          self.precompile_pool = None
+
    def on_initialized(self):
       self.tracer.trace0("Initialized")
       syslog.syslog("Initialization complete. Process initial configuration file(s)")
       self.agent_mgr.status_set("Status:", "Administratively Up")
       self.watch_all_acls(True)
-      self.process_config()
+      # The configuration files are processed once the ACLs on the switch
+      # have been read
+      self.pending_configs.update(self.config_files())
+      self.job_add("reconcile", None, self.reconcile(), LatencyTimer("reconcile"))
+      self.pass_start()
+      if counters_interval:
+          if self.counters_read is None:
+              syslog.syslog("ACL counters cannot be read with this EOS SDK: "
+                            "counter collection disabled")
+          else:
+              self.counters_due = time.time() + counters_interval
+              self.counters_timer.timeout_time_is(eossdk.now() + counters_interval)
+
+   def reconcile(self):
+      """Generator run at startup rebuilding the record of the rules programmed
+      in each ACL from the IPv4 and IPv6 ACLs found on the switch, so that only
+      differences from the configuration are then programmed.  The snapshot
+      saved by snapshot_write() supplies the rules files the rules came from.
+      If the ACLs found match the snapshot exactly, the counters, interfaces
+      and configuration fingerprints are also restored from it so unchanged
+      configuration entries are skipped.  Yields periodically, as
+      rules_program() does, while reading large ACLs."""
+
+      reconcile_start = time.time()
+      snapshot = None
+      if snapshot_file:
+          snapshot = snapshot_load()
+
+      saved = {}
+      if snapshot is not None:
+          for acl in snapshot["acls"]:
+              saved[(str(acl["name"]), acl["type"])] = acl
+      verified = snapshot is not None
+
+      acl_count = rule_count = 0
+      for acl_key in list(self.acl_mgr.acl_iter()):
+          sdk_type = acl_key.acl_type()
+          if sdk_type not in (eossdk.ACL_TYPE_IPV4, eossdk.ACL_TYPE_IPV6):
+              continue
+          acl_id = (acl_key.acl_name(), sdk_type)
+          saved_rules = {}
+          if acl_id in saved:
+              self.acls_managed.add(acl_id)
+              for rule in saved[acl_id]["rules"]:
+                  saved_rules[rule[0]] = (tuple(rule[1:6]), rule[6])
+          acl_count += 1
+
+          rules = {}
+          for entry in self.acl_mgr.acl_rule_ip_iter(acl_key):
+              number = entry.sequence_number()
+              rule_sig = rule_sig_read(entry.acl_rule(), sdk_type)
+              saved_rule = saved_rules.get(number)
+              if saved_rule is not None and saved_rule[0] == rule_sig:
+                  rules[number] = saved_rule
+              else:
+                  rules[number] = (rule_sig, None)
+                  # ACLs not in the snapshot are not ACLerate's
+                  if acl_id in saved:
+                      verified = False
+              rule_count += 1
+              if rule_count % rule_chunk_size == 0:
+                  self.agent_mgr.status_set("Progress:", "Reading ACLs on switch: %s "
+                                            "rules read" % rule_count)
+                  yield 0
+          if acl_id in saved and len(rules) != len(saved_rules):
+              verified = False
+          self.acl_rules[acl_id] = rules
+      if set(saved).difference(self.acl_rules):
+          verified = False
+
+      # ACLs replaced under another name, as long as that ACL is still there
+      if snapshot is not None:
+          for name, sdk_type, hw_name in snapshot.get("aliases", ()):
+              if self.acl_mgr.acl_exists(eossdk.AclKey(str(hw_name), sdk_type)):
+                  self.acl_aliases[(str(name), sdk_type)] = str(hw_name)
+
+      if verified:
+          for acl_id, acl in saved.iteritems():
+              if acl["counters"] is not None:
+                  self.acl_counters[acl_id] = acl["counters"]
+              self.acl_bindings[acl_id] = set((intf, direction)
+                                              for intf, direction in acl["bindings"])
+          for group, fingerprints in snapshot["fingerprints"]:
+              self.config_fingerprints[group] = [
+                  (entry, identity and tuple(identity)) for entry, identity in fingerprints]
+
+      if snapshot is None:
+          outcome = "no snapshot"
+      elif verified:
+          outcome = "snapshot verified"
+      else:
+          outcome = "snapshot out of date"
+      syslog.syslog("Found %s ACLs, %s rules on switch in %ss (%s)" %
+                    (acl_count, rule_count, time.time() - reconcile_start, outcome))
+      self.agent_mgr.status_set("Startup:", "%s ACLs, %s rules found on switch "
+                                "(%s)" % (acl_count, rule_count, outcome))
+
+   def snapshot_schedule(self):
+      """The state programmed has changed, so arrange for the snapshot to be
+      written, no sooner than snapshot_interval secs after the last write
+      started.  A write in progress no longer reflects the state so is
+      abandoned."""
+
+      if not snapshot_file:
+          return
+      if self.snapshot_gen is not None:
+          self.snapshot_gen.close()
+          self.snapshot_gen = None
+          self.snapshot_scheduled = False
+      if not self.snapshot_scheduled:
+          self.snapshot_scheduled = True
+          delay = max(0, self.snapshot_written + snapshot_interval - time.time())
+          self.snapshot_timer.timeout_time_is(eossdk.now() + delay)
+
+   def snapshot_resume(self):
+      """Continue writing the snapshot.  Postponed while changes are being
+      made or await the HW, so that the snapshot reflects the ACLs as
+      committed."""
+
+      if self.jobs or self.commit_pending:
+          if self.snapshot_gen is not None:
+              self.snapshot_gen.close()
+              self.snapshot_gen = None
+          self.snapshot_timer.timeout_time_is(eossdk.now() + snapshot_interval)
+          return
 
-   def process_config(self):
+      if self.snapshot_gen is None:
+          self.snapshot_written = time.time()
+          self.snapshot_gen = self.snapshot_write()
+      try:
+          next(self.snapshot_gen)
+      except StopIteration:
+          self.snapshot_gen = None
+          self.snapshot_scheduled = False
+          return
+      self.snapshot_timer.timeout_time_is(eossdk.now())
+
+   def snapshot_write(self):
+      """Generator saving the state programmed to snapshot_file (see
+      snapshot_load()), yielding after every snapshot_chunk_size rules.  The
+      snapshot is written to a temporary file, with its header's checksum
+      filled in at the end, then renamed so it is never left partially
+      written."""
+
+      acl_ids = sorted(self.acls_managed.intersection(
+          set(self.acl_rules).union(self.acl_counters, self.acl_bindings)))
+      aliases = [[name, sdk_type, hw_name] for (name, sdk_type), hw_name
+                 in sorted(self.acl_aliases.iteritems())]
+      fingerprints = sorted(self.config_fingerprints.iteritems())
+      header = "%s %s %%010d\n" % (snapshot_magic, snapshot_version)
+      try:
+          with open(snapshot_file + ".tmp", "w") as f:
+              f.write(header % 0)
+              checksum = 0
+              written = 0
+              for index, acl_id in enumerate(acl_ids):
+                  rules = [[number] + list(rule_sig) + [origin] for number, (rule_sig, origin)
+                           in sorted(self.acl_rules.get(acl_id, {}).iteritems())]
+                  acl = json.dumps({"name": acl_id[0],
+                                    "type": acl_id[1],
+                                    "rules": rules,
+                                    "counters": self.acl_counters.get(acl_id),
+                                    "bindings": sorted(self.acl_bindings.get(acl_id, ()))})
+                  body = ('{"acls": [' if index == 0 else ", ") + acl
+                  f.write(body)
+                  checksum = zlib.crc32(body, checksum)
+                  written += len(rules)
+                  if written >= snapshot_chunk_size:
+                      written = 0
+                      yield
+              body = "%s], \"aliases\": %s, \"fingerprints\": %s}" % (
+                  '{"acls": [' if not acl_ids else "", json.dumps(aliases),
+                  json.dumps(fingerprints))
+              f.write(body)
+              checksum = zlib.crc32(body, checksum)
+              f.seek(0)
+              f.write(header % (checksum & 0xffffffff))
+          os.rename(snapshot_file + ".tmp", snapshot_file)
+      except (IOError, OSError) as e:
+          syslog.syslog("Cannot write snapshot %s: %s" % (snapshot_file, e))
+          sys.stderr.write("Cannot write snapshot %s: %s\n" % (snapshot_file, e))
+
+   def process_config(self, rules_files=None, config_files=None):
       """Critical function; processes configuration and rules description files.
       Called upon initialization and then subsequently whenever inotify indicates
-      the configuration file has changed on disk."""
+      configuration files, config_files, have changed on disk.  If instead only
+      the rules files rules_files have changed, only the ACLs using them are
+      reprocessed.  If neither is given, every configuration file is processed.
+      The processing itself is carried out by config_pass() generators, run as
+      jobs which are resumed from the SDK event loop whenever they have to
+      wait, e.g. for a file lock, so the agent remains responsive throughout.
+      A file already being processed is processed again once that completes."""
+
+      if rules_files is None and config_files is None:
+          config_files = self.config_files()
+      if config_files:
+          self.pending_configs.update(config_files)
+      if rules_files:
+          self.pending_rules.update(rules_files)
+      self.pass_start()
+
+   def config_files(self):
+      """Return the absolute paths of every configuration file: the main
+      configuration file, those in the configuration directory, and any
+      previously parsed which may since have been removed"""
+
+      paths = set([self.config_path])
+      paths.update(config_dir_files())
+      paths.update(self.configs)
+      return paths
+
+   def pass_start(self):
+      """Queue jobs for the processing requested by process_config() and by the
+      control socket, then run the most urgent job.  Requests made while a job
+      for the same work is queued are combined into it; each configuration
+      file is processed by a job of its own."""
+
+      # Jobs are queued and run from the event loop, not from within a job
+      if self.job_current is not None:
+          return
+
+      # The configuration is processed only once the ACLs on the switch
+      # have been read
+      if self.job_find("reconcile") is None:
+          self.jobs_queue()
+      self.pass_resume()
+
+   def jobs_queue(self):
+      """Queue jobs for the processing requested and not yet queued"""
+
+      if self.pending_requests:
+          job = self.job_find("control")
+          if job is not None and job.started is None:
+              job.work.extend(self.pending_requests)
+          else:
+              requests = list(self.pending_requests)
+              timer = LatencyTimer("control")
+              self.job_add("control", requests, self.control_pass(timer, requests), timer)
+          self.pending_requests = []
+
+      # The main configuration file is queued before those in the
+      # configuration directory.  A file whose job is in progress is queued
+      # again once it completes.
+      for path in sorted(self.pending_configs, key=lambda path: (path != self.config_path, path)):
+          job = self.job_find("config", path)
+          if job is None:
+              timer = LatencyTimer(path)
+              self.job_add("config", path, self.config_pass(timer, path), timer)
+          elif job.started is not None:
+              continue
+          self.pending_configs.discard(path)
+
+      if self.pending_rules:
+          job = self.job_find("rules")
+          if job is None:
+              rules_files = set(self.pending_rules)
+              timer = LatencyTimer("rules")
+              self.job_add("rules", rules_files,
+                           self.config_pass(timer, rules_files=rules_files), timer)
+          elif job.started is None:
+              job.work.update(self.pending_rules)
+          else:
+              return
+          self.pending_rules = set()
+
+   def job_add(self, kind, work, generator, timer):
+      """Queue a job carrying out the generator, as job_priority_new until its
+      entries are known (see job_classify())"""
+
+      self.job_count += 1
+      job = Job(kind, work, generator, timer, job_priorities[job_priority_new],
+                job_deadlines[job_priority_new], self.job_count)
+      self.jobs.append(job)
+      syslog.syslog("Job %s queued" % job)
+      if self.profile_remaining and kind != "reconcile":
+          self.profile_remaining -= 1
+          job.profile = JobProfile()
+          self.agent_mgr.status_set("Profiling:", "job %s (%s more to "
+                                    "profile)" % (job, self.profile_remaining))
+      return job
+
+   def job_find(self, kind, work=None):
+      """Return the job of the given kind processing work, if any"""
+
+      for job in self.jobs:
+          if job.kind == kind and (work is None or job.work == work):
+              return job
+      return None
+
+   def job_classify(self, schedules):
+      """The entries of the current job have the (priority, deadline) pairs
+      schedules (see entry_schedule()), so the job takes on the priority and
+      deadline of the most urgent of them"""
+
+      job = self.job_current
+      if job is None or not schedules:
+          return
+      job.priority = max(priority for priority, deadline in schedules)
+      job.deadline = job.queued + min(deadline for priority, deadline in schedules)
+
+   def acls_reserve(self, acl_ids):
+      """Reserve the ACLs acl_ids, as (name, SDK type) pairs, for the current
+      job.  Returns False, reserving none of them, if another job has
+      reserved any of them, in which case the job must wait until that job
+      completes.  As each job reserves all its ACLs at once, jobs never wait
+      for each other."""
+
+      job = self.job_current
+      for other in self.jobs:
+          if other is not job and other.acls & acl_ids:
+              syslog.syslog("Job %s waiting for ACLs being changed by job %s" % (job, other))
+              return False
+      job.acls = acl_ids
+      return True
+
+   def pass_resume(self):
+      """Run the most urgent job until it next needs to wait or may be preempted,
+      then arrange for the most urgent job then to be resumed from the event
+      loop.  Jobs past their deadline are most urgent, followed by those of
+      higher priority and then those with the earliest deadline.  A job with
+      ACL changes not yet committed is not preempted, as another job's commit
+      would push them to HW incomplete.  While a commit is awaiting the HW,
+      only the job last run may continue."""
+
+      if self.job_current is not None:
+          return
+
+      now = time.time()
+      for job in self.jobs:
+          if job.deadline <= now and not job.missed:
+              job.missed = True
+              self.deadlines_missed += 1
+              syslog.syslog("Job %s missed its deadline: run ahead of other jobs" % job)
+      runnable = [job for job in self.jobs if not job.blocked and job.resume <= now]
+      if self.job_staged is not None:
+          runnable = [job for job in runnable if job is self.job_staged]
+      if runnable and self.commit_pending and runnable != [self.job_last]:
+          commit_wait = self.commit_time + commit_wait_max - now
+          if commit_wait > 0:
+              if self.job_last in runnable:
+                  runnable = [self.job_last]
+              else:
+                  syslog.syslog("ACL commit awaiting HW; resume jobs once it responds")
+                  self.commit_wait_timer.timeout_time_is(eossdk.now() + commit_wait)
+                  self.jobs_report(now)
+                  return
+          else:
+              syslog.syslog("No response from HW after %ss; resume jobs "
+                            "anyway" % commit_wait_max)
+
+      if runnable:
+          job = min(runnable, key=lambda job: (job.deadline > now, -job.priority,
+                                              job.deadline, job.seq))
+          if job.started is None:
+              job.started = now
+              job.timer.add("queue_wait", now - job.queued)
+          else:
+              job.timer.add("preempted", now - job.resume)
+          self.job_current = job
+          self.job_last = job
+          if job.profile is not None:
+              job.profile.start()
+          # A job failing unexpectedly is dropped, so that it does not hold
+          # up all other processing
+          try:
+              delay = next(job.generator)
+              complete = False
+          except StopIteration:
+              complete = True
+          except Exception as e:
+              syslog.syslog("Job %s failed: %s: %s" % (job, type(e).__name__, e))
+              sys.stderr.write("Job %s failed:\n%s" % (job, traceback.format_exc()))
+              complete = True
+          finally:
+              if job.profile is not None:
+                  job.profile.stop()
+              self.job_current = None
+          if complete:
+              self.job_complete(job)
+          # A job yields None when waiting for ACLs reserved by another
+          elif delay is None:
+              job.blocked = True
+          else:
+              job.resume = time.time() + delay
+
+      now = time.time()
+      self.jobs_report(now)
+      resumes = [job.resume for job in self.jobs if not job.blocked]
+      if resumes:
+          self.pass_timer.timeout_time_is(eossdk.now() + max(0, min(resumes) - now))
+
+   def job_complete(self, job):
+      """The job has completed so release its ACLs, and queue any processing
+      requested meanwhile"""
+
+      self.jobs.remove(job)
+      if self.job_last is job:
+          self.job_last = None
+      if self.job_staged is job:
+          self.job_staged = None
+      for other in self.jobs:
+          other.blocked = False
+      syslog.syslog("Job %s complete: waited %.3fs, ran for %.3fs" %
+                    (job, job.started - job.queued, time.time() - job.started))
+      if job.profile is not None:
+          self.profile_write(job)
+      if self.job_find("reconcile") is None:
+          self.jobs_queue()
+
+   def profile_request(self, signum, frame):
+      """SIGUSR1 handler: profile the next profile_jobs jobs queued"""
+
+      self.profile_remaining += profile_jobs
+      syslog.syslog("Profiling the next %s job(s)" % self.profile_remaining)
+      self.agent_mgr.status_set("Profiling:", "next %s job(s)" % self.profile_remaining)
+
+   def profile_write(self, job):
+      """Write the profile of the job, which has completed, to profile_dir"""
+
+      prefix = os.path.join(profile_dir, "ACLerate-%s-%s-%s" % (
+          time.strftime("%Y%m%d-%H%M%S"), job.seq, job.kind))
+      try:
+          if not os.path.isdir(profile_dir):
+              os.makedirs(profile_dir)
+          job.profile.write(prefix)
+      except (IOError, OSError) as e:
+          syslog.syslog("Cannot write profile %s: %s" % (prefix, e))
+          sys.stderr.write("Cannot write profile %s: %s\n" % (prefix, e))
+          return
+      syslog.syslog("Profile of job %s written to %s.{prof,txt,collapsed}" % (job, prefix))
+      self.agent_mgr.status_set("Profiling:", "job %s written to %s (%s more to "
+                                "profile)" % (job, prefix, self.profile_remaining))
+
+   def jobs_report(self, now):
+      """Report the jobs queued and how long they have waited in the agent
+      status"""
+
+      names = dict((priority, name) for name, priority in job_priorities.iteritems())
+      counts = collections.Counter(job.priority for job in self.jobs)
+      queued = "%s queued" % len(self.jobs)
+      if counts:
+          queued += " (%s)" % ", ".join("%s %s" % (counts[priority], names[priority])
+                                        for priority in sorted(counts, reverse=True))
+      waits = [now - job.queued for job in self.jobs if job.started is None]
+      self.agent_mgr.status_set("Jobs:", "%s, longest wait %.1fs, %s deadlines "
+                                "missed" % (queued, max(waits or [0]), self.deadlines_missed))
+
+   def file_updated(self, path):
+      """Called when inotify reports a file in a watched directory has been
+      updated.  Processing is deferred until the burst of updates is over."""
+
+      path = os.path.abspath(path)
+      if path == self.config_path:
+          syslog.syslog("ACLerate config file, %s, updated & saved: process" % ACLerate_config_file)
+          self.change_configs.add(path)
+      elif config_dir_member(path):
+          syslog.syslog("Configuration file %s updated: process" % path)
+          self.change_configs.add(path)
+      elif any(path in config.rules_dependents for config in self.configs.itervalues()):
+          syslog.syslog("Rules description file %s updated & saved: process" % path)
+          self.change_rules.add(path)
+          self.rules_file_forget(path)
+      else:
+          return
+
+      now = time.time()
+      if self.change_first is None:
+          self.change_first = now
+      self.change_due = min(now + config_debounce, self.change_first + config_debounce_max)
+      self.debounce_timer.timeout_time_is(eossdk.now() + self.change_due - now)
+
+   def rules_file_forget(self, rules_file):
+      """The rules file has been rewritten, so its rules are compiled afresh
+      and the entries referencing it processed again.  A rewrite need not
+      change the file's identity (see rules_file_identity()): the file may be
+      rewritten with the same size within the resolution of its mtime."""
+
+      self.rules_cache.discard(rules_file)
+      for group, group_fingerprints in self.config_fingerprints.items():
+          for entry, identity in group_fingerprints:
+              if identity is not None and os.path.abspath(identity[0]) == rules_file:
+                  del self.config_fingerprints[group]
+                  break
+
+   def debounce_expired(self):
+      if self.change_first is None:
+          return
+      self.change_first = None
+      self.process_config(self.change_rules, self.change_configs)
+      self.change_configs = set()
+      self.change_rules = set()
+
+   def watches_update(self):
+      """Watch the directories containing the configuration files and the rules
+      files they reference, and stop watching any other directories"""
+
+      directories = set([os.path.dirname(self.config_path)])
+      if ACLerate_config_dir and os.path.isdir(ACLerate_config_dir):
+          directories.add(os.path.abspath(ACLerate_config_dir))
+      for config in self.configs.itervalues():
+          directories.update(os.path.dirname(path) for path in config.rules_dependents)
+      for directory in directories.difference(self.watches):
+          wd = self.wm.add_watch(directory, self.inotify_mask).get(directory, -1)
+          if wd >= 0:
+              self.watches[directory] = wd
+          else:
+              syslog.syslog("Cannot watch %s for changes" % directory)
+              sys.stderr.write("Cannot watch %s for changes\n" % directory)
+      for directory in set(self.watches).difference(directories):
+          self.wm.rm_watch(self.watches.pop(directory))
+
+   def config_dependents(self, rules_files):
+      """Return the entries of the configuration files last processed for the
+      ACLs which use any of rules_files.  Every entry for these ACLs is
+      returned, in order, so that the entries still take precedence over
+      earlier entries as before."""
+
+      acl_config_list = []
+      for path in sorted(self.configs):
+          config = self.configs[path]
+          groups = set()
+          for rules_file in rules_files:
+              for index in config.rules_dependents.get(rules_file, ()):
+                  groups.add(config_acl_group(config.entries[index]))
+          acl_config_list.extend(acl_config for acl_config in config.entries
+                                 if config_acl_group(acl_config) in groups)
+      return acl_config_list
+
+   def config_claim(self, path, acl_config_list):
+      """The configuration file path declares the ACLs of the entries
+      acl_config_list.  Record it as the owner of those not owned by another
+      configuration file, and release those it no longer declares.  Returns
+      the entries for the ACLs it owns; the others are reported and ignored."""
+
+      groups = set(config_acl_group(acl_config) for acl_config in acl_config_list)
+      for group, owner in self.acl_owners.items():
+          if owner == path and group not in groups:
+              self.acl_release(group)
+      for group, paths in self.acl_conflicts.items():
+          if group not in groups:
+              paths.discard(path)
+              if not paths:
+                  del self.acl_conflicts[group]
+
+      entries = []
+      for acl_config in acl_config_list:
+          group = config_acl_group(acl_config)
+          owner = self.acl_owners.setdefault(group, path)
+          if owner == path:
+              entries.append(acl_config)
+              continue
+          paths = self.acl_conflicts.setdefault(group, set())
+          if path not in paths:
+              paths.add(path)
+              syslog.syslog("%s ACL %s declared in both %s and %s: ignored in "
+                            "%s" % (acl_config.get("type"), acl_config.get("name"),
+                                    owner, path, path))
+              sys.stderr.write("%s ACL %s declared in both %s and %s: ignored in "
+                               "%s\n" % (acl_config.get("type"), acl_config.get("name"),
+                                         owner, path, path))
+      self.conflicts_report()
+      return entries
+
+   def acl_release(self, group):
+      """The configuration file owning the ACL no longer declares it.  The ACL
+      is left as it is, but any other configuration file declaring it is
+      processed again so that it may take the ACL over."""
+
+      del self.acl_owners[group]
+      self.config_fingerprints.pop(group, None)
+      waiting = self.acl_conflicts.pop(group, set())
+      if waiting:
+          syslog.syslog("ACL %s released: reprocessing %s" % (group, ", ".join(sorted(waiting))))
+          self.pending_configs.update(waiting)
+
+   def config_forget(self, path):
+      """The configuration file path has been removed so release its ACLs"""
+
+      syslog.syslog("Configuration file %s removed: its ACLs are left as they are" % path)
+      del self.configs[path]
+      self.agent_mgr.status_del("Entries %s:" % path)
+      self.config_claim(path, [])
+      self.watches_update()
+
+   def conflicts_report(self):
+      """Report the ACLs declared in more than one configuration file in the
+      agent status"""
+
+      conflicts = ["%s (owned by %s, also in %s)" % (group, self.acl_owners.get(group),
+                                                    ", ".join(sorted(paths)))
+                   for group, paths in sorted(self.acl_conflicts.iteritems())]
+      self.agent_mgr.status_set("Conflicts:", "; ".join(conflicts) or "none")
+
+   def config_pass(self, pass_timer, config_file=None, rules_files=None):
+      """Generator carrying out a single pass over the configuration file
+      config_file (an absolute path) and the rules description files it
+      references or, if rules_files is given, over only the entries of the
+      configuration files last processed which use those rules files.  Yields
+      the number of seconds to wait whenever it cannot make progress, e.g.
+      when a file is locked, or None while waiting for another job (see
+      acls_reserve()).  The latency of the pass is recorded in pass_timer."""
 
       self.tracer.trace0("Processing config")
-      syslog.syslog("Attempting to process configuration file(s)")
 
       # Time stamp for performance evaluation
       start_time = time.time()
       self.start_time = start_time
-      
-      # Attempt to parse ACLerate_config_file
+
+      if rules_files is not None:
+          acl_config_list = self.config_dependents(rules_files)
+          syslog.syslog("Rules description file(s) %s changed: reprocessing %s of %s "
+                        "ACL entries" % (", ".join(sorted(rules_files)), len(acl_config_list),
+                                         sum(len(config.entries)
+                                             for config in self.configs.itervalues())))
+          for delay in self.config_entries_process(acl_config_list, None, start_time,
+                                                   pass_timer):
+              yield delay
+          return
+
+      syslog.syslog("Attempting to process configuration file %s" % config_file)
+
+      # Attempt to parse config_file
       # Initially, attempt to acquire the lock to ensure file not modified
       # by another entity while it is being processed here.
-      syslog.syslog("Attempting to open, lock and parse %s" % self.config_file)
+      syslog.syslog("Attempting to open, lock and parse %s" % config_file)
       try:
-          with open(self.config_file) as acl_config_file:
+          with open(config_file) as acl_config_file:
               for i in xrange(file_lock_attempt):
-                  try:
-                      fcntl.flock(acl_config_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                  if file_lock(acl_config_file, config_file, i):
                       break
-                  except IOError:
-                      sys.stderr.write("Attempt %s to lock %s "
-                                       "failed\n" % (str(i+1), self.config_file))
-                  time.sleep(file_lock_interval)
+                  # Wait without blocking the event loop before retrying
+                  yield file_lock_interval
               else:
                   syslog.syslog("All %s attempts to lock %s "
-                                "failed" % (str(file_lock_attempt), self.config_file))
+                                "failed" % (str(file_lock_attempt), config_file))
                   sys.stderr.write("All %s attempts to lock %s "
-                                   "failed\n" % (str(file_lock_attempt), self.config_file))
+                                   "failed\n" % (str(file_lock_attempt), config_file))
                   return
-              syslog.syslog("%s opened & locked successfully. Now parse" % self.config_file)
+              parse_start = time.time()
+              pass_timer.add("config_lock_wait", parse_start - start_time)
+              syslog.syslog("%s opened & locked successfully. Now parse" % config_file)
               acl_config_list = json.load(acl_config_file)
-      except IOError:
-          syslog.syslog("Cannot open %s" % self.config_file)
-          sys.stderr.write("Cannot open %s\n" % self.config_file)
+              pass_timer.add("config_parse", time.time() - parse_start)
+      except IOError as e:
+          # A configuration file removed no longer declares its ACLs
+          if e.errno == errno.ENOENT and config_file in self.configs:
+              self.config_forget(config_file)
+              return
+          syslog.syslog("Cannot open %s" % config_file)
+          sys.stderr.write("Cannot open %s\n" % config_file)
           return
+      except ValueError as e:
+          syslog.syslog("Error parsing %s: %s" % (config_file, e))
+          sys.stderr.write("Error parsing %s: %s\n" % (config_file, e))
+          return
+
+      # Only the entries for ACLs this file owns are processed.  Remember which
+      # of those use each rules file and watch them for changes.
+      config = self.configs.setdefault(config_file, ConfigFile(config_file))
+      config.entries = self.config_claim(config_file, acl_config_list)
+      config.rules_dependents = {}
+      for index, acl_config in enumerate(config.entries):
+          rules_file = acl_config.get("rules")
+          if isinstance(rules_file, basestring):
+              config.rules_dependents.setdefault(os.path.abspath(rules_file),
+                                                 []).append(index)
+      self.watches_update()
+
+      for delay in self.config_entries_process(config.entries, config_file, start_time,
+                                               pass_timer):
+          yield delay
+
+   def control_pass(self, pass_timer, requests):
+      """Generator carrying out the commands of the control socket requests
+      requests, as config_pass() does for the configuration file"""
 
+      start_time = time.time()
+      self.start_time = start_time
+      acl_config_list = [acl_config for request in requests
+                         for acl_config in request.entries]
+      syslog.syslog("Processing %s commands from %s control socket "
+                    "requests" % (len(acl_config_list), len(requests)))
+      for delay in self.config_entries_process(acl_config_list, None, start_time,
+                                               pass_timer, requests):
+          yield delay
+
+   def config_entries_process(self, acl_config_list, config_file, start_time, pass_timer,
+                              requests=None):
+      """Generator processing the entries acl_config_list of the configuration
+      files, as for config_pass().  config_file is given if these are all the
+      entries of that configuration file.  If instead the entries are the
+      commands of the control socket requests requests, these are replied to
+      once the HW has responded."""
+
+      # Changes made during this pass, committed to HW together at the end
+      # of the pass when batch_commit is set
+      batch = CommitBatch()
+      batch.timers.append(pass_timer)
+      if requests is not None:
+          batch.requests = requests
+
+      # When batch_commit is set, the entries for an ACL are skipped if they,
+      # and the rules files they reference, are unchanged since they were
+      # last successfully committed.  Control socket commands are changes
+      # to be made regardless, so are always executed.
+      fingerprints = collections.OrderedDict()
+      if requests is None:
+          for acl_config in acl_config_list:
+              fingerprints.setdefault(config_acl_group(acl_config),
+                                      []).append(config_fingerprint(acl_config))
+          skipped = 0
+          if batch_commit:
+              for group, group_fingerprints in fingerprints.iteritems():
+                  if self.config_fingerprints.get(group) == group_fingerprints:
+                      batch.fingerprints[group] = group_fingerprints
+                      skipped += len(group_fingerprints)
+              acl_config_list = [acl_config for acl_config in acl_config_list
+                                 if config_acl_group(acl_config) not in batch.fingerprints]
+          syslog.syslog("Configuration entries: %s executed, %s "
+                        "skipped as unchanged" % (len(acl_config_list), skipped))
+          if config_file is not None:
+              self.agent_mgr.status_set("Entries %s:" % config_file, "%s executed, %s "
+                                        "skipped" % (len(acl_config_list), skipped))
+
+      # The entries for the most urgent ACLs are processed first, keeping the
+      # order of the entries for each ACL.  Once the job's priority is known,
+      # a more urgent job may run first.
+      schedules = {}
+      for acl_config in acl_config_list:
+          group = config_acl_group(acl_config)
+          priority, deadline = entry_schedule(acl_config, job_priority_control
+                                              if requests is not None else
+                                              job_priority_default)
+          prior_priority, prior_deadline = schedules.get(group, (priority, deadline))
+          schedules[group] = (max(priority, prior_priority), min(deadline, prior_deadline))
+      acl_config_list = sorted(acl_config_list, reverse=True,
+                               key=lambda acl_config: schedules[config_acl_group(acl_config)][0])
+      self.job_classify(schedules.values())
+      yield 0
+
+      # No other job may change these ACLs until this job's changes are
+      # committed
+      acl_ids = set()
       for acl_config in acl_config_list:
+          acl_type = acl_config.get("type")
+          if isinstance(acl_type, basestring) and acl_type_convert(acl_type) is not None:
+              acl_ids.add((str(acl_config.get("name")), acl_type_convert(acl_type)))
+      while not self.acls_reserve(acl_ids):
+          yield None
+
+      # Compile the rules files in parallel up front if worthwhile
+      for delay in self.rules_precompile(acl_config_list, pass_timer):
+          yield delay
+
+      # Identity of each rules file opened during this pass
+      pass_identities = {}
+
+      # Number of entries for each ACL successfully processed
+      processed = collections.Counter()
+
+      # ACL replacement in progress (see acl_replace()), as an (acl_id,
+      # target_state) pair, until its new ACL has been built.  It is
+      # abandoned if the entry is not processed successfully.
+      replacing = None
+
+      for acl_config in acl_config_list:
+          if replacing is not None:
+              self.acl_replace_abandon(batch, *replacing)
+              replacing = None
 
           command = acl_config.get("command")
           name = acl_config.get("name")
@@ -279,6 +2615,7 @@ class ACLerate(eossdk.AgentHandler, eossdk.AclHandler,
           direction = acl_config.get("direction")
           rules_file = acl_config.get("rules")
           counting = acl_config.get("counting")
+          optimize = acl_config.get("optimize")
 
           # Sanity check ACL parameters (before potentially
           # iterating over thousands of rules!).  If invalid, skip
@@ -297,8 +2634,28 @@ class ACLerate(eossdk.AgentHandler, eossdk.AclHandler,
               sys.stderr.write("Invalid ACL type specified\n")
               continue
 
-          # Get handle to ACL.
-          acl_key = eossdk.AclKey(str(name), sdk_type)
+          # Get handle to ACL, by the name it has in HW if it has been replaced
+          acl_id = (str(name), sdk_type)
+          acl_key = eossdk.AclKey(self.acl_aliases.get(acl_id, acl_id[0]), sdk_type)
+          timer = LatencyTimer(str(name))
+          batch.timers.append(timer)
+
+          # The rules replacing an ACL are added to a new ACL, which is then
+          # attached to the interfaces the ACL is attached to
+          swaps = []
+          prior_counters = None
+          replaced_key = None
+          if command.lower() == "replace-acl":
+              replaced_key = acl_key
+              acl_key, swaps, prior_counters, target_state = self.acl_replace(batch, timer,
+                                                                              acl_id, acl_key)
+              replacing = (acl_id, target_state)
+              command = "add-rule"
+          self.acl_track(batch, acl_key)
+
+          # Rules are optimized only if requested, and not for MAC ACLs
+          optimize = (optimize is not None and str(optimize).lower() == "true" and
+                      command.lower() == "add-rule" and sdk_type != eossdk.ACL_TYPE_ETH)
 
           # If input command is to delete the ACL, simply call the appropriate
           # SDK API and continue onto next ACL in the list.  i.e. no need to be
@@ -306,16 +2663,27 @@ class ACLerate(eossdk.AgentHandler, eossdk.AclHandler,
           if command.lower() == "delete-acl":
               syslog.syslog("About to delete %s ACL %s" % (acl_type, name))
               self.acl_mgr.acl_del(acl_key)
+              self.acl_rules.pop((acl_key.acl_name(), sdk_type), None)
+              self.rules_unverified.pop((acl_key.acl_name(), sdk_type), None)
+              self.acl_counters.pop((acl_key.acl_name(), sdk_type), None)
+              self.acl_bindings.pop((acl_key.acl_name(), sdk_type), None)
+              if acl_id in self.acl_aliases:
+                  batch.aliases.setdefault(acl_id, self.acl_aliases.pop(acl_id))
+              batch.changed = True
+              processed[config_acl_group(acl_config)] += 1
+              batch.executed.add(id(acl_config))
               # Now call commit to actually push changes to HW.
-              self.acl_mgr.acl_commit()
+              if not batch_commit:
+                  self.acl_commit(batch.timers)
+                  batch.timers = []
               continue
 
-          intf_id = None
-          # Next, if an interface is specified, verify it actually exists
+          intf_ids = []
+          # Next, if interfaces are specified, verify they actually exist
           # and correct parameters have been specified
           if interface:
-              intf_id = self.interface_validate(interface, operation, direction)
-              if intf_id:
+              intf_ids = self.interface_validate(interface, operation, direction)
+              if intf_ids:
                   # Convert external direction to SDK's type
                   sdk_direction = direction_convert(direction)
                   if sdk_direction is None:
@@ -327,13 +2695,22 @@ class ACLerate(eossdk.AgentHandler, eossdk.AclHandler,
                   sys.stderr.write("Invalid interface %s specified\n" % interface)
                   continue
 
-          # Set ACL counting behaviour if specified.  If not, will
-          # simply fallback to default ACL behaviour.
+          # Should ACL be attached or detached from the interfaces?
+          applies = list(swaps)
+          for intf_id in intf_ids:
+              applies.append((acl_key, intf_id, sdk_direction,
+                              operation.lower() == "attach", timer))
+
+          # ACL counting behaviour, set once the ACL is known to fit.  If not
+          # specified, will simply fallback to default ACL behaviour.
+          counters = None
           if counting:
               if counting.lower() == "true":
-                  self.acl_mgr.acl_counters_enabled_set(acl_key, True)
+                  counters = True
               if counting.lower() == "false":
-                  self.acl_mgr.acl_counters_enabled_set(acl_key, False)
+                  counters = False
+          if counters is None:
+              counters = prior_counters
 
           # Rules files is needed.  Does it actually exist?
           # Is a comprehensive unwind needed in the error case?
@@ -342,139 +2719,113 @@ class ACLerate(eossdk.AgentHandler, eossdk.AclHandler,
               sys.stderr.write("Need to add/remove rules but no rule info file specified\n")
               continue
           
-          # Attempt to parse rules_file
-          # Initially, attempt to acquire the lock to ensure file not modified
-          # by another entity while it is being processed here.
-          syslog.syslog("Attempting to open, lock and parse %s" % rules_file)
-          try:
-              with open(rules_file) as rule_listing_file:
-                  for i in xrange(file_lock_attempt):
-                      try:
-                          fcntl.flock(rule_listing_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                          break
-                      except IOError:
-                          sys.stderr.write("Attempt %s to lock %s "
-                                           "failed\n" % (str(i+1), rule_file))
-                      time.sleep(file_lock_interval)
-                  else:
-                      syslog.syslog("All %s attempts to lock %s "
-                                    "failed" % (str(file_lock_attempt), rules_file))
-                      sys.stderr.write("All %s attempts to lock %s "
-                                       "failed\n" % (str(file_lock_attempt), rules_file))
-                      return
-                  syslog.syslog("%s opened & locked successfully. Now parse" % rules_file)
-                  rule_list = json.load(rule_listing_file)
-          except IOError:
-              syslog.syslog("Cannot open %s" % rules_file)
-              sys.stderr.write("Cannot open %s\n" % rules_file)
-              continue
-
-          # Now iterate over all rules
-          for index, rule in enumerate(rule_list):
-              number = rule.get("number")
-              source = rule.get("source")
-              destination = rule.get("destination")
-              protocol = rule.get("protocol")
-              action = rule.get("action")
-              log = rule.get("log")
-
-              # Rule must have a sequence number.
-              if number is None:
-                  syslog.syslog("Rule must have a number")
-                  sys.stderr.write("Rule must have a number\n")
+          # Rules given inline, by a control socket command, are compiled
+          # afresh.  Each list is recorded as the origin of its rules in place
+          # of a rules file, so rules added by earlier lists are left alone.
+          inline_rules = None
+          if isinstance(rules_file, list):
+              inline_rules = rules_file
+              self.inline_count += 1
+              rules_file = "<control %s>" % self.inline_count
+
+          # Rules previously compiled from an identical copy of this rules file
+          # (e.g. for another ACL sharing it) are reused rather than re-parsed.
+          # Within a pass, a file already opened for a previous ACL is not
+          # even re-opened.
+          rule_count = None
+          admitted = True
+          if inline_rules is not None:
+              compiled = CompiledRules(None, sdk_type, command)
+              try:
+                  compiled.rules = list(rules_compile(inline_rules, command, sdk_type, timer))
+              except (ValueError, TypeError) as e:
+                  syslog.syslog("Invalid rules for ACL %s: %s" % (name, e))
+                  sys.stderr.write("Invalid rules for ACL %s: %s\n" % (name, e))
                   continue
-    
-              # If input command is to delete the rule, simply call the SDK API
-              # and continue to next rule in the list.
-              # i.e. no need to be concerned with addresses, protocols etc.
-              if command.lower() == "delete-rule":
-                  self.acl_mgr.acl_rule_del(acl_key, int(number))
+              compiled.complete = True
+          else:
+              compiled = self.rules_cache.get(pass_identities.get(rules_file),
+                                              sdk_type, command)
+          if compiled is None:
+              # Attempt to parse rules_file
+              # Initially, attempt to acquire the lock to ensure file not modified
+              # by another entity while it is being processed here.
+              syslog.syslog("Attempting to open, lock and parse %s" % rules_file)
+              lock_start = time.time()
+              try:
+                  with open(rules_file) as rule_listing_file:
+                      for i in xrange(file_lock_attempt):
+                          if file_lock(rule_listing_file, rules_file, i):
+                              break
+                          # Wait without blocking the event loop before retrying
+                          yield file_lock_interval
+                      else:
+                          syslog.syslog("All %s attempts to lock %s "
+                                        "failed" % (str(file_lock_attempt), rules_file))
+                          sys.stderr.write("All %s attempts to lock %s "
+                                           "failed\n" % (str(file_lock_attempt), rules_file))
+                          # Abandon the rest of the pass, committing only the
+                          # ACLs already processed
+                          break
+                      timer.add("lock_wait", time.time() - lock_start)
+                      identity = rules_file_identity(rules_file,
+                                                     os.fstat(rule_listing_file.fileno()))
+                      pass_identities[rules_file] = identity
+                      compiled = self.rules_cache.get(identity, sdk_type, command)
+                      if compiled is None:
+                          syslog.syslog("%s opened & locked successfully. Now parse" % rules_file)
+                          # Rules are parsed and programmed one at a time rather than
+                          # parsing the entire (potentially enormous) file up front.
+                          compiled = CompiledRules(identity, sdk_type, command)
+                          if rules_file_binary(rule_listing_file):
+                              rules = rules_binary_iterate(rule_listing_file, command,
+                                                           sdk_type, timer)
+                          else:
+                              rules = rules_compile(rules_iterate(rule_listing_file),
+                                                    command, sdk_type, timer)
+                          rules = self.rules_admit(batch, timer, command, name, acl_key,
+                                                   rules_file, compiled.collect(rules),
+                                                   optimize, counters, applies)
+                          admitted = rules is not None
+                          if admitted:
+                              for delay in self.rules_program(batch, timer, command, name,
+                                                              acl_key, rules_file, rules):
+                                  yield delay
+                          rule_count = self.rule_count if admitted else 0
+                          self.rules_cache.add(compiled)
+              except IOError:
+                  syslog.syslog("Cannot open %s" % rules_file)
+                  sys.stderr.write("Cannot open %s\n" % rules_file)
                   continue
-
-              # If here, then the command must be to add rule.
-              # So verify if rule data supplied is valid.
-              if rule_validate(number, source, destination, action) == False:
-                  syslog.syslog("Invalid rule input data")
-                  sys.stderr.write("Invalid rule input data\n")
+              except ValueError as e:
+                  # Any rules preceding the malformed JSON have been pushed already
+                  syslog.syslog("Error parsing %s: %s" % (rules_file, e))
+                  sys.stderr.write("Error parsing %s: %s\n" % (rules_file, e))
                   continue
 
-              # Create IP ACL rule object.  Used for IPv4 and IPv6 ACLs but
-              # different object needed for Ethernet ACLs.
-              # (Perhaps create object with all rule info and invoke
-              # functions to process for ACL, IPv4, IPv6 etc?
-              # Needs more thought on optimal way to handle different ACL type)
-              acl_rule = eossdk.AclRuleIp()
-
-              # Now parse the rule data and invoke appropriate SDK
-              # APIs to create requisite data structures.
-              if source:
-                  try:
-                      # How is "any" handled? 0.0.0.0/0?
-                      if source == "any":
-                          source = "0.0.0.0/0"
-
-                      # String to IP address conversion of source?
-                      sdk_prefix = eossdk.IpPrefix(str(source))
-                      sdk_addr = eossdk.IpAddrMask(sdk_prefix.network(),
-                                                       sdk_prefix.prefix_length())
-                      acl_rule.source_addr_is(sdk_addr)
-                  except eossdk.Error:
-                      syslog.syslog("Error processing source address %s" % source)
-                      sys.stderr.write("Error processing source address %s\n" % source)
-                      continue
-
-              if destination:
-                  try:
-                      # How is "any" handled? 0.0.0.0/0?
-                      if destination == "any":
-                          destination = "0.0.0.0/0"
-
-                      # String to IP address conversion of destination?
-                      sdk_prefix = eossdk.IpPrefix(str(destination))
-                      sdk_addr = eossdk.IpAddrMask(sdk_prefix.network(),
-                                                       sdk_prefix.prefix_length())
-                      acl_rule.destination_addr_is(sdk_addr)
-                  except eossdk.Error:
-                      syslog.syslog("Error processing destination address %s" % destination)
-                      sys.stderr.write("Error processing destination address %s\n" % destination)
-                      continue
-
-              if protocol:
-                  protocol_number = protocol_validate(protocol, sdk_type)
-                  if protocol_number:
-                      acl_rule.ip_protocol_is(protocol_number)
-                  else:
-                      syslog.syslog("Error processing protocol %s" % protocol)
-                      sys.stderr.write("Error processing protocol %s\n" % protocol)
-                      continue
+          if rule_count is None:
+              if inline_rules is None:
+                  syslog.syslog("Using previously compiled rules from %s" % rules_file)
+              rules = self.rules_admit(batch, timer, command, name, acl_key, rules_file,
+                                       compiled.rules, optimize, counters, applies)
+              admitted = rules is not None
+              if admitted:
+                  for delay in self.rules_program(batch, timer, command, name, acl_key,
+                                                  rules_file, iter(rules)):
+                      yield delay
+              rule_count = self.rule_count
+
+          if not admitted:
+              continue
 
-              # Previously verified that action is 'permit' or 'deny'
-              if action:
-                  try:
-                      if action.lower() == "permit":
-                          acl_rule.action_is(eossdk.ACL_PERMIT)
-                      else:
-                          acl_rule.action_is(eossdk.ACL_DENY)
-                  except:
-                      syslog.syslog("Error processing action %s" % action)
-                      sys.stderr.write("Error processing action %s\n" % action)
-                      continue
-
-              if log:
-                  try:
-                      if log.lower() == "true":
-                          acl_rule.log_is(True)
-                      else:
-                          acl_rule.log_is(False)
-                  except:
-                      syslog.syslog("Error processing log %s" % log)
-                      sys.stderr.write("Error processing log %s\n" % log)
-                      continue
- 
-              # Now add this rule to ACL, with appropriate sequence number
-              # Should only ever be here when adding rules.... paranoid check.
-              if command.lower() == "add-rule":
-                  self.acl_mgr.acl_rule_set(acl_key, int(number), acl_rule)
+          if tcam_entry_budget is None and tcam_counter_budget is None:
+              # Without a budget the rules were not held for a preflight
+              # estimate, so it is made from the rules now programmed
+              estimate = self.acl_estimate(batch, acl_key,
+                                           len(self.acl_rules.get((acl_key.acl_name(),
+                                                                   acl_key.acl_type()), ())),
+                                           counters, applies)[0]
+              self.agent_mgr.status_set("TCAM estimate %s:" % name, estimate)
 
           parsing_time = time.time()
           self.parsing_time = parsing_time
@@ -483,38 +2834,676 @@ class ACLerate(eossdk.AgentHandler, eossdk.AclHandler,
 
           syslog.syslog("Time to parse config files for ACL %s "
                            "is %ss" % (name, self.parsing_duration))
+          processed[config_acl_group(acl_config)] += 1
+          batch.executed.add(id(acl_config))
+          if replacing is not None:
+              self.acl_replace_complete(batch, acl_id, replaced_key, acl_key)
+              target_state = replacing[1]
+              replacing = None
+
+          if batch_commit:
+              # Interfaces are updated only once the whole batch is in HW
+              syslog.syslog("Processing %s rules complete for ACL %s" % (self.rule_count, name))
+              batch.applies.extend(applies)
+              continue
 
-          self.rule_count = index+1
           syslog.syslog("Processing %s rules complete.  "
-                        "Now commit ACL %s to HW" % (index+1, name))
+                        "Now commit ACL %s to HW" % (self.rule_count, name))
+          if batch.retired:
+              # The interfaces are moved to the replacement, and the ACL
+              # replaced deleted, only once the HW has accepted the
+              # replacement.  Should it be rejected, it is undone.
+              replaced = CommitBatch()
+              replaced.acls[(acl_key.acl_name(), sdk_type)] = target_state
+              replaced.applies = applies
+              replaced.retired = batch.retired
+              replaced.aliases[acl_id] = batch.aliases[acl_id]
+              replaced.timers = batch.timers
+              replaced.changed = True
+              batch.timers = []
+              batch.retired = []
+              self.batch_commit(replaced)
+              continue
+
           # Now call commit to actually push changes to HW.
-          self.acl_mgr.acl_commit()
-
-          # Should ACL be attached or detached from interface?
-          if intf_id:
-              if operation.lower() == "attach":
-                  syslog.syslog("Attaching ACL %s to interface %s "
-                                "%sbound" % (name, interface, direction.lower()))
-                  self.acl_mgr.acl_apply(acl_key, intf_id, sdk_direction, True)
-              if operation.lower() == "detach":
-                  syslog.syslog("Detaching ACL %s from interface %s "
-                                "%sbound" % (name, interface, direction.lower()))
-                  self.acl_mgr.acl_apply(acl_key, intf_id, sdk_direction, False)
+          self.acl_commit(batch.timers)
+          batch.timers = []
+          self.interfaces_apply(applies)
+
+      if replacing is not None:
+          self.acl_replace_abandon(batch, *replacing)
+
+      if batch_commit:
+          # Only the ACLs whose entries were all processed successfully can be
+          # skipped next time
+          for group, group_fingerprints in fingerprints.iteritems():
+              if processed[group] == len(group_fingerprints):
+                  batch.fingerprints[group] = group_fingerprints
+              elif group not in batch.fingerprints:
+                  batch.fingerprints[group] = None
+          self.batch_commit(batch)
+      else:
+          # The changes have been committed already
+          self.requests_defer(batch)
+
+   def requests_defer(self, batch):
+      """The changes made by the batch have been committed already, outside
+      batch_commit mode, so reply to its control socket requests once the HW
+      has responded to the commits (see on_acl_sync and on_acl_sync_fail)"""
+
+      if not batch.requests:
+          return
+      if not self.commit_pending:
+          self.requests_reply(batch, True)
+          return
+      if self.commit_batch is None:
+          self.commit_batch = CommitBatch()
+      self.commit_batch.requests.extend(batch.requests)
+      self.commit_batch.executed.update(batch.executed)
+      batch.requests = []
+
+   def rules_precompile(self, acl_config_list, timer):
+      """Generator compiling, in parallel worker processes, the rules files
+      referenced by acl_config_list which are not already in the compiled
+      rules cache and adding them to it.  The agent itself then only needs to
+      push the compiled rules to the SDK.  Yields while waiting for the
+      workers.  Without a pool of workers, the files are compiled one at a
+      time in this process, yielding between them.  Files which cannot be
+      precompiled (e.g. because they are locked) are left to be processed as
+      usual."""
+
+      if precompile_workers <= 0:
+          return
+
+      jobs = []
+      for acl_config in acl_config_list:
+          command = acl_config.get("command")
+          acl_type = acl_config.get("type")
+          rules_file = acl_config.get("rules")
+          if (not command or command.lower() not in ("add-rule", "delete-rule",
+                                                     "replace-acl") or
+              not acl_type or acl_type_convert(acl_type) is None or
+              not isinstance(rules_file, basestring)):
+              continue
+          if command.lower() == "replace-acl":
+              command = "add-rule"
+          sdk_type = acl_type_convert(acl_type)
+          try:
+              identity = rules_file_identity(rules_file, os.stat(rules_file))
+          except OSError:
+              continue
+          job = (rules_file, sdk_type, command.lower())
+          if (self.rules_cache.get(identity, sdk_type, command) is None and
+              job not in jobs):
+              jobs.append(job)
+
+      # No point compiling more files than the cache can hold
+      jobs = jobs[:rules_cache_max_files]
+      if len(jobs) < precompile_min_files:
+          return
+
+      syslog.syslog("Precompiling %s rules files" % len(jobs))
+      precompile_start = time.time()
+      if self.precompile_pool is None:
+          # Forking a pool now would copy the SDK's connections into the
+          # workers, so each file is compiled in turn below
+          results = [(job, None) for job in jobs]
+      else:
+          results = [(job, self.precompile_pool.apply_async(rules_file_precompile, job))
+                     for job in jobs]
+
+          while not all(result.ready() for job, result in results):
+              yield precompile_poll_interval
+
+      for (rules_file, sdk_type, command), result in results:
+          try:
+              if result is None:
+                  precompiled = rules_file_precompile(rules_file, sdk_type, command)
+                  yield 0
+              else:
+                  precompiled = result.get()
+          except Exception as e:
+              syslog.syslog("Error precompiling %s: %s" % (rules_file, e))
+              continue
+          if precompiled is None:
+              continue
+          identity, rules = precompiled
+          compiled = CompiledRules(identity, sdk_type, command)
+          compiled.rules = rules
+          compiled.complete = True
+          self.rules_cache.add(compiled)
+
+      timer.add("precompile", time.time() - precompile_start)
+
+   def acl_track(self, batch, acl_key):
+      """Record the state of the ACL before it is first changed by the batch,
+      so that the change can be rolled back should the HW reject the batch.
+      The previous rules are known only for ACLs previously programmed by
+      ACLerate."""
+
+      # No other job may run until the changes are committed
+      self.job_staged = self.job_current
+      acl_id = (acl_key.acl_name(), acl_key.acl_type())
+      self.acls_managed.add(acl_id)
+      if not batch_commit and acl_id not in self.acls_unconfirmed:
+          self.acls_unconfirmed[acl_id] = dict(self.acl_rules.get(acl_id, {}))
+      if acl_id in batch.acls:
+          return
+      prior_rules = self.acl_rules.get(acl_id)
+      if prior_rules is not None:
+          prior_rules = dict(prior_rules)
+      batch.acls[acl_id] = (acl_key, self.acl_mgr.acl_exists(acl_key),
+                            prior_rules, self.acl_counters.get(acl_id),
+                            frozenset(self.acl_bindings.get(acl_id, ())))
+
+   def acl_counters_set(self, batch, acl_key, enabled):
+      """Enable or disable counters for the ACL, remembering the setting"""
+
+      acl_id = (acl_key.acl_name(), acl_key.acl_type())
+      if self.acl_counters.get(acl_id) != enabled:
+          batch.changed = True
+      self.acl_counters[acl_id] = enabled
+      self.acl_mgr.acl_counters_enabled_set(acl_key, enabled)
+
+   def batch_commit(self, batch):
+      """Commit all changes made by the batch to HW with a single commit.  The
+      interface attachments and detachments are carried out once the HW
+      confirms the commit succeeded (see on_acl_sync) or straight away if
+      nothing actually needed to be committed."""
+
+      if not batch.acls:
+          # E.g. all entries were skipped as unchanged: the pass is complete
+          self.fingerprints_record(batch)
+          self.requests_reply(batch, True)
+          self.metrics.record(batch.timers)
+          self.metrics.publish(self.agent_mgr)
+          return
+
+      if not batch.changed:
+          syslog.syslog("No ACL changes to commit")
+          self.fingerprints_record(batch)
+          self.interfaces_apply(batch.applies)
+          self.requests_reply(batch, True)
+          self.metrics.record(batch.timers)
+          self.metrics.publish(self.agent_mgr)
+          return
+
+      # A previous batch may still be awaiting the HW, in which case this
+      # commit also covers it and so takes over its rollback information.
+      if self.commit_batch is not None:
+          batch.absorb(self.commit_batch)
+
+      syslog.syslog("Now commit %s ACL(s) to HW" % len(batch.acls))
+      self.commit_batch = batch
+      self.acl_commit(batch.timers)
+      batch.timers = []
+
+   def fingerprints_record(self, batch):
+      """The batch is in HW so remember the fingerprints of the configuration
+      file entries it processed"""
+
+      fingerprints = dict(self.config_fingerprints)
+      for group, group_fingerprints in batch.fingerprints.iteritems():
+          if group_fingerprints is None:
+              self.config_fingerprints.pop(group, None)
+          elif group in self.acl_owners:
+              self.config_fingerprints[group] = group_fingerprints
+      if self.config_fingerprints != fingerprints:
+          self.snapshot_schedule()
+
+   def acl_commit(self, timers):
+      """Commit pending ACL changes to HW.  The latency timers of the ACLs
+      concerned are completed once the HW responds."""
+
+      commit_start = time.time()
+      self.acl_mgr.acl_commit()
+      self.commit_time = time.time()
+      self.commit_pending = True
+      self.job_staged = None
+      for timer in timers:
+          timer.add("commit", self.commit_time - commit_start)
+          timer.committed = self.commit_time
+      self.sync_timers.extend(timers)
+
+   def batch_rollback(self, batch):
+      """The HW rejected the batch so restore every ACL it changed to the state
+      it was in beforehand and commit that instead."""
+
+      rollback = CommitBatch()
+      rollback.rollback = True
+      # ACLs replaced remain in use
+      for acl_id, hw_name in batch.aliases.iteritems():
+          if hw_name == acl_id[0]:
+              self.acl_aliases.pop(acl_id, None)
+          else:
+              self.acl_aliases[acl_id] = hw_name
+      for acl_id, state in batch.acls.items():
+          rollback.applies.extend(self.acl_restore(acl_id, state))
+
+      self.commit_batch = rollback
+      self.acl_commit([])
+
+   def acl_restore(self, acl_id, state):
+      """Restore the ACL acl_id to the state, an (acl_key, existed, rules,
+      counters, bindings) tuple as recorded by acl_track(), it was in
+      beforehand.  Returns the interface updates (see interfaces_apply())
+      which restore its bindings, to be made once the restored ACL is in HW:
+      deleting an ACL detaches it from its interfaces."""
+
+      acl_key, existed, prior_rules, prior_counters, prior_bindings = state
+      if not existed:
+          syslog.syslog("Rolling back creation of ACL %s" % acl_id[0])
+          self.acl_mgr.acl_del(acl_key)
+          self.acl_rules.pop(acl_id, None)
+          self.acl_counters.pop(acl_id, None)
+          self.acl_bindings.pop(acl_id, None)
+          return []
+
+      if prior_rules is None:
+          syslog.syslog("Cannot roll back ACL %s: previous rules unknown" % acl_id[0])
+          sys.stderr.write("Cannot roll back ACL %s: previous rules unknown\n" % acl_id[0])
+          return []
+
+      syslog.syslog("Rolling back ACL %s" % acl_id[0])
+      current_rules = self.acl_rules.get(acl_id, {})
+      for number in current_rules:
+          if number not in prior_rules:
+              self.acl_mgr.acl_rule_del(acl_key, number)
+      for number, (rule_sig, origin) in prior_rules.iteritems():
+          if current_rules.get(number) != (rule_sig, origin):
+              acl_rule = rule_build(rule_sig)
+              if acl_rule is not None:
+                  self.acl_mgr.acl_rule_set(acl_key, number, acl_rule)
+      self.acl_rules[acl_id] = prior_rules
+
+      if prior_counters is not None:
+          self.acl_mgr.acl_counters_enabled_set(acl_key, prior_counters)
+          self.acl_counters[acl_id] = prior_counters
+      elif self.acl_counters.pop(acl_id, None):
+          # Counting was off, the default, until enabled by the batch
+          self.acl_mgr.acl_counters_enabled_set(acl_key, False)
+
+      # The bindings are recorded as the updates are made
+      applies = []
+      timer = LatencyTimer(acl_id[0])
+      current_bindings = self.acl_bindings.get(acl_id, set())
+      for intf, sdk_direction in sorted(prior_bindings.symmetric_difference(current_bindings)):
+          try:
+              intf_id = eossdk.IntfId(intf)
+          except eossdk.NoSuchInterfaceError:
+              current_bindings.discard((intf, sdk_direction))
+              continue
+          applies.append((acl_key, intf_id, sdk_direction,
+                          (intf, sdk_direction) in prior_bindings, timer))
+      return applies
+
+   def acl_replace(self, batch, timer, acl_id, acl_key):
+      """Prepare to replace the rules of the ACL acl_id, currently in HW as
+      acl_key, with those of a replace-acl command.  Returns the key of the
+      (empty) ACL the new rules are to be added to, the interface updates which
+      will move the ACL's interfaces to it, the counters setting to carry over
+      and the state of that ACL beforehand (as recorded by acl_track()).  The
+      old ACL is left untouched until then, and deleted afterwards.  If the ACL
+      does not yet exist, it is simply created.  If it has already been
+      replaced by changes not yet accepted by the HW, that replacement, not yet
+      in use, is rebuilt instead.  The ACL is only switched over to its
+      replacement by acl_replace_complete() once the replacement has been
+      built, and acl_replace_abandon() restores the replacement otherwise."""
+
+      name, sdk_type = acl_id
+      old_id = (acl_key.acl_name(), sdk_type)
+      prior_counters = self.acl_counters.get(old_id)
+      swaps = []
+      if (acl_id in batch.aliases or (self.commit_batch is not None and
+                                      acl_id in self.commit_batch.aliases) or
+          not self.acl_mgr.acl_exists(acl_key)):
+          target = acl_key
+      else:
+          if acl_key.acl_name() == name:
+              target = eossdk.AclKey(name + acl_replace_suffix, sdk_type)
+          else:
+              target = eossdk.AclKey(name, sdk_type)
+          for intf, sdk_direction in sorted(self.acl_bindings.get(old_id, ())):
+              try:
+                  intf_id = eossdk.IntfId(intf)
+              except eossdk.NoSuchInterfaceError:
+                  syslog.syslog("Interface %s no longer exists: not moved to "
+                                "ACL %s" % (intf, target.acl_name()))
+                  continue
+              swaps.append((target, intf_id, sdk_direction, True, timer))
+          syslog.syslog("Replacing ACL %s: building %s to take over its %s "
+                        "interfaces" % (acl_key.acl_name(), target.acl_name(), len(swaps)))
+
+      # The ACL is built from scratch
+      self.acl_track(batch, target)
+      target_id = (target.acl_name(), sdk_type)
+      prior_rules = self.acl_rules.get(target_id)
+      if prior_rules is not None:
+          prior_rules = dict(prior_rules)
+      target_state = (target, self.acl_mgr.acl_exists(target), prior_rules,
+                      self.acl_counters.get(target_id),
+                      frozenset(self.acl_bindings.get(target_id, ())))
+      if target_id in self.acl_rules or target_state[1]:
+          self.acl_mgr.acl_del(target)
+          self.acl_rules.pop(target_id, None)
+          self.acl_counters.pop(target_id, None)
+          self.acl_bindings.pop(target_id, None)
+          batch.changed = True
+      return target, swaps, prior_counters, target_state
+
+   def acl_replace_complete(self, batch, acl_id, acl_key, target):
+      """The replacement target of the ACL acl_id, in HW as acl_key, has been
+      built so subsequent commands for the ACL apply to the replacement, and
+      the ACL replaced is deleted once its interfaces have been moved"""
+
+      batch.aliases.setdefault(acl_id, acl_key.acl_name())
+      if target.acl_name() == acl_id[0]:
+          self.acl_aliases.pop(acl_id, None)
+      else:
+          self.acl_aliases[acl_id] = target.acl_name()
+      if target.acl_name() != acl_key.acl_name():
+          batch.retired.append((acl_id, acl_key))
+
+   def acl_replace_abandon(self, batch, acl_id, target_state):
+      """The replacement of the ACL acl_id could not be built so restore the
+      ACL it was being built in to its state beforehand.  The ACL itself
+      remains in use unchanged."""
+
+      target = target_state[0]
+      syslog.syslog("Replacement of ACL %s abandoned" % acl_id[0])
+      applies = self.acl_restore((target.acl_name(), target.acl_type()), target_state)
+      if batch_commit:
+          batch.applies.extend(applies)
+      else:
+          self.interfaces_apply(applies)
+
+   def acls_retire(self, retired):
+      """The interfaces of the ACLs replaced have been moved to their
+      replacements so delete the old ACLs, given as (acl_id, acl_key) pairs.
+      They are deleted with a separate commit: the replacements are already
+      in use so need not wait for the old ACLs to be removed from HW."""
+
+      deleted = 0
+      for acl_id, acl_key in retired:
+          # Skip an ACL which has been brought back into use since
+          if self.acl_aliases.get(acl_id, acl_id[0]) == acl_key.acl_name():
+              continue
+          syslog.syslog("Deleting ACL %s, replaced by %s" %
+                        (acl_key.acl_name(), self.acl_aliases.get(acl_id, acl_id[0])))
+          self.acl_mgr.acl_del(acl_key)
+          old_id = (acl_key.acl_name(), acl_key.acl_type())
+          self.acl_rules.pop(old_id, None)
+          self.acl_counters.pop(old_id, None)
+          self.acl_bindings.pop(old_id, None)
+          deleted += 1
+      if deleted:
+          self.acl_commit([])
+
+   def interfaces_apply(self, applies):
+      """Attach ACLs to, or detach them from, interfaces.  applies is a list
+      of (acl_key, intf_id, sdk_direction, attach, timer) tuples.  The
+      outcome for each ACL is reported in the agent status."""
+
+      # Interfaces attached, detached and failed for each ACL
+      results = collections.OrderedDict()
+      for acl_key, intf_id, sdk_direction, attach, timer in applies:
+          apply_start = time.time()
+          if sdk_direction == eossdk.ACL_IN:
+              direction = "in"
+          else:
+              direction = "out"
+          if attach:
+              syslog.syslog("Attaching ACL %s to interface %s "
+                            "%sbound" % (acl_key.acl_name(), intf_id.to_string(), direction))
+          else:
+              syslog.syslog("Detaching ACL %s from interface %s "
+                            "%sbound" % (acl_key.acl_name(), intf_id.to_string(), direction))
+          result = results.setdefault(acl_key.acl_name(), ([], [], []))
+          try:
+              self.acl_mgr.acl_apply(acl_key, intf_id, sdk_direction, attach)
+          except eossdk.Error as e:
+              syslog.syslog("Cannot update ACL %s on interface %s: %s" %
+                            (acl_key.acl_name(), intf_id.to_string(), e))
+              sys.stderr.write("Cannot update ACL %s on interface %s: %s\n" %
+                               (acl_key.acl_name(), intf_id.to_string(), e))
+              result[2].append(intf_id.to_string())
+              continue
+          timer.add("intf_apply", time.time() - apply_start)
+          bindings = self.acl_bindings.setdefault((acl_key.acl_name(), acl_key.acl_type()),
+                                                  set())
+          if attach:
+              bindings.add((intf_id.to_string(), sdk_direction))
+              result[0].append(intf_id.to_string())
+          else:
+              bindings.discard((intf_id.to_string(), sdk_direction))
+              result[1].append(intf_id.to_string())
+
+      for name, (attached, detached, failed) in results.iteritems():
+          status = "%s attached, %s detached" % (len(attached), len(detached))
+          if failed:
+              status += ", failed: %s" % ", ".join(failed)
+          self.agent_mgr.status_set("Interfaces %s:" % name, status)
+
+   def rules_admit(self, batch, timer, command, name, acl_key, rules_file, rules,
+                   optimize, counters, applies):
+      """Prepare to program the (number, rule_sig) pairs rules from rules_file
+      into the ACL identified by acl_key: optimize the rules if requested,
+      check the ACL will fit in TCAM once the rules are programmed, its
+      counters set (unless counters is None) and interfaces updated according
+      to applies, then set its counters.  Returns the rules to program, or
+      None if the ACL is rejected, in which case no changes have been made."""
+
+      if optimize:
+          rules = self.acl_optimize(timer, name, acl_key, rules_file, rules)
+
+      if command.lower() == "add-rule" and (tcam_entry_budget is not None or
+                                             tcam_counter_budget is not None):
+          # The whole rules file is needed for the estimate
+          rules = list(rules)
+          if not self.acl_preflight(batch, name, acl_key, rules_file, rules,
+                                    counters, applies):
+              return None
+
+      if counters is not None:
+          self.acl_counters_set(batch, acl_key, counters)
+      return rules
+
+   def acl_preflight(self, batch, name, acl_key, rules_file, rules, counters, applies):
+      """Estimate the TCAM usage of the ACL once the (number, rule_sig) pairs
+      rules from rules_file are programmed, counters set and interfaces updated
+      by this and earlier applies of the batch.  The estimate is reported via
+      the agent status.  Returns False if it exceeds the budget."""
+
+      acl_id = (acl_key.acl_name(), acl_key.acl_type())
+
+      # The ACL will consist of these rules, any rules from other files not
+      # overwritten by them and, for invalid rules, the rules they would have
+      # replaced
+      new_rules = {}
+      for number, rule_sig in rules:
+          new_rules[number] = rule_sig
+      acl_shadow = self.acl_rules.get(acl_id, {})
+      rule_count = sum(1 for number, (rule_sig, origin) in acl_shadow.iteritems()
+                       if origin != rules_file and number not in new_rules)
+      for number, rule_sig in new_rules.iteritems():
+          if rule_sig is not None or number in acl_shadow:
+              rule_count += 1
+
+      estimate, entries, counter_count = self.acl_estimate(batch, acl_key, rule_count,
+                                                           counters, applies)
+      if tcam_entry_budget is not None and entries > tcam_entry_budget:
+          problem = "%s entries exceeds budget of %s" % (entries, tcam_entry_budget)
+      elif tcam_counter_budget is not None and counter_count > tcam_counter_budget:
+          problem = "%s counters exceeds budget of %s" % (counter_count, tcam_counter_budget)
+      else:
+          self.agent_mgr.status_set("TCAM estimate %s:" % name, estimate)
+          return True
+
+      syslog.syslog("ACL %s rejected: estimated %s" % (name, problem))
+      sys.stderr.write("ACL %s rejected: estimated %s\n" % (name, problem))
+      self.agent_mgr.status_set("TCAM estimate %s:" % name, "%s (rejected)" % estimate)
+      return False
+
+   def acl_estimate(self, batch, acl_key, rule_count, counters, applies):
+      """Estimate the TCAM usage of the ACL identified by acl_key with
+      rule_count valid rules, once its counters are set and interfaces updated
+      by this and earlier applies of the batch.  Returns the estimate as
+      reported in the agent status, the entries and the counters."""
+
+      acl_id = (acl_key.acl_name(), acl_key.acl_type())
+      bindings = set(self.acl_bindings.get(acl_id, ()))
+      for apply_key, intf_id, sdk_direction, attach, timer in batch.applies + applies:
+          if (apply_key.acl_name(), apply_key.acl_type()) != acl_id:
+              continue
+          if attach:
+              bindings.add((intf_id.to_string(), sdk_direction))
+          else:
+              bindings.discard((intf_id.to_string(), sdk_direction))
+
+      if counters is None:
+          counters = self.acl_counters.get(acl_id, False)
+
+      per_binding, entries, counter_count = acl_tcam_estimate(rule_count, acl_key.acl_type(),
+                                                              counters, len(bindings))
+      estimate = ("%s entries per interface, %s interfaces: %s entries, "
+                  "%s counters" % (per_binding, len(bindings), entries, counter_count))
+      return estimate, entries, counter_count
+
+   def acl_optimize(self, timer, name, acl_key, rules_file, rules):
+      """Return the optimized equivalent of the (number, rule_sig) pairs rules
+      from rules_file for the ACL identified by acl_key (see rules_optimize()),
+      logging the rules and TCAM entries saved.  All the rules are needed to
+      optimize them, so the rules file is read in full first."""
+
+      # Optimizing must not move rules of this file across those of the ACL
+      # added from other files
+      acl_shadow = self.acl_rules.get((acl_key.acl_name(), acl_key.acl_type()), {})
+      barriers = sorted(number for number, (rule_sig, origin) in acl_shadow.iteritems()
+                        if origin != rules_file)
+
+      rules = list(rules)
+      optimize_start = time.time()
+      optimized, saved_rules, saved_entries = rules_optimize(rules, acl_key.acl_type(),
+                                                             barriers)
+      timer.add("optimize", time.time() - optimize_start)
+      syslog.syslog("ACL %s optimized: %s rules and %s TCAM entries "
+                    "saved" % (name, saved_rules, saved_entries))
+      return optimized
+
+   def rules_program(self, batch, timer, command, name, acl_key, rules_file, rules):
+      """Push the (number, rule_sig) pairs yielded by the iterable rules to the
+      SDK for the ACL identified by acl_key, according to command.  Rules are
+      consumed one at a time so SDK calls are made while the rules file is still
+      being read.  This is a generator: after
+      every rule_chunk_size rules, or rule_chunk_time secs, it yields so that
+      the event loop can service other work before programming continues.
+      The number of rules processed is left in self.rule_count."""
+
+      # Shadow of the rules previously pushed to this ACL.  Only rules
+      # which are new or differ from the shadow are pushed to the SDK.
+      acl_id = (acl_key.acl_name(), acl_key.acl_type())
+      acl_shadow = self.acl_rules.setdefault(acl_id, {})
+      # Rules whose shadow may not match the HW (see rules_invalidate())
+      unverified = self.rules_unverified.get(acl_id, set())
+      added = modified = removed = unchanged = 0
+      rule_numbers = set()
+      rule_count = 0
+      chunk_start = time.time()
+      chunk_count = 0
+
+      # Now iterate over all rules
+      for number, rule_sig in rules:
+          rule_count += 1
+          rule_numbers.add(number)
+
+          # Give the event loop a chance to run once this chunk is complete
+          chunk_count += 1
+          if (chunk_count >= rule_chunk_size or
+              (chunk_count % 64 == 0 and time.time() - chunk_start >= rule_chunk_time)):
+              self.agent_mgr.status_set("Progress:", "ACL %s: %s rules "
+                                        "processed" % (name, rule_count))
+              yield 0
+              chunk_start = time.time()
+              chunk_count = 0
+
+          # If input command is to delete the rule, simply call the SDK API
+          # and continue to next rule in the list.
+          # i.e. no need to be concerned with addresses, protocols etc.
+          if command.lower() == "delete-rule":
+              sdk_start = time.time()
+              self.acl_mgr.acl_rule_del(acl_key, number)
+              timer.add("rule_set", time.time() - sdk_start)
+              acl_shadow.pop(number, None)
+              unverified.discard(number)
+              continue
+
+          # If here, then the command must be to add rule.  Rules whose data
+          # was found to be invalid when compiled are skipped.
+          if rule_sig is None:
+              continue
+
+          # Rule is already programmed exactly as described so nothing to do
+          shadow_entry = acl_shadow.get(number)
+          if (shadow_entry is not None and shadow_entry[0] == rule_sig and
+              number not in unverified):
+              if shadow_entry[1] != rules_file:
+                  acl_shadow[number] = (rule_sig, rules_file)
+              unchanged += 1
+              continue
+
+          build_start = time.time()
+          acl_rule = rule_build(rule_sig)
+          sdk_start = time.time()
+          timer.add("build", sdk_start - build_start)
+          if acl_rule is None:
+              continue
+
+          # Now add this rule to ACL, with appropriate sequence number
+          # Should only ever be here when adding rules.... paranoid check.
+          if command.lower() == "add-rule":
+              self.acl_mgr.acl_rule_set(acl_key, number, acl_rule)
+              timer.add("rule_set", time.time() - sdk_start)
+              acl_shadow[number] = (rule_sig, rules_file)
+              unverified.discard(number)
+              if shadow_entry is None:
+                  added += 1
+              else:
+                  modified += 1
+
+      # Rules previously added from this rules file but no longer present
+      # in it are removed from the ACL.
+      if command.lower() == "add-rule":
+          for number, (rule_sig, origin) in acl_shadow.items():
+              if origin == rules_file and number not in rule_numbers:
+                  self.acl_mgr.acl_rule_del(acl_key, number)
+                  del acl_shadow[number]
+                  unverified.discard(number)
+                  removed += 1
+          syslog.syslog("ACL %s rules: %s added, %s modified, %s removed, "
+                        "%s unchanged" % (name, added, modified, removed, unchanged))
+
+      if not unverified:
+          self.rules_unverified.pop(acl_id, None)
+      if added or modified or removed or command.lower() == "delete-rule":
+          batch.changed = True
+      self.rule_count = rule_count
+      self.agent_mgr.status_set("Progress:", "ACL %s: %s rules "
+                                "processed" % (name, rule_count))
 
    def interface_validate(self, interface, operation, direction):
-       """An interface has been specified so verify that it exists and is usable.
-       Also check that the accompanying parameters are valid.  If both true then
-       the ACL can be attached/detached from the interface so return the
-       interface id.  If not, return None so processing stops before attempting
-       to process the potentially large rules description file."""
-       
-       # Verify interface exists
-       try:
-           intf_id = eossdk.IntfId(str(interface))
-       except eossdk.NoSuchInterfaceError:
-           sys.stderr.write("Interface %s does not exist\n" % interface)
+       """Interfaces have been specified (see interfaces_expand()) so verify
+       that they exist and are usable.  Also check that the accompanying
+       parameters are valid.  If so then the ACL can be attached/detached
+       from the interfaces so return the interface ids of those which exist;
+       the others are reported and left out.  If none exist, return None so
+       processing stops before attempting to process the potentially large
+       rules description file."""
+
+       if direction is None or operation is None:
+           sys.stderr.write("Direction and operation must be specified with"
+                            " interface %s\n" % interface)
            return None
- 
+
        if direction.lower() != "in" and direction.lower() != "out" :
            sys.stderr.write("Direction must be 'in' or 'out',"
                             " i.e. not '%s'\n" % direction)
@@ -525,38 +3514,349 @@ class ACLerate(eossdk.AgentHandler, eossdk.AclHandler,
                             " i.e. not '%s'\n" % operation)
            return None
 
-       return intf_id
+       names = interfaces_expand(interface)
+       if names is None:
+           sys.stderr.write("Interface specification %s is malformed or gives more than "
+                            "%s interfaces\n" % (interface, interfaces_max))
+           return None
+
+       # Verify interfaces exist.  Interface ids are remembered so a name is
+       # only checked the first time it is used.
+       intf_ids = []
+       for name in names:
+           intf_id = self.intf_ids.get(name)
+           if intf_id is None:
+               try:
+                   intf_id = eossdk.IntfId(str(name))
+               except eossdk.NoSuchInterfaceError:
+                   syslog.syslog("Interface %s does not exist" % name)
+                   sys.stderr.write("Interface %s does not exist\n" % name)
+                   continue
+               self.intf_ids[name] = intf_id
+           intf_ids.append(intf_id)
+       if len(intf_ids) > 1 or len(names) > 1:
+           syslog.syslog("%s of %s interfaces specified by %s "
+                         "exist" % (len(intf_ids), len(names), interface))
+       return intf_ids or None
+
+   def control_open(self):
+      """Listen for connections to the control socket"""
+
+      try:
+          if os.path.exists(control_socket):
+              os.unlink(control_socket)
+          sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+          sock.bind(control_socket)
+          sock.listen(16)
+      except (socket.error, OSError) as e:
+          syslog.syslog("Cannot listen on control socket %s: %s" % (control_socket, e))
+          sys.stderr.write("Cannot listen on control socket %s: %s\n" % (control_socket, e))
+          return
+      sock.setblocking(False)
+      self.control_sock = sock
+      self.watch_readable(sock.fileno(), True)
+      syslog.syslog("Listening on control socket %s" % control_socket)
+
+   def control_accept(self):
+      """Accept the connections waiting on the control socket"""
+
+      while True:
+          try:
+              sock, _ = self.control_sock.accept()
+          except socket.error:
+              return
+          sock.setblocking(False)
+          connection = ControlConnection(sock)
+          self.control_connections[connection.fd] = connection
+          self.watch_readable(connection.fd, True)
+
+   def control_close(self, connection):
+      self.watch_readable(connection.fd, False)
+      self.watch_writable(connection.fd, False)
+      del self.control_connections[connection.fd]
+      connection.sock.close()
+
+   def control_read(self, connection):
+      """Read the requests the client has sent on its connection and queue
+      them to be carried out"""
+
+      try:
+          messages = connection.read()
+      except ValueError as e:
+          syslog.syslog("Control socket request refused: %s" % e)
+          self.control_send(connection, {"id": None, "status": "error", "message": str(e)})
+          messages = None
+      if messages is None:
+          self.control_close(connection)
+          return
+
+      for message in messages:
+          request = self.control_request(connection, message)
+          if request is not None:
+              self.pending_requests.append(request)
+      if self.pending_requests:
+          self.pass_start()
+
+   def control_request(self, connection, message):
+      """Decode and check a request received on the control socket.  A request
+      is an object with an id, echoed in the reply, and a list of commands.
+      Each command is a configuration file entry, whose rules may be given
+      inline as a list of rules, or an attach or detach command, which only
+      updates interfaces.  Returns the ControlRequest, or None if the request
+      is invalid, in which case an error has been sent in reply."""
+
+      request_id = None
+      try:
+          request = json.loads(message)
+          if not isinstance(request, dict):
+              raise ValueError("Request must be a JSON object")
+          request_id = request.get("id")
+          commands = request.get("commands")
+          if not isinstance(commands, list):
+              raise ValueError("Request must contain a list of commands")
+          entries = []
+          for entry in commands:
+              if not isinstance(entry, dict):
+                  raise ValueError("Each command must be a JSON object")
+              command = entry.get("command")
+              if isinstance(command, basestring) and command.lower() in ("attach", "detach"):
+                  entry = dict(entry, command="add-rule", operation=command, rules=[])
+              rules = entry.get("rules")
+              if isinstance(rules, list) and not all(isinstance(rule, dict)
+                                                     for rule in rules):
+                  raise ValueError("Each rule must be a JSON object")
+              entries.append(entry)
+      except ValueError as e:
+          syslog.syslog("Invalid control socket request: %s" % e)
+          self.control_send(connection, {"id": request_id, "status": "error",
+                                         "message": str(e)})
+          return None
+      return ControlRequest(connection, request_id, entries)
+
+   def control_send(self, connection, reply):
+      """Send reply to the client, finishing once it is ready if need be"""
+
+      if connection.fd not in self.control_connections:
+          return
+      if not connection.send(reply):
+          self.watch_writable(connection.fd, True)
+
+   def requests_reply(self, batch, committed):
+      """The HW has responded to the changes made by the batch, or none were
+      needed, so reply to the control socket requests it carried out.  The
+      reply gives the outcome of each command: "ok" or "rejected" (e.g. being
+      invalid).  If the HW failed the changes (committed is False), they have
+      all been undone."""
+
+      for request in batch.requests:
+          results = []
+          for acl_config in request.entries:
+              if id(acl_config) in batch.executed:
+                  results.append("ok")
+              else:
+                  results.append("rejected")
+          self.control_send(request.connection, {"id": request.id,
+                                                 "status": "ok" if committed else "failed",
+                                                 "results": results})
+      batch.requests = []
 
    def on_readable(self, fd):
        """Called when file descriptor number is readable"""
        if fd == self.inotify_fd:
            self.inotifier.handle_read()
+       elif self.control_sock is not None and fd == self.control_sock.fileno():
+           self.control_accept()
+       elif fd in self.control_connections:
+           self.control_read(self.control_connections[fd])
+
+   def on_writable(self, fd):
+       """Called when file descriptor number is writable, i.e. a control
+       socket client is ready for the rest of the replies to it"""
+       connection = self.control_connections.get(fd)
+       if connection is None or connection.flush():
+           self.watch_writable(fd, False)
+
+   def counters_resume(self):
+      """Run the counter collection, starting one if due, until it next returns
+      to the event loop, and arrange for it, or the next, to be resumed"""
+
+      if self.counters_gen is None:
+          self.counters_gen = self.counters_collect()
+          self.counters_due += counters_interval
+      try:
+          next(self.counters_gen)
+      except StopIteration:
+          self.counters_gen = None
+          self.counters_timer.timeout_time_is(eossdk.now() +
+                                              max(0, self.counters_due - time.time()))
+          return
+      self.counters_timer.timeout_time_is(eossdk.now())
+
+   def counters_collect(self):
+      """Generator reading the counters of every rule of the ACLs with counting
+      enabled, and exporting the changes if due.  Yields every
+      counters_chunk_size rules so large ACLs do not hold up the event loop."""
+
+      collect_start = time.time()
+      acl_ids = sorted(acl_id for acl_id, enabled in self.acl_counters.iteritems() if enabled)
+      for acl_id in set(self.acl_rule_counters).difference(acl_ids):
+          del self.acl_rule_counters[acl_id]
+
+      rule_count = changed = chunk_count = 0
+      for acl_id in acl_ids:
+          numbers = sorted(self.acl_rules.get(acl_id, {}))
+          table = self.acl_rule_counters.get(acl_id)
+          if table is None or table.numbers.tolist() != numbers:
+              table = RuleCounters(numbers, table)
+              self.acl_rule_counters[acl_id] = table
+          try:
+              for number, packets, byte_count in self.counters_read(eossdk.AclKey(*acl_id)):
+                  changed += table.update(number, packets, byte_count)
+                  rule_count += 1
+                  chunk_count += 1
+                  if chunk_count >= counters_chunk_size:
+                      yield
+                      chunk_count = 0
+          except (eossdk.Error, ValueError, KeyError) as e:
+              syslog.syslog("Cannot read counters of ACL %s: %s" % (acl_id[0], e))
+              sys.stderr.write("Cannot read counters of ACL %s: %s\n" % (acl_id[0], e))
+
+      now = time.time()
+      self.agent_mgr.status_set("Counters:", "%s ACLs, %s rules read in %.1fms, %s "
+                                "changed" % (len(acl_ids), rule_count,
+                                             (now - collect_start) * 1000, changed))
+      if now - self.counters_exported >= counters_export_interval:
+          self.counters_export(now)
+
+   def counters_export(self, now):
+      """Append the changes to the counters since they were last exported to
+      counters_file as a line of JSON: the time, the secs since last exported
+      (so that rates can be calculated) and, for each ACL with any rules
+      whose counters have changed, those rules' numbers and increases in
+      packets and bytes.  Nothing is written if no counters have changed."""
+
+      # ACLs are identified by their name in the configuration, rather than
+      # in HW should they have been replaced
+      names = dict((hw_name, acl_id[0]) for acl_id, hw_name in self.acl_aliases.iteritems())
+      acls = []
+      for acl_id, table in sorted(self.acl_rule_counters.iteritems()):
+          changes = table.export()
+          if changes:
+              acls.append({"name": names.get(acl_id[0], acl_id[0]),
+                           "type": acl_type_names.get(acl_id[1], acl_id[1]),
+                           "rules": changes})
+      interval = now - self.counters_exported
+      self.counters_exported = now
+      if not acls or not counters_file:
+          return
+
+      line = json.dumps({"timestamp": now, "interval": interval, "acls": acls},
+                        separators=(",", ":"), sort_keys=True)
+      try:
+          if (os.path.exists(counters_file) and
+              os.path.getsize(counters_file) >= counters_file_max):
+              os.rename(counters_file, counters_file + ".1")
+          with open(counters_file, "a") as f:
+              f.write(line + "\n")
+      except (IOError, OSError) as e:
+          syslog.syslog("Cannot write counters file %s: %s" % (counters_file, e))
 
    def on_acl_sync(self):
        """Called upon hardware successfully committing all pending transactions"""
        self.sync_time = time.time()
        syslog.syslog("ACL programming success callback from HW")
 
-       # Need to be careful of timestamping here when there are multiple ACLs etc
-       # Should perhaps verify the ACL name in question?  Remove before production.
-       hw_processing_duration = self.sync_time - self.parsing_time
+       hw_processing_duration = self.sync_time - self.commit_time
        syslog.syslog("HW programming duration is %ss" % hw_processing_duration)
 
        overall_duration = self.sync_time - self.start_time
        syslog.syslog("Overall duration is %ss" % overall_duration)
 
+       # Now that the batch is in HW, update the interfaces
+       batch = self.commit_batch
+       self.commit_batch = None
+       self.commit_pending = False
+       self.acls_unconfirmed = {}
+       if batch is not None:
+           if batch.rollback:
+               syslog.syslog("Rollback of rejected ACL changes complete")
+               self.interfaces_apply(batch.applies)
+           else:
+               self.fingerprints_record(batch)
+               self.interfaces_apply(batch.applies)
+               self.requests_reply(batch, True)
+               if batch.retired:
+                   self.acls_retire(batch.retired)
+
+       self.sync_timers_complete(False)
+       self.snapshot_schedule()
+       self.pass_start()
+
    def on_acl_sync_fail(self, linecard, message):
        """Called if a problem stopped ACL configuration from being committed.
        e.g. because the TCAM is full."""
+       self.sync_time = time.time()
        sys.stderr.write("ACL programming failure callback from HW."
                         " Linecard: %s. Message: %s\n" % (linecard, message))
        syslog.syslog("ACL programming failure callback from HW."
                      " Linecard: %s. Message: %s" % (linecard, message))
 
+       # Undo the whole batch rather than leave it partially applied.  The
+       # interfaces have not been touched yet so need no attention.
+       batch = self.commit_batch
+       self.commit_batch = None
+       self.commit_pending = False
+       # The ACLs may no longer be as last processed so process all entries
+       # again next time
+       self.config_fingerprints = {}
+       self.rules_invalidate()
+       self.sync_timers_complete(True)
+       if batch is not None and not batch.rollback:
+           self.requests_reply(batch, False)
+           # A batch only awaiting replies (see requests_defer()) changed no
+           # ACLs itself
+           if batch.acls or batch.aliases:
+               self.batch_rollback(batch)
+       self.pass_start()
+
+   def rules_invalidate(self):
+       """Unless batch_commit is set, changes rejected by the HW are not rolled
+       back, leaving the ACLs changed since the last confirmed commit in an
+       unknown state.  Every rule of those ACLs, including any deleted since,
+       is pushed again when next processed (see rules_program())."""
+
+       for acl_id, prior_rules in self.acls_unconfirmed.iteritems():
+           acl_shadow = self.acl_rules.setdefault(acl_id, {})
+           for number, shadow_entry in prior_rules.iteritems():
+               acl_shadow.setdefault(number, shadow_entry)
+           self.rules_unverified.setdefault(acl_id, set()).update(acl_shadow)
+           syslog.syslog("ACL %s: %s rules to be programmed again" %
+                         (acl_id[0], len(self.rules_unverified[acl_id])))
+       self.acls_unconfirmed = {}
+
+   def sync_timers_complete(self, failed):
+       """The HW has responded to the outstanding commit(s) so complete the
+       latency timers of the ACLs concerned and publish the updated metrics"""
+
+       if not self.sync_timers:
+           return
+       for timer in self.sync_timers:
+           timer.add("hw_sync", self.sync_time - timer.committed)
+           timer.add("total", self.sync_time - timer.start)
+           timer.failed = failed
+       self.metrics.record(self.sync_timers)
+       self.sync_timers = []
+       self.metrics.publish(self.agent_mgr)
+
 def main():
+    # The precompile workers are forked before the SDK opens any connections
+    precompile_pool = precompile_pool_create()
     sdk = eossdk.Sdk()
-    ACLerator = ACLerate(sdk)
-    sdk.main_loop(sys.argv)
+    ACLerator = ACLerate(sdk, precompile_pool)
+    try:
+        sdk.main_loop(sys.argv)
+    finally:
+        ACLerator.precompile_stop()
 
 if __name__ == '__main__':
    sys.exit( main() )
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# Copyright (c) 2018 Arista Networks, Inc.  All rights reserved.
+# Arista Networks, Inc. Confidential and Proprietary.
+
+#Checks that when the HW rejects a batch of ACL changes every ACL it changed
+#is restored to its state beforehand: its rules, counters and the interfaces
+#it is attached to.  ACLerate is run against the stand-in EOS SDK in
+#performance/fakesdk, which is made to reject the commit.  It is executed:
+#   python tests/test_commit_rollback.py
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(top_dir, "performance", "fakesdk"))
+sys.path.insert(1, os.path.join(top_dir, "src"))
+import eossdk
+import ACLerate
+
+class CommitRollbackTest(unittest.TestCase):
+
+   def setUp(self):
+      self.dir = tempfile.mkdtemp()
+      ACLerate.batch_commit = True
+      ACLerate.counters_interval = None
+      ACLerate.metrics_file = None
+      ACLerate.snapshot_file = None
+      ACLerate.control_socket = None
+      ACLerate.ACLerate_config_dir = None
+      ACLerate.ACLerate_config_file = os.path.join(self.dir, "config.json")
+
+      self.sdk = eossdk.Sdk()
+      self.acl_mgr = self.sdk.acl_mgr
+      self.agent = ACLerate.ACLerate(self.sdk)
+
+   def tearDown(self):
+      shutil.rmtree(self.dir)
+
+   def rules_write(self, name, numbers):
+      rules_file = os.path.join(self.dir, name + ".json")
+      with open(rules_file, "w") as f:
+          json.dump([{"number": number, "source": "10.0.0.%s" % number,
+                      "destination": "any", "action": "permit"} for number in numbers], f)
+      return rules_file
+
+   def process(self, entries, fail=False):
+      """Process the configuration entries, the HW rejecting the commit if
+      fail is set but accepting the rollback"""
+
+      with open(ACLerate.ACLerate_config_file, "w") as f:
+          json.dump(entries, f)
+      sync = self.acl_mgr.sync
+      def sync_once():
+          sync()
+          self.acl_mgr.sync_fail = None
+      if fail:
+          self.acl_mgr.sync_fail = "TCAM full"
+          self.acl_mgr.sync = sync_once
+      self.agent.process_config()
+      self.sdk.run_until_idle()
+      self.acl_mgr.sync = sync
+
+   def hw_rules(self, name):
+      return sorted(self.acl_mgr.acls.get(eossdk.AclKey(name, eossdk.ACL_TYPE_IPV4), {}))
+
+   def hw_bindings(self, name):
+      return sorted(binding for binding, acl_key in self.acl_mgr.applied.iteritems()
+                    if acl_key.acl_name() == name)
+
+   def test_rules(self):
+      self.process([{"command": "add-rule", "name": "A", "type": "IPv4",
+                     "rules": self.rules_write("A", [10, 20, 30])}])
+      self.process([{"command": "add-rule", "name": "A", "type": "IPv4",
+                     "rules": self.rules_write("A", [20, 30, 40, 50]),
+                     "counting": "true"}], fail=True)
+      self.assertEqual(self.hw_rules("A"), [10, 20, 30])
+      self.assertEqual(sorted(self.agent.acl_rules[("A", eossdk.ACL_TYPE_IPV4)]),
+                       [10, 20, 30])
+      self.assertFalse(self.acl_mgr.counters_enabled[eossdk.AclKey("A", eossdk.ACL_TYPE_IPV4)])
+      # The rejected changes are made again by the next pass
+      self.process([{"command": "add-rule", "name": "A", "type": "IPv4",
+                     "rules": self.rules_write("A", [20, 30, 40, 50])}])
+      self.assertEqual(self.hw_rules("A"), [20, 30, 40, 50])
+
+   def test_created(self):
+      # An ACL created by the rejected batch is deleted, with its interfaces
+      self.process([{"command": "add-rule", "name": "A", "type": "IPv4",
+                     "rules": self.rules_write("A", [10]), "interface": "Ethernet1",
+                     "direction": "in", "operation": "attach"}], fail=True)
+      self.assertFalse(self.acl_mgr.acl_exists(eossdk.AclKey("A", eossdk.ACL_TYPE_IPV4)))
+      self.assertEqual(self.hw_bindings("A"), [])
+      self.assertFalse(("A", eossdk.ACL_TYPE_IPV4) in self.agent.acl_rules)
+
+   def test_delete_acl(self):
+      # Deleting an ACL detaches it from its interfaces, so rolling back the
+      # deletion attaches it to them again
+      self.process([{"command": "add-rule", "name": "A", "type": "IPv4",
+                     "rules": self.rules_write("A", [10, 20]), "interface": "Ethernet1-2",
+                     "direction": "in", "operation": "attach"},
+                    {"command": "add-rule", "name": "B", "type": "IPv4",
+                     "rules": self.rules_write("B", [10]), "interface": "Ethernet3",
+                     "direction": "out", "operation": "attach"}])
+      bindings = [("Ethernet1", eossdk.ACL_IN), ("Ethernet2", eossdk.ACL_IN)]
+      self.assertEqual(self.hw_bindings("A"), bindings)
+
+      self.process([{"command": "delete-acl", "name": "A", "type": "IPv4"},
+                    {"command": "add-rule", "name": "B", "type": "IPv4",
+                     "rules": self.rules_write("B", [10, 20])}], fail=True)
+      self.assertEqual(self.hw_rules("A"), [10, 20])
+      self.assertEqual(self.hw_bindings("A"), bindings)
+      self.assertEqual(sorted(self.agent.acl_bindings[("A", eossdk.ACL_TYPE_IPV4)]),
+                       bindings)
+      self.assertEqual(self.hw_rules("B"), [10])
+      self.assertEqual(self.hw_bindings("B"), [("Ethernet3", eossdk.ACL_OUT)])
+
+if __name__ == '__main__':
+   unittest.main()
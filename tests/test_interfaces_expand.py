@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# Copyright (c) 2018 Arista Networks, Inc.  All rights reserved.
+# Arista Networks, Inc. Confidential and Proprietary.
+
+#Checks the expansion of the interface attribute of a configuration entry by
+#interfaces_expand(): lists and ranges of interface numbers, leading zeros,
+#duplicates and the limit on the number of interfaces an entry may specify.
+#ACLerate is run against the stand-in EOS SDK in performance/fakesdk.  It is
+#executed:
+#   python tests/test_interfaces_expand.py
+
+import os
+import sys
+import unittest
+
+top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(top_dir, "performance", "fakesdk"))
+sys.path.insert(1, os.path.join(top_dir, "src"))
+import eossdk
+import ACLerate
+
+class InterfacesExpandTest(unittest.TestCase):
+
+   def test_names(self):
+      self.assertEqual(ACLerate.interfaces_expand("Ethernet1"), ["Ethernet1"])
+      self.assertEqual(ACLerate.interfaces_expand(["Ethernet2", "Management1"]),
+                       ["Ethernet2", "Management1"])
+      self.assertEqual(ACLerate.interfaces_expand(" Port-Channel10 "), ["Port-Channel10"])
+
+   def test_ranges(self):
+      self.assertEqual(ACLerate.interfaces_expand("Ethernet1-4"),
+                       ["Ethernet1", "Ethernet2", "Ethernet3", "Ethernet4"])
+      self.assertEqual(ACLerate.interfaces_expand("Port-Channel10,20,30-31"),
+                       ["Port-Channel10", "Port-Channel20", "Port-Channel30",
+                        "Port-Channel31"])
+      # Only the last component of a modular interface number is a range
+      self.assertEqual(ACLerate.interfaces_expand("Ethernet3/1-3"),
+                       ["Ethernet3/1", "Ethernet3/2", "Ethernet3/3"])
+      self.assertEqual(ACLerate.interfaces_expand("Ethernet1/2/3-4"),
+                       ["Ethernet1/2/3", "Ethernet1/2/4"])
+      self.assertEqual(ACLerate.interfaces_expand("Ethernet5-5"), ["Ethernet5"])
+
+   def test_leading_zeros(self):
+      self.assertEqual(ACLerate.interfaces_expand("Ethernet01"), ["Ethernet1"])
+      self.assertEqual(ACLerate.interfaces_expand("Ethernet08-010"),
+                       ["Ethernet8", "Ethernet9", "Ethernet10"])
+      self.assertEqual(ACLerate.interfaces_expand("Ethernet03/01-2"),
+                       ["Ethernet3/1", "Ethernet3/2"])
+
+   def test_duplicates(self):
+      # The first occurrence of each interface is kept, in order
+      self.assertEqual(ACLerate.interfaces_expand(["Ethernet3,1-2", "Ethernet02", "Ethernet3"]),
+                       ["Ethernet3", "Ethernet1", "Ethernet2"])
+
+   def test_malformed(self):
+      for interface in ["Ethernet5-3", "Ethernet1,,2", "Ethernet1-", "Ethernet1/1-2/3",
+                        ["Ethernet1", 2], 3, None, {"Ethernet1": "in"}]:
+          self.assertEqual(ACLerate.interfaces_expand(interface), None, repr(interface))
+
+   def test_cap(self):
+      self.assertEqual(ACLerate.interfaces_max, 4096)
+      self.assertEqual(len(ACLerate.interfaces_expand("Ethernet1-4096")), 4096)
+      self.assertEqual(ACLerate.interfaces_expand("Ethernet1-4097"), None)
+      self.assertEqual(ACLerate.interfaces_expand("Ethernet1-4000,5000-5096"), None)
+      self.assertEqual(ACLerate.interfaces_expand(["Ethernet1-4096", "Ethernet9999"]), None)
+      self.assertEqual(ACLerate.interfaces_expand(["Management1"] * 4097), None)
+      # A huge range is rejected without being expanded
+      self.assertEqual(ACLerate.interfaces_expand("Ethernet1-4000000000"), None)
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# Copyright (c) 2018 Arista Networks, Inc.  All rights reserved.
+# Arista Networks, Inc. Confidential and Proprietary.
+
+#Checks replace-acl, with and without batch commits: the new rules are built
+#in the shadow ACL, which takes over the ACL's interfaces only once the HW
+#has accepted it, and the ACL replaced is then deleted.  Should the
+#replacement be rejected, by the HW or before being built, the ACL stays in
+#use unchanged.  ACLerate is run against the stand-in EOS SDK in
+#performance/fakesdk.  It is executed:
+#   python tests/test_replace_acl.py
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(top_dir, "performance", "fakesdk"))
+sys.path.insert(1, os.path.join(top_dir, "src"))
+import eossdk
+import ACLerate
+
+acl_id = ("P", eossdk.ACL_TYPE_IPV4)
+shadow_name = "P" + ACLerate.acl_replace_suffix
+bindings = [("Ethernet1", eossdk.ACL_IN), ("Ethernet2", eossdk.ACL_OUT)]
+
+class ReplaceAclTest(unittest.TestCase):
+
+   def setUp(self):
+      self.dir = tempfile.mkdtemp()
+      self.batch_commit = ACLerate.batch_commit
+      self.tcam_entry_budget = ACLerate.tcam_entry_budget
+      ACLerate.counters_interval = None
+      ACLerate.metrics_file = None
+      ACLerate.snapshot_file = None
+      ACLerate.control_socket = None
+      ACLerate.ACLerate_config_dir = None
+      ACLerate.ACLerate_config_file = os.path.join(self.dir, "config.json")
+
+   def tearDown(self):
+      ACLerate.batch_commit = self.batch_commit
+      ACLerate.tcam_entry_budget = self.tcam_entry_budget
+      shutil.rmtree(self.dir)
+
+   def agent_start(self, batch_commit):
+      """Start the agent with ACL P, of rules 1-3, attached to two
+      interfaces"""
+
+      ACLerate.batch_commit = batch_commit
+      self.sdk = eossdk.Sdk()
+      self.acl_mgr = self.sdk.acl_mgr
+      self.agent = ACLerate.ACLerate(self.sdk)
+      self.process([{"command": "add-rule", "name": "P", "type": "IPv4",
+                     "rules": self.rules_write("old", 3), "interface": "Ethernet1",
+                     "direction": "in", "operation": "attach"},
+                    {"command": "add-rule", "name": "P", "type": "IPv4",
+                     "rules": self.rules_write("old", 3), "interface": "Ethernet2",
+                     "direction": "out", "operation": "attach"}])
+      self.assertEqual(self.hw_acls(), {"P": [1, 2, 3]})
+
+   def rules_write(self, name, count):
+      rules_file = os.path.join(self.dir, name + ".json")
+      with open(rules_file, "w") as f:
+          json.dump([{"number": number, "source": "10.0.0.%s" % number,
+                      "destination": "any", "action": "permit"}
+                     for number in xrange(1, count + 1)], f)
+      return rules_file
+
+   def process(self, entries, fail=False):
+      """Process the configuration entries, the HW rejecting the first commit
+      if fail is set"""
+
+      with open(ACLerate.ACLerate_config_file, "w") as f:
+          json.dump(entries, f)
+      sync = self.acl_mgr.sync
+      def sync_once():
+          sync()
+          self.acl_mgr.sync_fail = None
+      if fail:
+          self.acl_mgr.sync_fail = "TCAM full"
+          self.acl_mgr.sync = sync_once
+      self.agent.process_config()
+      self.sdk.run_until_idle()
+      self.acl_mgr.sync = sync
+
+   def replace(self, rules_file, fail=False):
+      self.process([{"command": "replace-acl", "name": "P", "type": "IPv4",
+                     "rules": rules_file}], fail)
+
+   def hw_acls(self):
+      return dict((acl_key.acl_name(), sorted(rules))
+                  for acl_key, rules in self.acl_mgr.acls.iteritems())
+
+   def hw_bindings(self):
+      return dict((binding, acl_key.acl_name())
+                  for binding, acl_key in self.acl_mgr.applied.iteritems())
+
+   def check_swap(self, batch_commit):
+      self.agent_start(batch_commit)
+      new = self.rules_write("new", 5)
+
+      # Until the HW accepts the replacement, the interfaces keep the ACL
+      synced = []
+      sync = self.acl_mgr.sync
+      def sync_record():
+          synced.append((self.hw_acls(), self.hw_bindings()))
+          sync()
+      self.acl_mgr.sync = sync_record
+      self.replace(new)
+      self.acl_mgr.sync = sync
+      self.assertEqual(synced[0], ({"P": [1, 2, 3], shadow_name: [1, 2, 3, 4, 5]},
+                                   dict((binding, "P") for binding in bindings)))
+
+      self.assertEqual(self.hw_acls(), {shadow_name: [1, 2, 3, 4, 5]})
+      self.assertEqual(self.hw_bindings(), dict((binding, shadow_name) for binding in bindings))
+      self.assertEqual(self.agent.acl_aliases, {acl_id: shadow_name})
+
+      # Subsequent commands for the ACL apply to its replacement
+      self.process([{"command": "add-rule", "name": "P", "type": "IPv4",
+                     "rules": self.rules_write("new", 6)}])
+      self.assertEqual(self.hw_acls(), {shadow_name: [1, 2, 3, 4, 5, 6]})
+
+      # Replacing it again moves it back to its own name
+      self.replace(self.rules_write("newer", 2))
+      self.assertEqual(self.hw_acls(), {"P": [1, 2]})
+      self.assertEqual(self.hw_bindings(), dict((binding, "P") for binding in bindings))
+      self.assertEqual(self.agent.acl_aliases, {})
+
+   def test_swap(self):
+      self.check_swap(True)
+
+   def test_swap_unbatched(self):
+      self.check_swap(False)
+
+   def check_sync_fail(self, batch_commit):
+      self.agent_start(batch_commit)
+      self.replace(self.rules_write("new", 5), fail=True)
+      self.assertEqual(self.hw_acls(), {"P": [1, 2, 3]})
+      self.assertEqual(self.hw_bindings(), dict((binding, "P") for binding in bindings))
+      self.assertEqual(self.agent.acl_aliases, {})
+      self.assertEqual(sorted(self.agent.acl_bindings[acl_id]), bindings)
+
+      # The replacement is made once the HW accepts it
+      self.agent.config_fingerprints = {}
+      self.replace(self.rules_write("new", 5))
+      self.assertEqual(self.hw_acls(), {shadow_name: [1, 2, 3, 4, 5]})
+      self.assertEqual(self.hw_bindings(), dict((binding, shadow_name) for binding in bindings))
+
+   def test_sync_fail(self):
+      self.check_sync_fail(True)
+
+   def test_sync_fail_unbatched(self):
+      self.check_sync_fail(False)
+
+   def test_abandoned(self):
+      # A replacement which cannot be built leaves the ACL as it was
+      for batch_commit in (True, False):
+          self.agent_start(batch_commit)
+          self.replace(os.path.join(self.dir, "missing.json"))
+          self.assertEqual(self.hw_acls(), {"P": [1, 2, 3]})
+          self.assertEqual(self.hw_bindings(), dict((binding, "P") for binding in bindings))
+
+          ACLerate.tcam_entry_budget = 10
+          self.replace(self.rules_write("new", 30))
+          ACLerate.tcam_entry_budget = None
+          self.assertEqual(self.hw_acls(), {"P": [1, 2, 3]})
+          self.assertEqual(self.hw_bindings(), dict((binding, "P") for binding in bindings))
+          self.assertEqual(self.agent.acl_aliases, {})
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# Copyright (c) 2018 Arista Networks, Inc.  All rights reserved.
+# Arista Networks, Inc. Confidential and Proprietary.
+
+#Checks the collection of rule counters: the counters read from the show
+#access-lists output are turned into changes since the previous read, the
+#first read of a rule is only a starting point, reset counters count from 0
+#and the changes are exported as a line of JSON.  ACLerate is run against the
+#stand-in EOS SDK in performance/fakesdk.  It is executed:
+#   python tests/test_rule_counters.py
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(top_dir, "performance", "fakesdk"))
+sys.path.insert(1, os.path.join(top_dir, "src"))
+import eossdk
+import ACLerate
+
+class RuleCountersTest(unittest.TestCase):
+
+   def setUp(self):
+      self.dir = tempfile.mkdtemp()
+      ACLerate.counters_interval = None
+      ACLerate.metrics_file = None
+      ACLerate.snapshot_file = None
+      ACLerate.control_socket = None
+      ACLerate.ACLerate_config_dir = None
+      ACLerate.counters_file = os.path.join(self.dir, "counters.jsonl")
+      # Changes are only exported when the tests do so
+      ACLerate.counters_export_interval = float("inf")
+      ACLerate.ACLerate_config_file = os.path.join(self.dir, "config.json")
+
+      rules_file = os.path.join(self.dir, "rules.json")
+      with open(rules_file, "w") as f:
+          json.dump([{"number": number, "source": "10.0.0.%s" % number,
+                      "destination": "any", "action": "permit"}
+                     for number in (10, 20, 30)], f)
+      with open(ACLerate.ACLerate_config_file, "w") as f:
+          json.dump([{"command": "add-rule", "name": "block", "type": "IPv4",
+                      "rules": rules_file, "counting": "true"}], f)
+
+      self.sdk = eossdk.Sdk()
+      self.agent = ACLerate.ACLerate(self.sdk)
+      self.agent.process_config()
+      self.sdk.run_until_idle()
+      self.acl_key = eossdk.AclKey("block", eossdk.ACL_TYPE_IPV4)
+
+   def tearDown(self):
+      shutil.rmtree(self.dir)
+
+   def collect(self, counters):
+      """Read the counters, given as {number: (packets, bytes)}"""
+
+      self.sdk.eapi_mgr.counters[self.acl_key] = counters
+      for step in self.agent.counters_collect():
+          pass
+
+   def table(self):
+      return self.agent.acl_rule_counters[("block", eossdk.ACL_TYPE_IPV4)]
+
+   def test_first_read(self):
+      # Rules which have already matched packets are not reported as changed
+      # when first read, nor are those read as zero
+      self.collect({10: (5, 500), 20: (0, 0), 30: (7, 700)})
+      self.assertEqual(self.table().export(), [])
+      self.collect({10: (5, 500), 20: (0, 0), 30: (7, 700)})
+      self.assertEqual(self.table().export(), [])
+      # A rule read as zero first counts its packets from zero
+      self.collect({10: (5, 500), 20: (3, 300), 30: (7, 700)})
+      self.assertEqual(self.table().export(), [[20, 3, 300]])
+
+   def test_deltas(self):
+      self.collect({10: (5, 500), 20: (0, 0), 30: (7, 700)})
+      self.collect({10: (8, 800), 20: (0, 0), 30: (7, 700)})
+      self.collect({10: (9, 900), 20: (0, 0), 30: (10, 1000)})
+      # Changes accumulate until exported
+      self.assertEqual(self.table().export(), [[10, 4, 400], [30, 3, 300]])
+      self.assertEqual(self.table().export(), [])
+      self.collect({10: (9, 900), 20: (2, 200), 30: (10, 1000)})
+      self.assertEqual(self.table().export(), [[20, 2, 200]])
+
+   def test_reset(self):
+      # Counters which have gone backwards were cleared, so count from zero
+      self.collect({10: (5, 500), 20: (0, 0), 30: (7, 700)})
+      self.collect({10: (2, 200), 20: (0, 0), 30: (7, 700)})
+      self.assertEqual(self.table().export(), [[10, 2, 200]])
+
+   def test_packets_only(self):
+      # Counts EOS does not report are read as 0
+      self.collect({10: (5, 0), 20: (0, 0), 30: (7, 0)})
+      self.collect({10: (6, 0), 20: (0, 0), 30: (7, 0)})
+      self.assertEqual(self.table().export(), [[10, 1, 0]])
+
+   def test_export(self):
+      self.agent.counters_exported = 100.0
+      self.collect({10: (5, 500), 20: (0, 0), 30: (7, 700)})
+      self.agent.counters_export(110.0)
+      # Nothing has changed, so nothing is written
+      self.assertFalse(os.path.exists(ACLerate.counters_file))
+
+      self.collect({10: (6, 600), 20: (0, 0), 30: (9, 900)})
+      self.agent.counters_export(125.0)
+      with open(ACLerate.counters_file) as f:
+          lines = f.readlines()
+      self.assertEqual(len(lines), 1)
+      self.assertEqual(json.loads(lines[0]),
+                       {"timestamp": 125.0, "interval": 15.0,
+                        "acls": [{"name": "block", "type": "IPv4",
+                                  "rules": [[10, 1, 100], [30, 2, 200]]}]})
+
+   def test_read_failure(self):
+      # A failed show command is reported and the other counters are kept
+      self.collect({10: (5, 500), 20: (0, 0), 30: (7, 700)})
+      self.sdk.eapi_mgr.fail["show ip access-lists block"] = "Not supported"
+      self.collect({10: (6, 600), 20: (0, 0), 30: (7, 700)})
+      self.assertEqual(self.table().export(), [])
+      del self.sdk.eapi_mgr.fail["show ip access-lists block"]
+      self.collect({10: (6, 600), 20: (0, 0), 30: (7, 700)})
+      self.assertEqual(self.table().export(), [[10, 1, 100]])
+
+if __name__ == '__main__':
+   unittest.main()
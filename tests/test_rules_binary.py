@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+# Copyright (c) 2018 Arista Networks, Inc.  All rights reserved.
+# Arista Networks, Inc. Confidential and Proprietary.
+
+#Checks that JSON rules converted to the binary format by
+#utilities/rules-json-to-binary.py are read back by ACLerate as the same
+#rules as the JSON file, for IPv4 and IPv6 ACLs and rules with "any" ends.
+#ACLerate is run against the stand-in EOS SDK in performance/fakesdk.  It is
+#executed:
+#   python tests/test_rules_binary.py
+
+import imp
+import os
+import sys
+import tempfile
+import unittest
+
+top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(top_dir, "performance", "fakesdk"))
+sys.path.insert(1, os.path.join(top_dir, "src"))
+import eossdk
+import ACLerate
+
+converter = imp.load_source("rules_json_to_binary",
+                            os.path.join(top_dir, "utilities", "rules-json-to-binary.py"))
+
+class RulesBinaryTest(unittest.TestCase):
+
+   def round_trip(self, rules, sdk_type, acl_family):
+      """Return the rules read from the binary conversion of the JSON rules,
+      and those compiled from the JSON rules themselves"""
+
+      with tempfile.TemporaryFile() as binary_file:
+          binary_file.write(converter.rules_pack(rules, acl_family))
+          binary_file.flush()
+          binary_file.seek(0)
+          self.assertTrue(ACLerate.rules_file_binary(binary_file))
+          binary = list(ACLerate.rules_binary_iterate(binary_file, "add-rule", sdk_type,
+                                                      ACLerate.LatencyTimer("test")))
+      compiled = list(ACLerate.rules_compile(iter(rules), "add-rule", sdk_type,
+                                             ACLerate.LatencyTimer("test")))
+      return binary, compiled
+
+   def test_ipv4(self):
+      rules = [{"number": 10, "source": "10.0.0.0/8", "destination": "any",
+                "protocol": "tcp", "action": "permit"},
+               {"number": 20, "source": "any", "destination": "192.0.2.1",
+                "action": "deny", "log": "true"},
+               {"number": 30, "source": "192.0.2.0/24", "destination": "198.51.100.0/24",
+                "protocol": "udp", "action": "permit", "log": "false"},
+               {"number": 40, "source": "any", "destination": "any", "action": "deny"}]
+      binary, compiled = self.round_trip(rules, eossdk.ACL_TYPE_IPV4, 4)
+      self.assertEqual(binary, compiled)
+      self.assertTrue(all(rule_sig is not None for number, rule_sig in binary))
+
+   def test_ipv6(self):
+      rules = [{"number": 10, "source": "2001:db8::/32", "destination": "any",
+                "protocol": "tcp", "action": "permit"},
+               {"number": 20, "source": "any", "destination": "2001:db8::1",
+                "action": "deny", "log": "true"},
+               {"number": 30, "source": "2001:db8:1::/48", "destination": "2001:db8:2::/48",
+                "action": "permit"},
+               {"number": 40, "source": "any", "destination": "any", "action": "deny"}]
+      binary, compiled = self.round_trip(rules, eossdk.ACL_TYPE_IPV6, 6)
+      self.assertEqual(binary, compiled)
+      self.assertTrue(all(rule_sig is not None for number, rule_sig in binary))
+
+   def test_family_mismatch(self):
+      # Records of the other family are invalid in the ACL, as JSON rules are
+      rules = [{"number": 10, "source": "10.0.0.1", "action": "permit"},
+               {"number": 20, "source": "2001:db8::1", "action": "permit"}]
+      binary, compiled = self.round_trip(rules, eossdk.ACL_TYPE_IPV6, 6)
+      self.assertEqual(binary, compiled)
+      self.assertEqual(binary[0], (10, None))
+      self.assertNotEqual(binary[1][1], None)
+
+   def test_mixed_families(self):
+      rules = [{"number": 10, "source": "10.0.0.1", "destination": "2001:db8::1",
+                "action": "permit"}]
+      self.assertRaises(ValueError, converter.rules_pack, rules, 4)
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# Copyright (c) 2018 Arista Networks, Inc.  All rights reserved.
+# Arista Networks, Inc. Confidential and Proprietary.
+
+#Checks that rules_iterate() reads the same elements from a rules description
+#file as json.loads() whatever the size of the chunks the file is read in,
+#including values split across chunks, and rejects the same malformed files.
+#ACLerate is run against the stand-in EOS SDK in performance/fakesdk.  It is
+#executed:
+#   python tests/test_rules_iterate.py
+
+import json
+import os
+import StringIO
+import sys
+import unittest
+
+top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(top_dir, "performance", "fakesdk"))
+sys.path.insert(1, os.path.join(top_dir, "src"))
+import eossdk
+import ACLerate
+
+chunk_sizes = [1, 2, 3, 5, 7, 64, 65536]
+
+class RulesIterateTest(unittest.TestCase):
+
+   def setUp(self):
+      self.read_size = ACLerate.rules_read_size
+
+   def tearDown(self):
+      ACLerate.rules_read_size = self.read_size
+
+   def iterate(self, text, chunk_size):
+      ACLerate.rules_read_size = chunk_size
+      return list(ACLerate.rules_iterate(StringIO.StringIO(text)))
+
+   def check_valid(self, text):
+      for chunk_size in chunk_sizes:
+          self.assertEqual(self.iterate(text, chunk_size), json.loads(text),
+                           "%r read %s bytes at a time" % (text, chunk_size))
+
+   def check_invalid(self, text):
+      for chunk_size in chunk_sizes:
+          self.assertRaises(ValueError, self.iterate, text, chunk_size)
+
+   def test_rules(self):
+      rules = [{"number": number, "source": "10.0.%s.0/24" % number,
+                "destination": "any", "protocol": "tcp", "action": "permit"}
+               for number in xrange(1, 20)]
+      self.check_valid(json.dumps(rules))
+      self.check_valid(json.dumps(rules, indent=4))
+      self.check_valid(" \n[ ]\n")
+      self.check_valid("[]")
+
+   def test_scalars(self):
+      # Numbers are only complete once a delimiter has been read, however
+      # the file is split
+      self.check_valid("[1.5, 12e3, -7, 1E-2,0.25,\n100]")
+      self.check_valid("[12345678901234567890, 3.14159e+10 ]")
+      self.check_valid('[true, false, null, "1.5", {"a": 1.5e2}, [2.5]]')
+
+   def test_trailing(self):
+      self.check_valid("[1, 2]   \n\t")
+      self.check_invalid("[1, 2] x")
+      self.check_invalid("[1, 2]]")
+      self.check_invalid("[1, 2][3]")
+      self.check_invalid('[{"number": 1}]' + " " * 100 + ",")
+
+   def test_malformed(self):
+      self.check_invalid("")
+      self.check_invalid("{}")
+      self.check_invalid("[1, 2")
+      self.check_invalid("[1, 2,]")
+      self.check_invalid("[1 2]")
+      self.check_invalid("[1.]")
+      self.check_invalid('[{"number": 1}')
+      self.check_invalid('[{"number": 1]')
+
+   def test_offset(self):
+      # Errors give the offset in the file, not in the chunk being read
+      text = "[" + "1, " * 30 + "2 3]"
+      for chunk_size in chunk_sizes:
+          try:
+              self.iterate(text, chunk_size)
+          except ValueError as e:
+              self.assertTrue(str(e).endswith("offset %s" % text.index("3")), str(e))
+          else:
+              self.fail("%r was read" % text)
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# Copyright (c) 2018 Arista Networks, Inc.  All rights reserved.
+# Arista Networks, Inc. Confidential and Proprietary.
+
+#Checks that rules_optimize() preserves the first-match semantics of an ACL:
+#random rule sets over a small address space are optimized and every packet
+#in that space must meet the same action, or the implicit deny, before and
+#after.  ACLerate is run against the stand-in EOS SDK in
+#performance/fakesdk.  It is executed:
+#   python tests/test_rules_optimize.py
+
+import os
+import random
+import socket
+import sys
+import unittest
+
+top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(top_dir, "performance", "fakesdk"))
+sys.path.insert(1, os.path.join(top_dir, "src"))
+import eossdk
+import ACLerate
+
+# Rules are drawn from the 16 addresses starting at each base, plus one
+# address outside them which only "any" matches
+address_spaces = {eossdk.ACL_TYPE_IPV4: (socket.AF_INET, "10.0.0.0", 32, "11.0.0.1"),
+                  eossdk.ACL_TYPE_IPV6: (socket.AF_INET6, "2001:db8::", 128, "2001:db9::1")}
+protocols = [None, "tcp", "udp"]
+
+def address_add(family, base, offset):
+    packed = bytearray(socket.inet_pton(family, base))
+    packed[-1] += offset
+    return socket.inet_ntop(family, str(packed))
+
+def address_random(sdk_type):
+    family, base, max_length, outside = address_spaces[sdk_type]
+    if random.random() < 0.2:
+        return "any"
+    length = max_length - random.randint(0, 4)
+    offset = random.randrange(16) & ~((1 << (max_length - length)) - 1)
+    return "%s/%s" % (address_add(family, base, offset), length)
+
+def rules_random(sdk_type, count):
+    rules = []
+    numbers = random.sample(xrange(1, count * 3), count)
+    for number in numbers:
+        rule = {"number": number,
+                "source": address_random(sdk_type),
+                "destination": address_random(sdk_type),
+                "action": random.choice(["permit", "deny"])}
+        protocol = random.choice(protocols)
+        if protocol is not None:
+            rule["protocol"] = protocol
+        if random.random() < 0.1:
+            rule["log"] = "true"
+        rules.append(rule)
+    return rules
+
+def address_value(family, address, memo={}):
+    value = memo.get(address)
+    if value is None:
+        value = memo[address] = int(socket.inet_pton(family, address).encode("hex"), 16)
+    return value
+
+def prefix_matches(prefix, family, address):
+    if prefix is None:
+        return True
+    network, length = prefix.split("/")
+    bits = 32 if family == socket.AF_INET else 128
+    mask = ((1 << int(length)) - 1) << (bits - int(length))
+    return address_value(family, network) & mask == address_value(family, address) & mask
+
+def first_match(rules, family, source, destination, protocol):
+    """The action and log setting of the first rule matching the packet, or
+    None if it meets the implicit deny"""
+
+    for number, rule_sig in sorted(rules):
+        if rule_sig is None:
+            continue
+        rule_source, rule_destination, rule_protocol, action, log = rule_sig
+        if (prefix_matches(rule_source, family, source) and
+            prefix_matches(rule_destination, family, destination) and
+            rule_protocol in (None, protocol)):
+            return action, log
+    return None
+
+class RulesOptimizeTest(unittest.TestCase):
+
+   def check_equivalent(self, sdk_type, count, barriers):
+      family, base, max_length, outside = address_spaces[sdk_type]
+      rules_json = rules_random(sdk_type, count)
+      rules = list(ACLerate.rules_compile(iter(rules_json), "add-rule", sdk_type,
+                                          ACLerate.LatencyTimer("test")))
+      # Invalid rules, compiled as None, are barriers to merging
+      rules = [(number, None if random.random() < 0.05 else rule_sig)
+               for number, rule_sig in rules]
+      optimized, saved_rules, saved_entries = ACLerate.rules_optimize(rules, sdk_type,
+                                                                      barriers)
+      self.assertEqual(len(rules) - len(optimized), saved_rules)
+      self.assertEqual(sorted(optimized), optimized)
+
+      addresses = [address_add(family, base, offset) for offset in xrange(16)] + [outside]
+      for source in addresses:
+          for destination in addresses:
+              for protocol in (6, 17, 1):
+                  self.assertEqual(first_match(rules, family, source, destination, protocol),
+                                   first_match(optimized, family, source, destination,
+                                               protocol),
+                                   "%s to %s protocol %s: rules %s optimized to %s" %
+                                   (source, destination, protocol, rules, optimized))
+      return saved_rules
+
+   def test_ipv4(self):
+      random.seed(1)
+      saved = 0
+      for trial in xrange(100):
+          saved += self.check_equivalent(eossdk.ACL_TYPE_IPV4, random.randint(1, 40), [])
+      # The rule sets are dense enough for rules to be dropped and merged
+      self.assertTrue(saved > 0)
+
+   def test_ipv6(self):
+      random.seed(2)
+      for trial in xrange(50):
+          self.check_equivalent(eossdk.ACL_TYPE_IPV6, random.randint(1, 40), [])
+
+   def test_barriers(self):
+      random.seed(3)
+      for trial in xrange(50):
+          barriers = sorted(random.sample(xrange(1, 120), 5))
+          self.check_equivalent(eossdk.ACL_TYPE_IPV4, random.randint(1, 40), barriers)
+
+   def test_merges(self):
+      # Sibling prefixes with the same action merge into their parent
+      rules = [(10, ("10.0.0.0/25", None, 6, "permit", None)),
+               (20, ("10.0.0.128/25", None, 6, "permit", None))]
+      optimized, saved_rules, saved_entries = ACLerate.rules_optimize(
+          rules, eossdk.ACL_TYPE_IPV4, [])
+      self.assertEqual(optimized, [(10, ("10.0.0.0/24", None, 6, "permit", None))])
+      self.assertEqual(saved_rules, 1)
+
+if __name__ == '__main__':
+   unittest.main()
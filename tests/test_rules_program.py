@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# Copyright (c) 2018 Arista Networks, Inc.  All rights reserved.
+# Arista Networks, Inc. Confidential and Proprietary.
+
+#Checks that only the differences between the rules of a rules description
+#file and those last pushed to the ACL are programmed, that rules from other
+#files of the same ACL are left alone and, without batch commits, that the
+#ACLs are programmed again in full after the HW rejects a commit.  ACLerate
+#is run against the stand-in EOS SDK in performance/fakesdk.  It is executed:
+#   python tests/test_rules_program.py
+
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(top_dir, "performance", "fakesdk"))
+sys.path.insert(1, os.path.join(top_dir, "src"))
+import eossdk
+import ACLerate
+
+acl_key = eossdk.AclKey("A", eossdk.ACL_TYPE_IPV4)
+
+class RulesProgramTest(unittest.TestCase):
+
+   def setUp(self):
+      self.dir = tempfile.mkdtemp()
+      self.batch_commit = ACLerate.batch_commit
+      ACLerate.counters_interval = None
+      ACLerate.metrics_file = None
+      ACLerate.snapshot_file = None
+      ACLerate.control_socket = None
+      ACLerate.ACLerate_config_dir = None
+      ACLerate.ACLerate_config_file = os.path.join(self.dir, "config.json")
+
+   def tearDown(self):
+      ACLerate.batch_commit = self.batch_commit
+      shutil.rmtree(self.dir)
+
+   def agent_start(self, batch_commit):
+      ACLerate.batch_commit = batch_commit
+      self.sdk = eossdk.Sdk()
+      self.acl_mgr = self.sdk.acl_mgr
+      self.agent = ACLerate.ACLerate(self.sdk)
+
+   def rules_write(self, name, rules):
+      """Write the rules, given as {number: third octet of the source}"""
+
+      rules_file = os.path.join(self.dir, name + ".json")
+      with open(rules_file, "w") as f:
+          json.dump([{"number": number, "source": "10.0.%s.%s" % (octet, number),
+                      "destination": "any", "action": "permit"}
+                     for number, octet in sorted(rules.iteritems())], f)
+      return rules_file
+
+   def process(self, rules_files):
+      """Process an add-rule entry for ACL A for each rules file, returning
+      the number of rules set and deleted"""
+
+      with open(ACLerate.ACLerate_config_file, "w") as f:
+          json.dump([{"command": "add-rule", "name": "A", "type": "IPv4",
+                      "rules": rules_file} for rules_file in rules_files], f)
+      calls = self.acl_mgr.calls.copy()
+      self.agent.process_config()
+      self.sdk.run_until_idle()
+      return (self.acl_mgr.calls["acl_rule_set"] - calls["acl_rule_set"],
+              self.acl_mgr.calls["acl_rule_del"] - calls["acl_rule_del"])
+
+   def hw_sources(self):
+      return dict((number, acl_rule.source_addr().addr().to_string())
+                  for number, acl_rule in self.acl_mgr.acls.get(acl_key, {}).iteritems())
+
+   def test_incremental(self):
+      self.agent_start(True)
+      rules_file = self.rules_write("rules", dict((number, 0) for number in xrange(1, 101)))
+      self.assertEqual(self.process([rules_file]), (100, 0))
+
+      # One rule modified, one removed and one added
+      rules = dict((number, 0) for number in xrange(1, 101))
+      rules[10] = 1
+      del rules[20]
+      rules[200] = 0
+      self.rules_write("rules", rules)
+      self.assertEqual(self.process([rules_file]), (2, 1))
+      self.assertEqual(sorted(self.hw_sources()), sorted(rules))
+      self.assertEqual(self.hw_sources()[10], "10.0.1.10")
+
+      # Unchanged, if processed again, the rules need no programming
+      self.agent.config_fingerprints = {}
+      self.assertEqual(self.process([rules_file]), (0, 0))
+
+   def test_origins(self):
+      # Rules are only removed from the ACL by the file they were added from
+      self.agent_start(True)
+      first = self.rules_write("first", {1: 0, 2: 0})
+      second = self.rules_write("second", {11: 0, 12: 0})
+      self.assertEqual(self.process([first, second]), (4, 0))
+      self.rules_write("second", {12: 1})
+      self.assertEqual(self.process([first, second]), (1, 1))
+      self.assertEqual(sorted(self.hw_sources()), [1, 2, 12])
+
+   def test_sync_fail(self):
+      # Without batch commits the rejected changes are not rolled back, so
+      # the HW is no longer known to match the shadow
+      self.agent_start(False)
+      rules_file = self.rules_write("rules", {1: 0, 2: 0, 3: 0})
+      self.process([rules_file])
+
+      self.rules_write("rules", {1: 0, 2: 1, 4: 0})
+      self.acl_mgr.sync_fail = "TCAM full"
+      self.assertEqual(self.process([rules_file]), (2, 1))
+      self.acl_mgr.sync_fail = None
+      # Say the HW kept the ACL as it was
+      self.acl_mgr.acls[acl_key] = dict((number, acl_rule) for number, acl_rule
+                                        in self.acl_mgr.acls[acl_key].iteritems()
+                                        if number != 4)
+
+      # Every rule is pushed again, as is the deletion
+      self.assertEqual(self.process([rules_file]), (3, 1))
+      self.assertEqual(sorted(self.hw_sources()), [1, 2, 4])
+      self.assertEqual(self.agent.rules_unverified, {})
+      self.agent.config_fingerprints = {}
+      self.assertEqual(self.process([rules_file]), (0, 0))
+
+   def test_sync_fail_other_acls(self):
+      # Only the ACLs changed since the last commit the HW accepted are
+      # programmed again
+      self.agent_start(False)
+      rules_file = self.rules_write("rules", {1: 0, 2: 0})
+      self.process([rules_file])
+      self.acl_mgr.sync_fail = "TCAM full"
+      with open(ACLerate.ACLerate_config_file, "w") as f:
+          json.dump([{"command": "add-rule", "name": "B", "type": "IPv4",
+                      "rules": self.rules_write("other", {5: 0})}], f)
+      self.agent.process_config()
+      self.sdk.run_until_idle()
+      self.acl_mgr.sync_fail = None
+      self.assertEqual(sorted(self.agent.rules_unverified), [("B", eossdk.ACL_TYPE_IPV4)])
+
+if __name__ == '__main__':
+   unittest.main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# Copyright (c) 2018 Arista Networks, Inc.  All rights reserved.
+# Arista Networks, Inc. Confidential and Proprietary.
+
+#This script is used to send commands to ACLerate over its control socket
+#rather than via the configuration file, and to show ACLerate's reply.
+#It is executed:
+#   ACLerate-control.py <request_file> [<socket>]
+#where
+#   request_file: JSON file containing the request, e.g.
+#       {"id": 1, "commands": [{"command": "add-rule", "name": "block",
+#                               "type": "IPv4", "rules": [{"number": 10,
+#                               "source": "192.0.2.1", "action": "deny"}]}]}
+#   socket: ACLerate's control socket (default /var/run/ACLerate.sock)
+#The reply is printed once ACLerate has programmed the HW.  control_request()
+#may also be used directly by other scripts.
+
+import json
+import socket
+import struct
+import sys
+
+#Must match control_socket and control_frame in ACLerate.py
+ACLerate_control_socket = '/var/run/ACLerate.sock'
+control_frame = struct.Struct("!I")
+
+def recv_exactly(sock, length):
+    data = ""
+    while len(data) < length:
+        chunk = sock.recv(length - len(data))
+        if not chunk:
+            raise IOError("ACLerate closed the connection")
+        data += chunk
+    return data
+
+def control_request(request, path=ACLerate_control_socket):
+    """Send request to ACLerate and return its reply"""
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        body = json.dumps(request)
+        sock.sendall(control_frame.pack(len(body)) + body)
+        length = control_frame.unpack(recv_exactly(sock, control_frame.size))[0]
+        return json.loads(recv_exactly(sock, length))
+    finally:
+        sock.close()
+
+def main():
+    with open(sys.argv[1]) as f:
+        request = json.load(f)
+    path = ACLerate_control_socket
+    if len(sys.argv) > 2:
+        path = sys.argv[2]
+
+    reply = control_request(request, path)
+    print json.dumps(reply, indent=2)
+    if reply.get("status") != "ok":
+        return 1
+
+if __name__ == '__main__':
+   sys.exit( main() )
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# Copyright (c) 2018 Arista Networks, Inc.  All rights reserved.
+# Arista Networks, Inc. Confidential and Proprietary.
+
+#This script is used to convert a JSON rules description file into the
+#compact binary format which ACLerate can also read.  Binary rules files are
+#much smaller than the JSON equivalent and ACLerate loads them without
+#parsing, so they are quicker to copy to flash and to process.
+#It is executed:
+#   rules-json-to-binary.py [--type IPv4|IPv6] <json_file> <binary_file>
+#where the type is that of the ACLs the rules are for (default IPv4), giving
+#the address family of rules whose source and destination are both "any".
+#The binary format is described alongside rules_binary_magic in ACLerate.py,
+#which is imported for its definitions.  Off the switch, where the EOS SDK is
+#not installed, the stand-in in performance/fakesdk is used instead.
+
+import json
+import os
+import socket
+import sys
+import zlib
+
+top_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(top_dir, "src"))
+try:
+    import eossdk
+except ImportError:
+    sys.path.insert(1, os.path.join(top_dir, "performance", "fakesdk"))
+import ACLerate
+
+def prefix_pack(prefix, family):
+    """Convert an address or prefix string, of the address family (4 or 6),
+    to (packed address, length).  "any" is the zero length prefix."""
+
+    if prefix == "any":
+        if family == 6:
+            prefix = "::/0"
+        else:
+            prefix = "0.0.0.0/0"
+    address, _, length = prefix.partition("/")
+    if family == 6:
+        max_length = 128
+        packed = socket.inet_pton(socket.AF_INET6, address)
+    else:
+        max_length = 32
+        packed = socket.inet_pton(socket.AF_INET, address)
+    if length:
+        length = int(length)
+    else:
+        length = max_length
+    if not 0 <= length <= max_length:
+        raise ValueError("Invalid prefix length in %s" % prefix)
+    return packed, length
+
+def rule_pack(rule, acl_family):
+    """Convert a JSON rule, of an ACL of the address family acl_family (4 or
+    6), to a binary rule record"""
+
+    number = int(rule["number"])
+    flags = 0
+    addresses = []
+    for attribute, flag in (("source", ACLerate.rules_binary_source),
+                            ("destination", ACLerate.rules_binary_destination)):
+        if rule.get(attribute):
+            addresses.append(rule[attribute])
+            flags |= flag
+        else:
+            addresses.append(None)
+    if addresses == [None, None]:
+        raise ValueError("Either source or destination essential for rule %s" % number)
+
+    # The family is that of the addresses given, "any" matching either
+    families = set(6 if ":" in address else 4 for address in addresses
+                   if address is not None and address != "any")
+    if len(families) > 1:
+        raise ValueError("Rule %s mixes IPv4 and IPv6 addresses" % number)
+    family = families.pop() if families else acl_family
+    prefixes = [prefix_pack(address, family) if address is not None else ("", 0)
+                for address in addresses]
+
+    action = rule.get("action")
+    if action is None or action.lower() not in ("permit", "deny"):
+        raise ValueError("Rule %s action must be 'permit' or 'deny'" % number)
+    if action.lower() == "permit":
+        flags |= ACLerate.rules_binary_permit
+
+    log = rule.get("log")
+    if log:
+        flags |= ACLerate.rules_binary_log_set
+        if str(log).lower() == "true":
+            flags |= ACLerate.rules_binary_log
+
+    protocol = 0
+    if rule.get("protocol"):
+        protocol = ACLerate.protocols_ip.get(rule["protocol"].upper())
+        if protocol is None:
+            raise ValueError("Rule %s protocol '%s' unsupported" % (number, rule["protocol"]))
+
+    return ACLerate.rules_binary_record.pack(number, protocol, family,
+                                             prefixes[0][1], prefixes[1][1], flags,
+                                             prefixes[0][0], prefixes[1][0])
+
+def rules_pack(rules, acl_family):
+    """Convert a list of JSON rules to the contents of a binary rules file"""
+
+    records = "".join(rule_pack(rule, acl_family) for rule in rules)
+    header = ACLerate.rules_binary_header.pack(ACLerate.rules_binary_magic,
+                                               ACLerate.rules_binary_version,
+                                               ACLerate.rules_binary_record.size,
+                                               len(rules),
+                                               zlib.crc32(records) & 0xffffffff)
+    return header + records
+
+def main():
+    args = sys.argv[1:]
+    acl_family = 4
+    if args and args[0] == "--type":
+        if args[1].lower() not in ("ipv4", "ipv6"):
+            sys.stderr.write("Type must be IPv4 or IPv6, i.e. not '%s'\n" % args[1])
+            return 1
+        acl_family = 6 if args[1].lower() == "ipv6" else 4
+        args = args[2:]
+    json_file = args[0]
+    binary_file = args[1]
+
+    with open(json_file) as f:
+        rules = json.load(f)
+
+    contents = rules_pack(rules, acl_family)
+    with open(binary_file, "wb") as f:
+        f.write(contents)
+
+    sys.stderr.write("Converted %s rules from %s to %s (%s bytes)\n" %
+                     (len(rules), json_file, binary_file, len(contents)))
+
+if __name__ == '__main__':
+   sys.exit( main() )
@@ -4,37 +4,48 @@
 
 #This script is used to generate a an exemplar rules description
 #JSON file with potentially thousands of rules for testing ACLerate.
-#The number of rules is passed in as the argument.
+#It is executed:
+#   rules-json-writer.py <rule_count> [<file>]
+#where
+#   rule_count: number of rules to generate
+#   file: rules description file to write (default ACLerate-rules.json)
+#rules_write() may also be used directly, e.g. by the benchmark suite.
 
 import json
 import netaddr
 import sys
 
-#Rule count input as argument
-rule_count = int(sys.argv[1])
-
 #Arbitrary initial source and destination addresses
 base_src_ip_addr = 3232235777 #192.168.1.1
 base_dest_ip_addr = 2808220394 #167.98.10.234
 
-#Populate list of rules
-rules = []
-for j in range (rule_count):
-    rule = {}
-    rule["number"] = j+1
-    rule["source"] = str(netaddr.IPAddress(base_src_ip_addr + j))
-    rule["destination"] = str(netaddr.IPAddress(base_dest_ip_addr - j))
-    rule["action"] = "permit"
-    rule["protocol"] = "TCP"
-    rule["log"] = "true"
-
-    #Rules used for initial testing similar to
-    #"2 permit TCP host 192.168.1.2 host 167.98.10.233 log"
-
-    rules.append(rule)
-
-#Convert to JSON and print to file
-indented_json = json.dumps(rules, indent=2)
-
-with open('ACLerate-rules.json', 'w') as f:
-    print >> f, indented_json 
+def rules_write(rule_count, filename='ACLerate-rules.json', indent=2):
+    #Populate list of rules
+    rules = []
+    for j in range (rule_count):
+        rule = {}
+        rule["number"] = j+1
+        rule["source"] = str(netaddr.IPAddress(base_src_ip_addr + j))
+        rule["destination"] = str(netaddr.IPAddress(base_dest_ip_addr - j))
+        rule["action"] = "permit"
+        rule["protocol"] = "TCP"
+        rule["log"] = "true"
+
+        #Rules used for initial testing similar to
+        #"2 permit TCP host 192.168.1.2 host 167.98.10.233 log"
+
+        rules.append(rule)
+
+    #Convert to JSON and print to file
+    indented_json = json.dumps(rules, indent=indent)
+
+    with open(filename, 'w') as f:
+        print >> f, indented_json 
+
+if __name__ == '__main__':
+    #Rule count input as argument
+    rule_count = int(sys.argv[1])
+    if len(sys.argv) > 2:
+        rules_write(rule_count, sys.argv[2])
+    else:
+        rules_write(rule_count)